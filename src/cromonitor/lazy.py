@@ -0,0 +1,68 @@
+"""
+This module contains the lazy imports of the heavy dependencies of cromonitor.
+
+Plotting libraries (matplotlib, seaborn, plotly) and the Google Cloud clients take
+seconds to import, while most runs only need some of them: a batch job querying
+the cost does not plot anything, and a notebook plotting stored tables does not
+query BigQuery. A LazyModule stands in for a module and imports it on first use,
+so importing cromonitor only pays for the dependencies actually used.
+"""
+
+import importlib
+import sys
+import threading
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """
+    Module imported on the first access to one of its attributes. Setting or
+    deleting an attribute, for example to patch it in a test, is done on the
+    imported module.
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: Absolute name of the module, such as "matplotlib.pyplot"
+        """
+        super().__init__(name)
+        object.__setattr__(self, "_lazy_lock", threading.Lock())
+        object.__setattr__(self, "_lazy_module", None)
+
+    def _load(self) -> ModuleType:
+        module = object.__getattribute__(self, "_lazy_module")
+        if module is None:
+            with object.__getattribute__(self, "_lazy_lock"):
+                module = object.__getattribute__(self, "_lazy_module")
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    object.__setattr__(self, "_lazy_module", module)
+        return module
+
+    def __getattr__(self, name: str):
+        # Only called for attributes the proxy does not hold itself
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name: str, value):
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name: str):
+        delattr(self._load(), name)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        loaded = object.__getattribute__(self, "_lazy_module") is not None
+        return f"<LazyModule {self.__name__!r}{'' if loaded else ' (not loaded)'}>"
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Get a module, imported on first use unless it is already imported
+    :param name: Absolute name of the module, such as "google.cloud.bigquery"
+    :return: Module, or LazyModule standing in for it
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
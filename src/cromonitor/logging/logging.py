@@ -3,6 +3,26 @@ This module contains functions to handle errors and warnings.
 """
 
 import logging
+import sys
+
+# Name of the handler added to the root logger by configure_logger
+HANDLER_NAME = "cromonitor"
+
+
+def configure_logger(debug: bool = False) -> logging.Logger:
+    """
+    Set the level of the root logger and add a handler writing to stderr, once per
+    process, so creating many query objects does not duplicate log lines
+    :param debug: Whether to log debug messages
+    :return: Root logger
+    """
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    if not any(handler.get_name() == HANDLER_NAME for handler in logger.handlers):
+        handler = logging.StreamHandler(sys.stderr)
+        handler.set_name(HANDLER_NAME)
+        logger.addHandler(handler)
+    return logger
 
 
 def handle_user_error(err, message=None):
@@ -1,12 +1,17 @@
 # Class for plotting cost data.
+from __future__ import annotations
+
 from typing import Optional, Union
 
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 
+from ..lazy import lazy_import
 from ..logging import logging as log
 
+# Plotting libraries are imported on the first plot
+px = lazy_import("plotly.express")
+go = lazy_import("plotly.graph_objects")
+
 COST_COLUMN_NAME = "cost"
 COST_DESCRIPTION_COLUMN_NAME = "cost_description"
 TASK_NAME_COLUMN_NAME = "task_name"
@@ -1,7 +1,27 @@
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 from ..logging import logging as log
+from ..table.ragged import sample_reduction
+
+# Metrics columns plotted on the resource usage timelines
+RESOURCE_USAGE_COLUMNS = {
+    "cpu": "metrics_cpu_used_percent",
+    "mem": "metrics_mem_used_gb",
+    "disk": "metrics_disk_used_gb",
+    "disk_read": "metrics_disk_read_iops",
+    "disk_write": "metrics_disk_write_iops",
+}
+
+# Columns of the runtime table about the metrics of a VM, kept as attributes of the
+# VM rather than summarized like its samples
+RUNTIME_METRICS_COLUMNS = {
+    "metrics_duration_sec",
+    "metrics_start_time",
+    "metrics_end_time",
+}
 
 
 def mean_of_string(x: list):
@@ -72,6 +92,25 @@ def get_outliers(
     return lower_outliers, upper_outliers
 
 
+def fill_na(column: pd.Series, value) -> pd.Series:
+    """
+    Replace the missing values of a column. Missing rows of Arrow list columns
+    (pd.ArrowDtype) are replaced with a list of the value, as a scalar row holds a
+    single value.
+    @param column:
+    @param value:
+    @return:
+    """
+    dtype = column.dtype
+    if isinstance(dtype, pd.ArrowDtype) and pa.types.is_list(dtype.pyarrow_dtype):
+        filled = pc.fill_null(
+            pa.chunked_array(column.array.__arrow_array__()),
+            pa.scalar([value], type=dtype.pyarrow_dtype),
+        )
+        return pd.Series(filled, index=column.index, name=column.name, dtype=dtype)
+    return column.fillna(value)
+
+
 def fill_na_with_zero(df: pd.DataFrame, columns: list) -> pd.DataFrame:
     """
     Function to replace NaN values with 0 in the specified columns of a DataFrame.
@@ -95,7 +134,7 @@ def fill_na_with_zero(df: pd.DataFrame, columns: list) -> pd.DataFrame:
     # Removes shards with null in columns being measured.
     df_filled = df.copy()
     for col in columns:
-        df_filled[col] = df_filled[col].fillna(0)
+        df_filled[col] = fill_na(df_filled[col], 0)
 
     # error if datafram is empty
     if df_filled.empty:
@@ -110,12 +149,12 @@ def remove_nan(input_data: dict):
     @param input_data:
     @return:
     """
-    clean_dict = {k: input_data[k] for k in input_data if not np.isnan(input_data[k])}
+    clean_dict = {k: input_data[k] for k in input_data if not pd.isna(input_data[k])}
     return clean_dict
 
 
 def calculate_shard_metrics(
-    summary_shards, metrics_runtime, task_name_input, mean_of_string
+    summary_shards, metrics_runtime, task_name_input, mean_of_string=None
 ):
     """
     For each element in seres get the average cpu, max cpu, max mem, max disk
@@ -123,7 +162,9 @@ def calculate_shard_metrics(
     :param summary_shards:
     :param metrics_runtime:
     :param task_name_input:
-    :param mean_of_string:
+    :param mean_of_string: Function reducing the cpu usage of each sample, applied
+    row by row. By default the reductions of the repeated fields are computed at
+    once for the whole task, see table.ragged.
     :return:
     """
     average_cpu_per_shard_dict = {}
@@ -132,14 +173,22 @@ def calculate_shard_metrics(
     max_disk_per_shard_dict = {}
     duration_per_shard_dict = {}
 
+    df_task = metrics_runtime.loc[
+        metrics_runtime["runtime_task_call_name"] == task_name_input
+    ]
+    if mean_of_string is None:
+        cpu_time_mean_task = sample_reduction(df_task, "metrics_cpu_mean_percent")
+        first_disk_task = sample_reduction(df_task, "metrics_disk_first_gb")
+    else:
+        cpu_time_mean_task = df_task.metrics_cpu_used_percent.apply(mean_of_string)
+        first_disk_task = df_task.metrics_disk_used_gb.apply(get_1st_disk_usage)
+
     for shard in summary_shards:
-        # create dataframe for a given task name and shard
-        df_summary_shard = metrics_runtime.loc[
-            (metrics_runtime["runtime_task_call_name"] == task_name_input)
-            & (metrics_runtime["runtime_shard"] == shard)
-        ]
+        # rows of the task for a given shard
+        in_shard = (df_task["runtime_shard"] == shard).to_numpy()
+        df_summary_shard = df_task.loc[in_shard]
 
-        cpu_time_mean = df_summary_shard.metrics_cpu_used_percent.apply(mean_of_string)
+        cpu_time_mean = cpu_time_mean_task.loc[in_shard]
 
         average_cpu_per_shard_dict[str(shard)] = cpu_time_mean.mean()
         max_cpu_per_shard_dict[str(shard)] = cpu_time_mean.max()
@@ -148,10 +197,71 @@ def calculate_shard_metrics(
             df_summary_shard.metrics_mem_used_gb.max()
         )
 
+        max_disk_per_shard_dict[str(shard)] = first_disk_task.loc[in_shard].max()
+
+        duration_per_shard_dict[str(shard)] = df_summary_shard[
+            "metrics_duration_sec"
+        ].iloc[0]
+
+    return (
+        remove_nan(average_cpu_per_shard_dict),
+        remove_nan(max_cpu_per_shard_dict),
+        remove_nan(max_memory_per_shard_dict),
+        remove_nan(max_disk_per_shard_dict),
+        remove_nan(duration_per_shard_dict),
+    )
+
+
+def is_metrics_summary(df: pd.DataFrame) -> bool:
+    """
+    Check if a metrics dataframe holds per VM summaries, as fetched by
+    QueryBQToMonitor with metrics_mode="summary", rather than raw samples.
+    @param df:
+    @return:
+    """
+    return "summary_cpu_mean_percent" in df.columns
+
+
+def calculate_shard_metrics_from_summary(metrics_summary_runtime, task_name_input):
+    """
+    Get the average cpu, max cpu, max mem, max disk usage and duration of each shard
+    of a task from per VM summaries. Produces the same dictionaries as
+    calculate_shard_metrics without going through the raw samples.
+    :param metrics_summary_runtime: Metrics summaries merged with the runtime table
+    :param task_name_input:
+    :return:
+    """
+    df_task = metrics_summary_runtime.loc[
+        metrics_summary_runtime["runtime_task_call_name"] == task_name_input
+    ]
+
+    average_cpu_per_shard_dict = {}
+    max_cpu_per_shard_dict = {}
+    max_memory_per_shard_dict = {}
+    max_disk_per_shard_dict = {}
+    duration_per_shard_dict = {}
+
+    for shard, df_summary_shard in df_task.groupby("runtime_shard", sort=False):
+        # A shard can run on several VMs (retries, preemption), weight their
+        # average cpu usage by their number of samples.
+        sample_count = df_summary_shard.summary_sample_count.astype(float)
+        cpu_mean = df_summary_shard.summary_cpu_mean_percent.astype(float)
+        has_cpu = cpu_mean.notna()
+        average_cpu_per_shard_dict[str(shard)] = (
+            (cpu_mean[has_cpu] * sample_count[has_cpu]).sum()
+            / sample_count[has_cpu].sum()
+            if has_cpu.any()
+            else np.nan
+        )
+        max_cpu_per_shard_dict[str(shard)] = (
+            df_summary_shard.summary_cpu_max_percent.astype(float).max()
+        )
+        max_memory_per_shard_dict[str(shard)] = (
+            df_summary_shard.summary_mem_max_gb.astype(float).max()
+        )
         max_disk_per_shard_dict[str(shard)] = (
-            df_summary_shard.metrics_disk_used_gb.apply(get_1st_disk_usage).max()
+            df_summary_shard.summary_disk_max_gb.astype(float).max()
         )
-
         duration_per_shard_dict[str(shard)] = df_summary_shard[
             "metrics_duration_sec"
         ].iloc[0]
@@ -163,3 +273,95 @@ def calculate_shard_metrics(
         remove_nan(max_disk_per_shard_dict),
         remove_nan(duration_per_shard_dict),
     )
+
+
+def is_metrics_bucketed(df: pd.DataFrame) -> bool:
+    """
+    Check if a metrics dataframe holds time buckets, as fetched by
+    QueryBQToMonitor with metrics_mode="bucketed", rather than raw samples.
+    @param df:
+    @return:
+    """
+    return "metrics_cpu_used_percent_mean" in df.columns
+
+
+def get_resource_usage_arrays(df_monitoring_task_shard: pd.DataFrame) -> (dict, dict):
+    """
+    Get the values to plot on the resource usage timelines of a task shard.
+    For raw samples, cpu usage is the mean over the cores and disk usage the max
+    over the disks of each sample. For time buckets, the mean of each bucket is
+    plotted along with the band between its min and max.
+    @param df_monitoring_task_shard: Metrics of a task shard sorted by timestamp
+    @return: Dictionary of usage arrays and dictionary of (min, max) bands,
+    both keyed by the keys of RESOURCE_USAGE_COLUMNS
+    """
+    if is_metrics_bucketed(df_monitoring_task_shard):
+        usage = {
+            resource: df_monitoring_task_shard[f"{column}_mean"].to_numpy(dtype=float)
+            for resource, column in RESOURCE_USAGE_COLUMNS.items()
+        }
+        bands = {
+            resource: (
+                df_monitoring_task_shard[f"{column}_min"].to_numpy(dtype=float),
+                df_monitoring_task_shard[f"{column}_max"].to_numpy(dtype=float),
+            )
+            for resource, column in RESOURCE_USAGE_COLUMNS.items()
+        }
+        return usage, bands
+
+    usage = {
+        "cpu": sample_reduction(
+            df_monitoring_task_shard, "metrics_cpu_mean_percent"
+        ).to_numpy(),
+        "mem": df_monitoring_task_shard.metrics_mem_used_gb.to_numpy(
+            dtype=float, na_value=np.nan
+        ),
+        "disk": sample_reduction(
+            df_monitoring_task_shard, "metrics_disk_max_gb"
+        ).to_numpy(),
+        "disk_read": sample_reduction(
+            df_monitoring_task_shard, "metrics_disk_read_iops_max"
+        ).to_numpy(),
+        "disk_write": sample_reduction(
+            df_monitoring_task_shard, "metrics_disk_write_iops_max"
+        ).to_numpy(),
+    }
+    return usage, {}
+
+
+def bucketed_metrics_to_summary(metrics_bucketed_runtime: pd.DataFrame) -> pd.DataFrame:
+    """
+    Reduce time buckets to one summary row per VM, in the format of the metrics
+    fetched with metrics_mode="summary". The disk usage of buckets is the max over
+    all disks, instead of the first disk only.
+    @param metrics_bucketed_runtime: Time buckets, optionally merged with runtime
+    @return:
+    """
+    df = metrics_bucketed_runtime.assign(
+        _cpu_sum=metrics_bucketed_runtime.metrics_cpu_used_percent_mean.astype(float)
+        * metrics_bucketed_runtime.metrics_sample_count.astype(float)
+    )
+    grouped = df.groupby("metrics_instance_id", sort=False)
+    summary = grouped.agg(
+        summary_sample_count=("metrics_sample_count", "sum"),
+        _cpu_sum=("_cpu_sum", "sum"),
+        summary_cpu_max_percent=("metrics_cpu_used_percent_max", "max"),
+        summary_mem_max_gb=("metrics_mem_used_gb_max", "max"),
+        summary_disk_max_gb=("metrics_disk_used_gb_max", "max"),
+        summary_start_timestamp=("metrics_timestamp", "min"),
+        summary_end_timestamp=("metrics_timestamp", "max"),
+    )
+    summary["summary_cpu_mean_percent"] = summary.pop("_cpu_sum") / summary[
+        "summary_sample_count"
+    ].astype(float)
+
+    # Keep the runtime attributes of each VM
+    other_columns = [
+        column
+        for column in metrics_bucketed_runtime.columns
+        if not column.startswith("metrics_") or column in RUNTIME_METRICS_COLUMNS
+    ]
+    if other_columns:
+        summary = summary.join(grouped[other_columns].first())
+
+    return summary.reset_index()
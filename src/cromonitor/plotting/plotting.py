@@ -1,26 +1,47 @@
+from __future__ import annotations
+
 import datetime
 import logging
 from typing import List, Optional, Union
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
-import plotly.io as pio
-import seaborn as sns
-from plotly.subplots import make_subplots
 
+from ..lazy import lazy_import
 from ..table import utils as tableUtils
+from ..table.dataset import MonitoringDataset
 from .data_processing import (
+    bucketed_metrics_to_summary,
     calculate_shard_metrics,
+    calculate_shard_metrics_from_summary,
     fill_na_with_zero,
     get_outliers,
-    mean_of_string,
+    get_resource_usage_arrays,
+    is_metrics_bucketed,
+    is_metrics_summary,
 )
 
+# Plotting libraries are imported on the first plot
+plt = lazy_import("matplotlib.pyplot")
+go = lazy_import("plotly.graph_objects")
+pio = lazy_import("plotly.io")
+plotly_subplots = lazy_import("plotly.subplots")
+sns = lazy_import("seaborn")
+
 logger = logging.getLogger(__name__)
 
 
+def get_monitoring_dataset(df_monitoring) -> Optional[MonitoringDataset]:
+    """
+    Get the MonitoringDataset of a monitor, such as QueryBQToMonitor, to look up
+    the samples of a task or shard without filtering a merged metrics_runtime table
+    :param df_monitoring: Object holding the monitoring tables
+    :return: None if the monitor only holds tables
+    """
+    dataset = getattr(df_monitoring, "monitoring_dataset", None)
+    return dataset if isinstance(dataset, MonitoringDataset) else None
+
+
 def calculate_workflow_duration(df_monitoring) -> int:
     """
     Calculate the total duration of a workflow in seconds.
@@ -31,8 +52,12 @@ def calculate_workflow_duration(df_monitoring) -> int:
     Returns:
     int: The total duration of the workflow in seconds.
     """
-    latest_end_datetime = max(df_monitoring.metrics["metrics_timestamp"])
-    earliest_start_datetime = min(df_monitoring.metrics["metrics_timestamp"])
+    if is_metrics_summary(df_monitoring.metrics):
+        latest_end_datetime = max(df_monitoring.metrics["summary_end_timestamp"])
+        earliest_start_datetime = min(df_monitoring.metrics["summary_start_timestamp"])
+    else:
+        latest_end_datetime = max(df_monitoring.metrics["metrics_timestamp"])
+        earliest_start_datetime = min(df_monitoring.metrics["metrics_timestamp"])
     workflow_duration: int = round(
         datetime.timedelta.total_seconds(latest_end_datetime - earliest_start_datetime)
     )
@@ -56,15 +81,19 @@ def get_sorted_task_summary(
 
     :return:
     """
-    # Sort the task summary by duration
-    df_monitoring.metrics_runtime.sort_values(
-        by="metrics_duration_sec", ascending=False, inplace=True
-    )
+    dataset = get_monitoring_dataset(df_monitoring)
+    if dataset is not None:
+        task_summary_dict = dataset.task_summary()
+    else:
+        # Sort the task summary by duration
+        df_monitoring.metrics_runtime.sort_values(
+            by="metrics_duration_sec", ascending=False, inplace=True
+        )
 
-    all_task_names = df_monitoring.metrics_runtime.runtime_task_call_name.unique()
-    task_summary_dict = tableUtils.get_task_summary(
-        task_names=all_task_names, df=df_monitoring.metrics_runtime
-    )
+        all_task_names = df_monitoring.metrics_runtime.runtime_task_call_name.unique()
+        task_summary_dict = tableUtils.get_task_summary(
+            task_names=all_task_names, df=df_monitoring.metrics_runtime
+        )
     task_summary_duration = tableUtils.get_task_summary_duration(
         task_summary_dict=task_summary_dict
     )
@@ -130,7 +159,7 @@ def create_workflow_summary_subplot_figure(
     :param parent_workflow_id: The parent workflow id
     :return:
     """
-    fig = make_subplots(
+    fig = plotly_subplots.make_subplots(
         rows=2,
         cols=1,
         vertical_spacing=0.1,
@@ -331,21 +360,38 @@ def plot_shard_summary(
     :return:
     """
 
-    # print warning if na values are present
-    df_filled = fill_na_with_zero(
-        df=metrics_runtime,
-        columns=[
-            "metrics_duration_sec",
-            "meta_duration_sec",
-            "metrics_disk_used_gb",
-            "metrics_mem_used_gb",
-            "metrics_cpu_used_percent",
-        ],
-    )
+    if is_metrics_summary(metrics_runtime):
+        # Summaries were already aggregated per VM in BigQuery
+        shard_metrics = calculate_shard_metrics_from_summary(
+            metrics_summary_runtime=metrics_runtime, task_name_input=task_name_input
+        )
+    elif is_metrics_bucketed(metrics_runtime):
+        shard_metrics = calculate_shard_metrics_from_summary(
+            metrics_summary_runtime=bucketed_metrics_to_summary(metrics_runtime),
+            task_name_input=task_name_input,
+        )
+    else:
+        # print warning if na values are present
+        df_filled = fill_na_with_zero(
+            df=metrics_runtime,
+            columns=[
+                "metrics_duration_sec",
+                "meta_duration_sec",
+                "metrics_disk_used_gb",
+                "metrics_mem_used_gb",
+                "metrics_cpu_used_percent",
+            ],
+        )
 
-    summary_shards = get_unique_shards_for_task(
-        df=df_filled, task_name_input=task_name_input
-    )
+        summary_shards = get_unique_shards_for_task(
+            df=df_filled, task_name_input=task_name_input
+        )
+
+        shard_metrics = calculate_shard_metrics(
+            summary_shards=summary_shards,
+            metrics_runtime=metrics_runtime,
+            task_name_input=task_name_input,
+        )
 
     (
         average_cpu_per_shard_clean_dict,
@@ -353,12 +399,7 @@ def plot_shard_summary(
         max_memory_per_shard_clean_dict,
         max_disk_per_shard_clean_dict,
         duration_per_shard_clean_dict,
-    ) = calculate_shard_metrics(
-        summary_shards=summary_shards,
-        metrics_runtime=metrics_runtime,
-        task_name_input=task_name_input,
-        mean_of_string=mean_of_string,
-    )
+    ) = shard_metrics
 
     # Sort resource dict by value
     average_cpu_per_shard_sorted_dict = {
@@ -429,7 +470,7 @@ def plot_shard_summary(
     )
 
     # Writes to html file all the generated plots and tables for summary shard
-    fig = make_subplots(
+    fig = plotly_subplots.make_subplots(
         rows=10,
         cols=2,
         vertical_spacing=0.03,
@@ -538,6 +579,7 @@ def subplot_resource_usage(
     obtained_resource_key: Optional[str] = None,
     requested_resource_key: Optional[str] = None,
     available_resource: Optional[float] = None,
+    resource_band: Optional[tuple] = None,
 ) -> plt.Axes:
     """
     Plots the usage of a specific resource on a given subplot.
@@ -553,12 +595,27 @@ def subplot_resource_usage(
     @param resource_label: The label of the resource.
     @param obtained_resource_key: The key to get the obtained resource from the runtime dictionary.
     @param requested_resource_key: The key to get the requested resource from the runtime dictionary.
+    @param resource_band: Lower and upper arrays of resource usage to shade, used for
+    time bucketed metrics.
     """
+    # Times in UTC, as datetime64 values whatever the dtype of the column, instead
+    # of a Python object per sample
+    timestamps = df_monitoring_task_shard.metrics_timestamp.to_numpy(
+        dtype="datetime64[ns]"
+    )
     subplot.plot(
-        df_monitoring_task_shard.metrics_timestamp.astype("O"),
+        timestamps,
         resource_used_array,
         label=f"{resource_label} Used",
     )
+    if resource_band is not None:
+        subplot.fill_between(
+            timestamps,
+            resource_band[0],
+            resource_band[1],
+            alpha=0.3,
+            label=f"{resource_label} Min-Max",
+        )
     if available_resource:
         subplot.axhline(
             y=available_resource,
@@ -606,6 +663,8 @@ def plot_detailed_resource_usage(
     disk_write_iops_array: list,
     plt_height: int = 2000,
     plt_width: int = 1200,
+    mem_used_gb_array: Optional[list] = None,
+    resource_bands: Optional[dict] = None,
 ) -> plt:
     """
     Creates a plot with resource usage figure for a given
@@ -620,8 +679,16 @@ def plot_detailed_resource_usage(
     @param disk_used_gb_array:
     @param disk_read_iops_array:
     @param disk_write_iops_array:
+    @param mem_used_gb_array: Defaults to the metrics_mem_used_gb column
+    @param resource_bands: (min, max) arrays to shade per resource, keyed like
+    data_processing.RESOURCE_USAGE_COLUMNS
     @return:
     """
+    if mem_used_gb_array is None:
+        mem_used_gb_array = df_monitoring_task_shard.metrics_mem_used_gb
+    if resource_bands is None:
+        resource_bands = {}
+
     # For size and style of plots
     dpi = 100
     fig, axs = plt.subplots(5, 1, figsize=(plt_width / dpi, plt_height / dpi), dpi=dpi)
@@ -644,6 +711,7 @@ def plot_detailed_resource_usage(
         runtime_dic=runtime_dic,
         task_shard_duration=task_shard_duration,
         resource_label="CPU",
+        resource_band=resource_bands.get("cpu"),
         y_label="CPU % Used",
         obtained_resource_key=str(runtime_dic["available_cpu_cores"]),
         requested_resource_key="requested_cpu_cores",
@@ -653,10 +721,11 @@ def plot_detailed_resource_usage(
     subplot_resource_usage(
         subplot=mem_plt,
         df_monitoring_task_shard=df_monitoring_task_shard,
-        resource_used_array=df_monitoring_task_shard.metrics_mem_used_gb,
+        resource_used_array=mem_used_gb_array,
         runtime_dic=runtime_dic,
         task_shard_duration=task_shard_duration,
         resource_label="Memory",
+        resource_band=resource_bands.get("mem"),
         y_label="Memory GB Used",
         requested_resource_key="requested_mem_gb",
         available_resource=runtime_dic["available_mem_gb"],
@@ -670,6 +739,7 @@ def plot_detailed_resource_usage(
         runtime_dic=runtime_dic,
         task_shard_duration=task_shard_duration,
         resource_label="Disk",
+        resource_band=resource_bands.get("disk"),
         y_label="Disk GB Used",
         requested_resource_key="requested_disk_gb",
         available_resource=runtime_dic["available_disk_gb"],
@@ -683,6 +753,7 @@ def plot_detailed_resource_usage(
         runtime_dic=runtime_dic,
         task_shard_duration=task_shard_duration,
         resource_label="Disk Read_IOps",
+        resource_band=resource_bands.get("disk_read"),
         y_label="Disk Read_IOps",
     )
 
@@ -694,6 +765,7 @@ def plot_detailed_resource_usage(
         runtime_dic=runtime_dic,
         task_shard_duration=task_shard_duration,
         resource_label="Disk Write_IOps",
+        resource_band=resource_bands.get("disk_write"),
         y_label="Disk Write_IOps",
     )
 
@@ -718,16 +790,29 @@ def plot_shards(
     :return:
     """
     resource_plt = plt.figure()
+    dataset = get_monitoring_dataset(df_monitoring)
 
     for shard in shards:
-        df_monitoring_task_shard = df_monitoring.metrics_runtime.loc[
-            (df_monitoring.metrics_runtime["runtime_task_call_name"] == task_name)
-            & (df_monitoring.metrics_runtime["runtime_shard"] == shard)
-        ]
-        df_monitoring_metadata_runtime_task_shard = df_monitoring.metadata_runtime.loc[
-            (df_monitoring.metadata_runtime["runtime_task_call_name"] == task_name)
-            & (df_monitoring.metadata_runtime["runtime_shard"] == shard)
-        ]
+        if dataset is not None:
+            # The samples of the shard are a slice of the metrics
+            df_monitoring_task_shard = dataset.metrics_runtime(task_name, shard)
+            df_monitoring_metadata_runtime_task_shard = dataset.task_metadata_runtime(
+                task_name, shard
+            )
+        else:
+            df_monitoring_task_shard = df_monitoring.metrics_runtime.loc[
+                (df_monitoring.metrics_runtime["runtime_task_call_name"] == task_name)
+                & (df_monitoring.metrics_runtime["runtime_shard"] == shard)
+            ]
+            df_monitoring_metadata_runtime_task_shard = (
+                df_monitoring.metadata_runtime.loc[
+                    (
+                        df_monitoring.metadata_runtime["runtime_task_call_name"]
+                        == task_name
+                    )
+                    & (df_monitoring.metadata_runtime["runtime_shard"] == shard)
+                ]
+            )
         df_monitoring_task_shard = df_monitoring_task_shard.sort_values(
             by="metrics_timestamp"
         )
@@ -739,21 +824,10 @@ def plot_shards(
             datetime.timedelta.total_seconds(max_datetime - min_datetime)
         )
 
-        # create an array for to hold the y values from the list columns
-        cpu_used_percent_array = [
-            np.asarray(x).mean()
-            for x in df_monitoring_task_shard.metrics_cpu_used_percent
-        ]
-        disk_used_gb_array = [
-            np.asarray(x).max() for x in df_monitoring_task_shard.metrics_disk_used_gb
-        ]
-        disk_read_iops_array = [
-            np.asarray(x).max() for x in df_monitoring_task_shard.metrics_disk_read_iops
-        ]
-        disk_write_iops_array = [
-            np.asarray(x).max()
-            for x in df_monitoring_task_shard.metrics_disk_write_iops
-        ]
+        # create arrays to hold the y values of each resource
+        resource_usage, resource_bands = get_resource_usage_arrays(
+            df_monitoring_task_shard
+        )
 
         # Creates a dictionary of runtime attributes
         runtime_dic = create_runtime_dict(df_monitoring_metadata_runtime_task_shard)
@@ -765,13 +839,15 @@ def plot_shards(
             shard_number=shard,
             task_shard_duration=task_shard_duration,
             df_monitoring_task_shard=df_monitoring_task_shard,
-            cpu_used_percent_array=cpu_used_percent_array,
+            cpu_used_percent_array=resource_usage["cpu"],
             runtime_dic=runtime_dic,
-            disk_used_gb_array=disk_used_gb_array,
-            disk_read_iops_array=disk_read_iops_array,
-            disk_write_iops_array=disk_write_iops_array,
+            disk_used_gb_array=resource_usage["disk"],
+            disk_read_iops_array=resource_usage["disk_read"],
+            disk_write_iops_array=resource_usage["disk_write"],
             plt_height=plt_height,
             plt_width=plt_width,
+            mem_used_gb_array=resource_usage["mem"],
+            resource_bands=resource_bands,
         )
 
         resource_plt.subplots_adjust(hspace=0.5)
@@ -797,20 +873,32 @@ def plot_resource_usage(
     @param target_shard: Specific shards to plot for a sharded/scattered task
     @return: A pdf file with resource usage plots for each task name
     """
+    dataset = get_monitoring_dataset(df_monitoring)
     for task_name in task_names:
-        if (
-            task_name
-            not in df_monitoring.metadata_runtime.runtime_task_call_name.unique()
-        ):
-            raise ValueError(f"Task name {task_name} not found in dataframe")
-
-        all_shards = (
-            df_monitoring.metadata_runtime.runtime_shard.loc[
-                (df_monitoring.metadata_runtime["runtime_task_call_name"] == task_name)
-            ]
-            .sort_values()
-            .unique()
-        )
+        if dataset is not None:
+            if task_name not in dataset.task_names():
+                raise ValueError(f"Task name {task_name} not found in dataframe")
+            all_shards = dataset.shards(task_name)
+            # Only the samples of the task are merged with their runtime metadata
+            metrics_runtime = dataset.metrics_runtime(task_name)
+        else:
+            if (
+                task_name
+                not in df_monitoring.metadata_runtime.runtime_task_call_name.unique()
+            ):
+                raise ValueError(f"Task name {task_name} not found in dataframe")
+
+            all_shards = (
+                df_monitoring.metadata_runtime.runtime_shard.loc[
+                    (
+                        df_monitoring.metadata_runtime["runtime_task_call_name"]
+                        == task_name
+                    )
+                ]
+                .sort_values()
+                .unique()
+            )
+            metrics_runtime = df_monitoring.metrics_runtime
 
         if target_shard:
             if target_shard not in all_shards:
@@ -822,13 +910,18 @@ def plot_resource_usage(
 
         if len(task_shard_lookup) > 1:
             return plot_shard_summary(
-                metrics_runtime=df_monitoring.metrics_runtime,
+                metrics_runtime=metrics_runtime,
                 task_name_input=task_name,
                 parent_workflow_id=parent_workflow_id,
                 plt_height=plt_height,
                 plt_width=plt_width,
             )
         else:
+            if is_metrics_summary(metrics_runtime):
+                raise ValueError(
+                    "Plotting the resource usage of a single shard requires the "
+                    "metrics samples, query them with metrics_mode='raw'."
+                )
             return plot_shards(
                 df_monitoring=df_monitoring,
                 task_name=task_name,
@@ -858,20 +951,27 @@ def create_runtime_dict(
 
     runtime_dic = {
         "available_cpu_cores": first_shard.at["runtime_cpu_count"],
-        "available_mem_gb": first_shard.at["runtime_mem_total_gb"].round(2),
-        "available_disk_gb": first_shard.at["runtime_disk_total_gb"][0].round(2),
+        "available_mem_gb": round_first_value(first_shard.at["runtime_mem_total_gb"]),
+        "available_disk_gb": round_first_value(first_shard.at["runtime_disk_total_gb"]),
         "requested_cpu_cores": first_shard.at["meta_cpu"],
         "requested_mem_gb": first_shard.at["meta_mem_total_gb"],
         # Todo: Fix the following line so its not returning None
-        "requested_disk_gb": (
-            None
-            if np.isnan(first_shard.at["meta_disk_total_gb"])
-            else (
-                first_shard.at["meta_disk_total_gb"].round(2)
-                if isinstance(first_shard.at["meta_disk_total_gb"], float)
-                else first_shard.at["meta_disk_total_gb"][0].round(2)
-            )
-        ),
+        "requested_disk_gb": round_first_value(first_shard.at["meta_disk_total_gb"]),
     }
 
     return runtime_dic
+
+
+def round_first_value(value, ndigits: int = 2) -> Optional[float]:
+    """
+    Round a value, or the first value of a repeated field, such as the size of
+    the first disk. Repeated fields are arrays or, with Arrow dtypes, lists.
+    @param value: Number, array, list or missing value
+    @param ndigits: Number of decimals
+    @return: None if the value is missing
+    """
+    if value is not None and np.ndim(value) > 0:
+        value = value[0] if len(value) else None
+    if value is None or pd.isna(value):
+        return None
+    return round(float(value), ndigits)
@@ -0,0 +1,414 @@
+"""
+This module contains the backends the monitoring (runtime, metrics, metadata) and
+billing tables are queried from.
+
+BigQueryBackend runs the queries in BigQuery. DuckDBBackend holds local copies of
+the tables, created from the schemas of table_schema.py and filled with exported
+data, so analyses can be re-run offline and the query layer can be benchmarked
+without GCP. DuckDB is an optional dependency, only needed for the local backend.
+"""
+
+from __future__ import annotations
+
+import time
+from abc import ABC, abstractmethod
+from typing import Iterable, List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+
+from ..lazy import lazy_import
+from .dialects import BIGQUERY_DIALECT, DUCKDB_DIALECT, SqlDialect
+from .instrumentation import QueryJobStats
+from .monitoring_sql import MONITORING_DATASET
+from .utils import (
+    convert_dtype_backend,
+    get_bytes_for_query_dry_run,
+    query_job_to_dataframe,
+    query_job_to_record_batches,
+)
+
+api_exceptions = lazy_import("google.api_core.exceptions")
+bigquery = lazy_import("google.cloud.bigquery")
+# Builds the schemas of the tables with the BigQuery client library
+table_schema = lazy_import("cromonitor.query.table_schema")
+
+# Monitoring tables and the name of their schema in table_schema.py
+MONITORING_TABLE_SCHEMAS = {
+    "runtime": "RUNTIME_SCHEMA",
+    "metrics": "METRICS_SCHEMA",
+    "metadata": "METADATA_SCHEMA",
+}
+
+BIGQUERY_TO_DUCKDB_TYPES = {
+    "STRING": "VARCHAR",
+    "INTEGER": "BIGINT",
+    "INT64": "BIGINT",
+    "FLOAT": "DOUBLE",
+    "FLOAT64": "DOUBLE",
+    "NUMERIC": "DECIMAL(38, 9)",
+    "BOOLEAN": "BOOLEAN",
+    "BOOL": "BOOLEAN",
+    "TIMESTAMP": "TIMESTAMPTZ",
+    "DATETIME": "TIMESTAMP",
+    "DATE": "DATE",
+    "TIME": "TIME",
+    "BYTES": "BLOB",
+    "JSON": "JSON",
+}
+
+
+class QueryBackend(ABC):
+    """
+    Interface of the engines running the monitoring and billing queries. Queries
+    are written in the dialect of the backend and take BigQuery query parameters.
+    """
+
+    dialect: SqlDialect = BIGQUERY_DIALECT
+    # Source of the results in the job statistics
+    name: str = "backend"
+
+    @abstractmethod
+    def query(
+        self,
+        sql: str,
+        query_parameters: Optional[list] = None,
+        labels: Optional[dict] = None,
+    ):
+        """
+        Start a query
+        :param sql: Query in the dialect of the backend
+        :param query_parameters: BigQuery parameters referenced by the query
+        :param labels: Labels of the job, to find it in the backend
+        :return: Job of the query, its rows are returned by job.result()
+        """
+
+    def cancel_job(self, query_job):
+        """
+        Cancel a query job, jobs of local backends can not be cancelled
+        :param query_job: Job returned by query()
+        :return:
+        """
+
+    def get_job(self, job_id: str, location: Optional[str] = None):
+        """
+        Get a query job started earlier, such as by an interrupted session, to
+        download its results again
+        :param job_id: Id of the job
+        :param location: Location of the job
+        :return: Job of the query, None if it or its results are no longer available
+        """
+        return None
+
+    @abstractmethod
+    def to_dataframe(
+        self,
+        query_job,
+        stats: Optional[QueryJobStats] = None,
+        dtype_backend: str = "numpy",
+    ) -> pd.DataFrame:
+        """
+        Download the results of a query job
+        :param query_job: Job returned by query()
+        :param stats: Statistics of the query to fill in
+        :param dtype_backend: numpy or pyarrow, see utils.DTYPE_BACKENDS
+        :return:
+        """
+
+    def to_record_batches(
+        self,
+        query_job,
+        page_size: Optional[int] = None,
+        stats: Optional[QueryJobStats] = None,
+    ) -> Iterable[pa.RecordBatch]:
+        """
+        Download the results of a query job as Arrow record batches, so they can be
+        written out without holding them all in memory
+        :param query_job: Job returned by query()
+        :param page_size: Maximum number of rows of a batch
+        :param stats: Statistics of the query to fill in
+        :return:
+        """
+        dataframe = self.to_dataframe(query_job, stats=stats)
+        return pa.Table.from_pandas(dataframe, preserve_index=False).to_batches(
+            max_chunksize=page_size
+        )
+
+    def run_query(
+        self,
+        sql: str,
+        query_parameters: Optional[list] = None,
+        stats: Optional[QueryJobStats] = None,
+        dtype_backend: str = "numpy",
+    ) -> pd.DataFrame:
+        """
+        Run a query and download its results
+        :param sql: Query in the dialect of the backend
+        :param query_parameters: BigQuery parameters referenced by the query
+        :param stats: Statistics of the query to fill in
+        :param dtype_backend: numpy or pyarrow, see utils.DTYPE_BACKENDS
+        :return:
+        """
+        started = time.perf_counter()
+        query_job = self.query(sql, query_parameters=query_parameters)
+        if stats is not None:
+            stats.source = self.name
+            stats.submit_sec = time.perf_counter() - started
+        return self.to_dataframe(query_job, stats=stats, dtype_backend=dtype_backend)
+
+    @abstractmethod
+    def dry_run_bytes(self, sql: str, query_parameters: Optional[list] = None) -> int:
+        """
+        Get the number of bytes a query would process
+        :param sql: Query in the dialect of the backend
+        :param query_parameters: BigQuery parameters referenced by the query
+        :return:
+        """
+
+
+class BigQueryBackend(QueryBackend):
+    """
+    Runs the queries in BigQuery, downloading results through the BigQuery Storage
+    Read API when a storage client is given.
+    """
+
+    dialect = BIGQUERY_DIALECT
+    name = "bigquery"
+
+    def __init__(self, client: bigquery.Client, bqstorage_client=None):
+        self.client: bigquery.Client = client
+        self.bqstorage_client = bqstorage_client
+
+    def query(
+        self,
+        sql: str,
+        query_parameters: Optional[list] = None,
+        labels: Optional[dict] = None,
+    ) -> bigquery.QueryJob:
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=query_parameters or [], labels=labels or {}
+        )
+        return self.client.query(query=sql, job_config=job_config)
+
+    def cancel_job(self, query_job: bigquery.QueryJob):
+        # Cancelling a finished job does nothing
+        self.client.cancel_job(query_job.job_id, location=query_job.location)
+
+    def get_job(
+        self, job_id: str, location: Optional[str] = None
+    ) -> Optional[bigquery.QueryJob]:
+        try:
+            query_job = self.client.get_job(job_id, location=location)
+            if query_job.state == "DONE":
+                if query_job.error_result is not None:
+                    return None
+                # Results are kept in a temporary table for about a day
+                self.client.get_table(query_job.destination)
+        except api_exceptions.NotFound:
+            return None
+        return query_job
+
+    def to_dataframe(
+        self,
+        query_job: bigquery.QueryJob,
+        stats: Optional[QueryJobStats] = None,
+        dtype_backend: str = "numpy",
+    ) -> pd.DataFrame:
+        return query_job_to_dataframe(
+            query_job,
+            bqstorage_client=self.bqstorage_client,
+            stats=stats,
+            dtype_backend=dtype_backend,
+        )
+
+    def to_record_batches(
+        self,
+        query_job: bigquery.QueryJob,
+        page_size: Optional[int] = None,
+        stats: Optional[QueryJobStats] = None,
+    ) -> Iterable[pa.RecordBatch]:
+        return query_job_to_record_batches(
+            query_job,
+            bqstorage_client=self.bqstorage_client,
+            page_size=page_size,
+            stats=stats,
+        )
+
+    def dry_run_bytes(self, sql: str, query_parameters: Optional[list] = None) -> int:
+        return get_bytes_for_query_dry_run(
+            query=sql,
+            bq_client=self.client,
+            job_config=bigquery.QueryJobConfig(query_parameters=query_parameters or []),
+        )
+
+
+class LocalQueryJob:
+    """
+    Results of a query run by a local backend, with the parts of the BigQuery job
+    interface used by this package.
+    """
+
+    total_bytes_processed: int = 0
+    errors = None
+
+    def __init__(self, dataframe: pd.DataFrame):
+        self.dataframe: pd.DataFrame = dataframe
+
+    def result(self) -> List[dict]:
+        return self.dataframe.to_dict(orient="records")
+
+    def to_dataframe(self, create_bqstorage_client: bool = False) -> pd.DataFrame:
+        return self.dataframe
+
+
+def _import_duckdb():
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError(
+            "DuckDBBackend requires the duckdb package, install it with "
+            "'pip install duckdb'."
+        ) from e
+    return duckdb
+
+
+def schema_field_to_duckdb_type(field: bigquery.SchemaField) -> str:
+    """
+    Get the DuckDB type of a BigQuery schema field
+    :param field: BigQuery schema field
+    :return:
+    """
+    if field.field_type in ("RECORD", "STRUCT"):
+        members = ", ".join(
+            f'"{member.name}" {schema_field_to_duckdb_type(member)}'
+            for member in field.fields
+        )
+        duckdb_type = f"STRUCT({members})"
+    else:
+        duckdb_type = BIGQUERY_TO_DUCKDB_TYPES[field.field_type]
+    if field.mode == "REPEATED":
+        duckdb_type += "[]"
+    return duckdb_type
+
+
+class DuckDBBackend(QueryBackend):
+    """
+    Runs the queries on local copies of the tables in a DuckDB database. The
+    monitoring tables of a dataset are created empty, then filled with load_table().
+    A table is referred to with the id of the BigQuery table it copies, its project
+    is ignored.
+    """
+
+    dialect = DUCKDB_DIALECT
+    name = "duckdb"
+
+    def __init__(
+        self,
+        database: str = ":memory:",
+        monitoring_dataset: str = MONITORING_DATASET,
+        billing_table_id: Optional[str] = None,
+    ):
+        """
+        :param database: Path of the database file, in memory by default
+        :param monitoring_dataset: Dataset of the runtime, metrics and metadata tables
+        :param billing_table_id: Id of a billing export table to create
+        """
+        duckdb = _import_duckdb()
+        self.connection = duckdb.connect(database)
+        # Dates of timestamps are computed in UTC, as in BigQuery
+        self.connection.execute("SET TimeZone = 'UTC'")
+
+        for table_name, schema_name in MONITORING_TABLE_SCHEMAS.items():
+            self.create_table(
+                f"{monitoring_dataset}.{table_name}",
+                getattr(table_schema, schema_name),
+            )
+        if billing_table_id:
+            self.create_table(billing_table_id, table_schema.TERRA_GCP_BILLING_SCHEMA)
+
+    def create_table(self, table_id: str, schema: List[bigquery.SchemaField]):
+        """
+        Create an empty table from a BigQuery schema, if it does not exist
+        :param table_id: Id of the table, as dataset.table or project.dataset.table
+        :param schema: BigQuery schema of the table
+        :return:
+        """
+        dataset = table_id.split(".")[-2]
+        columns = ", ".join(
+            f'"{field.name}" {schema_field_to_duckdb_type(field)}' for field in schema
+        )
+        self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset}"')
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.dialect.table(table_id)} ({columns})"
+        )
+
+    def load_table(
+        self, table_id: str, data: Union[pd.DataFrame, str, Iterable[str]]
+    ) -> int:
+        """
+        Append rows to a table. Columns of the data missing from the table are
+        ignored, and columns of the table missing from the data are left NULL.
+        :param table_id: Id of the table
+        :param data: Dataframe, or path or glob of Parquet files such as exported
+        partitions of the table
+        :return: Number of rows loaded
+        """
+        cursor = self.connection.cursor()
+        if isinstance(data, pd.DataFrame):
+            cursor.register("load_table_source", data)
+            source = "load_table_source"
+        else:
+            paths = [data] if isinstance(data, str) else list(data)
+            source = f"read_parquet({paths!r}, union_by_name = true)"
+
+        table = self.dialect.table(table_id)
+        table_columns = [
+            row[0] for row in cursor.execute(f"DESCRIBE {table}").fetchall()
+        ]
+        source_columns = {
+            row[0]
+            for row in cursor.execute(f"DESCRIBE SELECT * FROM {source}").fetchall()
+        }
+        columns = ", ".join(
+            f'"{column}"' for column in table_columns if column in source_columns
+        )
+        rows_before = cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {source}"
+        )
+        return (
+            cursor.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] - rows_before
+        )
+
+    def query(
+        self,
+        sql: str,
+        query_parameters: Optional[list] = None,
+        labels: Optional[dict] = None,
+    ) -> LocalQueryJob:
+        parameters = {
+            parameter.name: (
+                list(parameter.values)
+                if isinstance(parameter, bigquery.ArrayQueryParameter)
+                else parameter.value
+            )
+            for parameter in query_parameters or []
+        }
+        # A cursor is a connection of its own, so threads can query concurrently
+        cursor = self.connection.cursor()
+        return LocalQueryJob(cursor.execute(sql, parameters).df())
+
+    def to_dataframe(
+        self,
+        query_job: LocalQueryJob,
+        stats: Optional[QueryJobStats] = None,
+        dtype_backend: str = "numpy",
+    ) -> pd.DataFrame:
+        # The query is run and its results converted when it is submitted
+        if stats is not None:
+            stats.rows = len(query_job.dataframe)
+        return convert_dtype_backend(query_job.to_dataframe(), dtype_backend)
+
+    def dry_run_bytes(self, sql: str, query_parameters: Optional[list] = None) -> int:
+        # Local tables are read from disk at no cost
+        return 0
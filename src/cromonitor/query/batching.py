@@ -0,0 +1,298 @@
+"""
+This module contains functions to plan how the VMs of a workflow are split into
+batches when querying their metrics from BigQuery.
+
+A batch may carry the time range its VMs ran in. The metrics table is partitioned
+by time, so a batch of VMs that ran close together, queried over their own range
+rather than the window of the whole workflow, only scans the partitions they wrote
+to.
+"""
+
+import heapq
+import math
+from datetime import timedelta
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+# The monitoring script records one metrics sample per second on each VM.
+DEFAULT_SAMPLE_INTERVAL_SEC = 1
+# Approximate size of a metrics row without its repeated fields
+# (timestamp, instance_id, mem_used_gb and the arrays' overhead).
+BASE_ROW_BYTES = 48
+# Size of a single FLOAT value in a repeated metrics field.
+REPEATED_VALUE_BYTES = 8
+# Number of repeated metrics fields that have one value per disk.
+DISK_FIELDS_PER_ROW = 3
+
+DEFAULT_TARGET_BATCH_BYTES = 128 * 1024 * 1024
+DEFAULT_MAX_BATCHES = 64
+DEFAULT_MAX_IDS_PER_BATCH = 5000
+
+
+class MetricsBatch:
+    """
+    A group of VM instance ids whose metrics are fetched by a single query.
+    """
+
+    def __init__(
+        self,
+        instance_ids: list,
+        estimated_rows: int = 0,
+        estimated_bytes: int = 0,
+        start_time: Optional[pd.Timestamp] = None,
+        end_time: Optional[pd.Timestamp] = None,
+    ):
+        """
+        :param instance_ids: Instance ids of the VMs of the batch
+        :param estimated_rows: Estimated number of metrics rows of the VMs
+        :param estimated_bytes: Estimated size of the metrics of the VMs
+        :param start_time: Start of the time range of the metrics of the VMs, the
+        queried window if None
+        :param end_time: End of the time range, excluded, the queried window if None
+        """
+        self.instance_ids: list = instance_ids
+        self.estimated_rows: int = estimated_rows
+        self.estimated_bytes: int = estimated_bytes
+        self.start_time: Optional[pd.Timestamp] = start_time
+        self.end_time: Optional[pd.Timestamp] = end_time
+
+    def __len__(self):
+        return len(self.instance_ids)
+
+    def __repr__(self):
+        time_range = ""
+        if self.start_time is not None or self.end_time is not None:
+            time_range = f", start_time={self.start_time}, end_time={self.end_time}"
+        return (
+            f"MetricsBatch(instances={len(self.instance_ids)}, "
+            f"estimated_rows={self.estimated_rows}, "
+            f"estimated_bytes={self.estimated_bytes}{time_range})"
+        )
+
+
+def estimate_instance_metrics_size(
+    runtime: pd.DataFrame, sample_interval_sec: float = DEFAULT_SAMPLE_INTERVAL_SEC
+) -> pd.DataFrame:
+    """
+    Estimate the number of metrics rows and bytes recorded by each VM of the runtime
+    table. The number of rows is derived from metrics_duration_sec and the size of a
+    row from the number of cpus and disks of the VM.
+    :param runtime: Runtime table as returned by QueryBQToMonitor
+    :param sample_interval_sec: Seconds between two metrics samples of a VM
+    :return: Dataframe with one row per instance id and its estimated rows and bytes
+    """
+    instances = runtime.drop_duplicates(subset="runtime_instance_id")
+
+    # VMs without a duration did not send any metrics in the queried window.
+    duration_sec = pd.to_numeric(
+        instances["metrics_duration_sec"], errors="coerce"
+    ).fillna(0)
+    estimated_rows = np.floor(duration_sec.to_numpy(dtype=float) / sample_interval_sec)
+    estimated_rows = np.where(
+        duration_sec.to_numpy(dtype=float) > 0, estimated_rows + 1, 0
+    )
+
+    if "runtime_cpu_count" in instances:
+        cpu_count = (
+            pd.to_numeric(instances["runtime_cpu_count"], errors="coerce")
+            .fillna(1)
+            .to_numpy(dtype=float)
+        )
+    else:
+        cpu_count = np.ones(len(instances))
+
+    if "runtime_disk_mounts" in instances:
+        disk_count = (
+            instances["runtime_disk_mounts"]
+            .apply(lambda x: len(x) if hasattr(x, "__len__") else 1)
+            .to_numpy(dtype=float)
+        )
+    else:
+        disk_count = np.ones(len(instances))
+
+    row_bytes = BASE_ROW_BYTES + REPEATED_VALUE_BYTES * (
+        cpu_count + DISK_FIELDS_PER_ROW * disk_count
+    )
+
+    return pd.DataFrame(
+        {
+            "instance_id": instances["runtime_instance_id"].to_list(),
+            "estimated_rows": estimated_rows.astype("int64"),
+            "estimated_bytes": (estimated_rows * row_bytes).astype("int64"),
+        }
+    )
+
+
+def _utc_times(column: pd.Series) -> pd.DatetimeIndex:
+    """
+    Convert a timestamp column of any dtype backend to UTC times, NaT if missing
+    """
+    return pd.to_datetime(column.to_numpy(dtype="datetime64[ns]"), utc=True)
+
+
+def estimate_instance_time_ranges(
+    runtime: pd.DataFrame, padding: timedelta, now: Optional[pd.Timestamp] = None
+) -> pd.DataFrame:
+    """
+    Estimate the time range of the metrics of each VM of the runtime table, from
+    its first and last samples (metrics_start_time and metrics_end_time), padded on
+    both sides. VMs without samples start at their runtime_start_time, when the
+    table has it. The end is unknown (NaT) for VMs without samples and for VMs
+    whose last sample is less than padding before now, as they may still be
+    recording.
+    :param runtime: Runtime table as returned by QueryBQToMonitor
+    :param padding: Margin added before the start and after the end
+    :param now: Time the metrics are queried at, the current time if None
+    :return: Dataframe with one row per instance id and its start and end time
+    """
+    if now is None:
+        now = pd.Timestamp.now(tz="UTC")
+    instances = runtime.drop_duplicates(subset="runtime_instance_id")
+    start_time = _utc_times(instances["metrics_start_time"])
+    if "runtime_start_time" in instances:
+        start_time = start_time.where(
+            start_time.notna(), _utc_times(instances["runtime_start_time"])
+        )
+    end_time = _utc_times(instances["metrics_end_time"]) + padding
+    end_time = end_time.where(end_time < now)
+    return pd.DataFrame(
+        {
+            "instance_id": instances["runtime_instance_id"].to_list(),
+            "start_time": start_time - padding,
+            "end_time": end_time,
+        }
+    )
+
+
+def _split_by_start_time(
+    sizes: pd.DataFrame, num_batches: int, max_ids_per_batch: int
+) -> List[MetricsBatch]:
+    """
+    Split VMs sorted by start time into consecutive batches of about the same
+    estimated size, so every batch covers a short time range
+    :param sizes: Estimated size and time range of each VM, sorted by start time
+    :param num_batches: Number of batches to split the VMs into
+    :param max_ids_per_batch: Maximum number of instance ids in a batch
+    :return:
+    """
+    target_bytes = sizes.estimated_bytes.sum() / num_batches
+    batches = [MetricsBatch(instance_ids=[])]
+    # Size of the VMs before the current one, a VM goes to the batch holding the
+    # middle of its size
+    preceding_bytes = 0
+    for instance_id, rows, size in zip(
+        sizes.instance_id, sizes.estimated_rows, sizes.estimated_bytes
+    ):
+        batch = batches[-1]
+        middle = preceding_bytes + size / 2
+        if batch.instance_ids and (
+            len(batch) >= max_ids_per_batch or middle > target_bytes * len(batches)
+        ):
+            batch = MetricsBatch(instance_ids=[])
+            batches.append(batch)
+        batch.instance_ids.append(instance_id)
+        batch.estimated_rows += int(rows)
+        batch.estimated_bytes += int(size)
+        preceding_bytes += int(size)
+
+    time_ranges = sizes.set_index("instance_id")
+    for batch in batches:
+        ranges = time_ranges.loc[batch.instance_ids]
+        # A bound of a batch with a VM of unknown start or end is that of the
+        # queried window
+        if ranges.start_time.notna().all():
+            batch.start_time = ranges.start_time.min()
+        if ranges.end_time.notna().all():
+            batch.end_time = ranges.end_time.max()
+    return batches
+
+
+def plan_metrics_batches(
+    runtime: pd.DataFrame,
+    num_threads: int = 8,
+    target_batch_bytes: int = DEFAULT_TARGET_BATCH_BYTES,
+    max_batches: int = DEFAULT_MAX_BATCHES,
+    max_ids_per_batch: int = DEFAULT_MAX_IDS_PER_BATCH,
+    sample_interval_sec: float = DEFAULT_SAMPLE_INTERVAL_SEC,
+    time_padding: Optional[timedelta] = None,
+    now: Optional[pd.Timestamp] = None,
+) -> List[MetricsBatch]:
+    """
+    Split the VMs of the runtime table into batches of roughly equal estimated size.
+
+    The number of batches is chosen so each batch holds about target_batch_bytes of
+    metrics, using at least one batch per thread when there is enough data to keep
+    the threads busy and never more than max_batches (every batch scans the metrics
+    partitions of the queried window, so more batches means more bytes billed).
+    Instances are then assigned, largest first, to the currently lightest batch.
+
+    With time_padding set and the times of the first and last samples of the VMs in
+    the runtime table, the VMs are instead sorted by start time and split into
+    consecutive batches of about the same estimated size, and every batch gets the
+    time range of its VMs (see estimate_instance_time_ranges), so it can be queried
+    over that range only.
+
+    The batches are returned largest first so that, when they are submitted to a
+    thread pool, the slowest queries start first and the smaller ones fill in the
+    threads as they free up.
+
+    :param runtime: Runtime table as returned by QueryBQToMonitor
+    :param num_threads: Number of threads that will fetch the batches
+    :param target_batch_bytes: Estimated number of bytes to fetch in a batch
+    :param max_batches: Maximum number of batches to create
+    :param max_ids_per_batch: Maximum number of instance ids in a batch
+    :param sample_interval_sec: Seconds between two metrics samples of a VM
+    :param time_padding: Margin around the time range of the metrics of a VM, the
+    batches are not grouped by start time if None
+    :param now: Time the metrics are queried at, the current time if None
+    :return: List of MetricsBatch
+    """
+    sizes = estimate_instance_metrics_size(
+        runtime=runtime, sample_interval_sec=sample_interval_sec
+    )
+    if sizes.empty:
+        return []
+
+    total_bytes = int(sizes.estimated_bytes.sum())
+    num_batches = math.ceil(total_bytes / target_batch_bytes)
+    if num_batches > 1:
+        num_batches = max(num_batches, num_threads)
+    num_batches = max(num_batches, math.ceil(len(sizes) / max_ids_per_batch))
+    num_batches = max(1, min(num_batches, max_batches, len(sizes)))
+
+    if time_padding is not None and "metrics_start_time" in runtime:
+        sizes = sizes.merge(
+            estimate_instance_time_ranges(
+                runtime=runtime, padding=time_padding, now=now
+            ),
+            on="instance_id",
+        ).sort_values(by="start_time", kind="stable", na_position="last")
+        batches = _split_by_start_time(
+            sizes, num_batches=num_batches, max_ids_per_batch=max_ids_per_batch
+        )
+        return sorted(batches, key=lambda batch: batch.estimated_bytes, reverse=True)
+
+    sizes = sizes.sort_values(by="estimated_bytes", ascending=False, kind="stable")
+
+    batches = [MetricsBatch(instance_ids=[]) for _ in range(num_batches)]
+    # Heap of (estimated bytes, number of ids, batch index) to find the lightest batch
+    lightest = [(0, 0, i) for i in range(num_batches)]
+    for instance_id, rows, size in zip(
+        sizes.instance_id, sizes.estimated_rows, sizes.estimated_bytes
+    ):
+        if not lightest:
+            # Every batch reached max_ids_per_batch, open new ones.
+            lightest = [(0, 0, len(batches))]
+            batches.append(MetricsBatch(instance_ids=[]))
+        batch_bytes, batch_len, index = heapq.heappop(lightest)
+        batch = batches[index]
+        batch.instance_ids.append(instance_id)
+        batch.estimated_rows += int(rows)
+        batch.estimated_bytes += int(size)
+        if batch_len + 1 < max_ids_per_batch:
+            heapq.heappush(lightest, (batch_bytes + int(size), batch_len + 1, index))
+
+    batches = [batch for batch in batches if batch.instance_ids]
+    return sorted(batches, key=lambda batch: batch.estimated_bytes, reverse=True)
@@ -0,0 +1,185 @@
+"""
+This module contains the query budget of a monitoring session. Every query a
+QueryBQToMonitor will run is dry run first, and the bytes they would process are
+compared to a budget. When the plan does not fit, cheaper metrics strategies are
+tried in turn: every metrics batch scans the partitions of the queried window
+again, so fetching all the VMs in a single query is cheaper, then bucketed and
+summary metrics read fewer columns. If no strategy fits, QueryBudgetExceededError
+is raised before any byte is billed.
+"""
+
+from typing import Iterable, List, Optional
+
+import pandas as pd
+
+from .utils import bytes_to_query_cost
+
+
+class QueryBudgetExceededError(RuntimeError):
+    """
+    Raised when the queries of a session would process more bytes than its budget
+    """
+
+    def __init__(self, plan: "QueryPlan"):
+        self.plan: QueryPlan = plan
+        super().__init__(
+            f"The queries would process {plan.total_bytes} bytes, over the budget of "
+            f"{plan.budget_bytes} bytes.\n{plan}"
+        )
+
+
+class MetricsStrategy:
+    """
+    How the metrics of the VMs are fetched: the metrics mode, and whether every VM
+    is fetched by a single query instead of batches. Summaries are always fetched
+    with as few queries as possible.
+    """
+
+    def __init__(self, metrics_mode: str, single_query: bool = False):
+        self.metrics_mode: str = metrics_mode
+        self.single_query: bool = single_query or metrics_mode == "summary"
+
+    @property
+    def name(self) -> str:
+        if self.single_query and self.metrics_mode != "summary":
+            return f"{self.metrics_mode}, single query"
+        return self.metrics_mode
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, MetricsStrategy)
+            and self.metrics_mode == other.metrics_mode
+            and self.single_query == other.single_query
+        )
+
+    def __repr__(self):
+        return f"MetricsStrategy({self.name})"
+
+
+def metrics_strategies(metrics_mode: str) -> List[MetricsStrategy]:
+    """
+    Get the metrics strategies to try, from the requested one to the cheapest
+    :param metrics_mode: Metrics mode requested
+    :return:
+    """
+    modes = ["raw", "bucketed", "summary"]
+    strategies = []
+    for mode in modes[modes.index(metrics_mode) :]:
+        if mode != "summary":
+            strategies.append(MetricsStrategy(mode))
+        strategies.append(MetricsStrategy(mode, single_query=True))
+    return strategies
+
+
+class PlannedQuery:
+    """
+    A query of the plan, run count times, each run processing at most
+    bytes_per_query bytes
+    """
+
+    def __init__(
+        self,
+        name: str,
+        bytes_per_query: int,
+        count: int = 1,
+        total_bytes: Optional[int] = None,
+    ):
+        """
+        :param name: Name of the query
+        :param bytes_per_query: Bytes processed by a run, the largest run if they
+        differ
+        :param count: Number of runs
+        :param total_bytes: Bytes processed by every run, when the runs differ such
+        as metrics batches over their own time ranges, bytes_per_query times count
+        if None
+        """
+        self.name: str = name
+        self.bytes_per_query: int = int(bytes_per_query)
+        self.count: int = int(count)
+        self._total_bytes: Optional[int] = (
+            None if total_bytes is None else int(total_bytes)
+        )
+
+    @property
+    def total_bytes(self) -> int:
+        if self._total_bytes is not None:
+            return self._total_bytes
+        return self.bytes_per_query * self.count
+
+
+class QueryPlan:
+    """
+    The queries of a session with a metrics strategy, and their estimated cost
+    """
+
+    def __init__(
+        self,
+        strategy: MetricsStrategy,
+        queries: Iterable[PlannedQuery],
+        budget_bytes: Optional[int] = None,
+    ):
+        """
+        :param strategy: Strategy used to fetch the metrics
+        :param queries: Queries of the session
+        :param budget_bytes: Maximum number of bytes the queries may process, None
+        for no limit
+        """
+        self.strategy: MetricsStrategy = strategy
+        self.queries: List[PlannedQuery] = list(queries)
+        self.budget_bytes: Optional[int] = budget_bytes
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(query.total_bytes for query in self.queries)
+
+    @property
+    def estimated_cost(self) -> float:
+        return bytes_to_query_cost(self.total_bytes)
+
+    def fits_budget(self) -> bool:
+        """
+        Check whether the queries process at most budget_bytes bytes
+        :return:
+        """
+        return self.budget_bytes is None or self.total_bytes <= self.budget_bytes
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Get the queries of the plan, their number of runs, bytes and cost
+        :return:
+        """
+        return pd.DataFrame(
+            {
+                "query": [query.name for query in self.queries],
+                "count": [query.count for query in self.queries],
+                "bytes_per_query": [query.bytes_per_query for query in self.queries],
+                "total_bytes": [query.total_bytes for query in self.queries],
+                "estimated_cost": [
+                    bytes_to_query_cost(query.total_bytes) for query in self.queries
+                ],
+            }
+        )
+
+    def __str__(self):
+        budget = "none" if self.budget_bytes is None else f"{self.budget_bytes} bytes"
+        return (
+            f"Query plan with {self.strategy.name} metrics, "
+            f"{self.total_bytes} bytes (${self.estimated_cost:.4f}), budget: {budget}\n"
+            f"{self.to_dataframe().to_string(index=False)}"
+        )
+
+
+def choose_plan(plans: Iterable[QueryPlan]) -> QueryPlan:
+    """
+    Get the first plan that fits its budget
+    :param plans: Plans, from the preferred one to the cheapest
+    :return:
+    :raises QueryBudgetExceededError: When no plan fits, with the cheapest plan
+    """
+    cheapest = None
+    for plan in plans:
+        if plan.fits_budget():
+            return plan
+        if cheapest is None or plan.total_bytes < cheapest.total_bytes:
+            cheapest = plan
+    raise QueryBudgetExceededError(cheapest)
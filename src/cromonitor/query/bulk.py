@@ -0,0 +1,252 @@
+"""
+This module contains the submission level monitoring query. The tables of many
+workflows, such as every workflow of a Terra submission, are fetched with a single
+QueryBQToMonitor, which scans each monitoring table once over the union of their
+time windows, instead of once per workflow.
+
+The results are sorted by workflow, so the rows of a workflow are a contiguous
+slice of each table, and MonitoringCollection hands out per workflow slices only
+when a workflow is accessed, without copying the tables.
+"""
+
+from collections.abc import Mapping
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from ..fiss.utils import Workflow, get_submission_workflow_ids
+from .queryBQ import QueryBQToMonitor
+
+
+class WorkflowMonitoring:
+    """
+    Monitoring tables of a single workflow of a MonitoringCollection, with the same
+    attributes as QueryBQToMonitor so it can be plotted the same way.
+    """
+
+    def __init__(
+        self,
+        workflow_id: str,
+        workflow_ids: List[str],
+        runtime: pd.DataFrame,
+        metadata: pd.DataFrame,
+        metrics: pd.DataFrame,
+        metadata_runtime: pd.DataFrame,
+        metrics_mode: str = "raw",
+    ):
+        """
+        :param workflow_id: Id of the (parent) workflow
+        :param workflow_ids: Ids of the workflow and of its subworkflows
+        :param runtime: Runtime rows of the workflow
+        :param metadata: Metadata rows of the workflow
+        :param metrics: Metrics rows of the VMs of the workflow
+        :param metadata_runtime: Metadata and runtime rows of the workflow
+        :param metrics_mode: Metrics mode the tables were queried with
+        """
+        self.workflow_id: str = workflow_id
+        self.workflow_ids: List[str] = workflow_ids
+        self.runtime: pd.DataFrame = runtime
+        self.metadata: pd.DataFrame = metadata
+        self.metrics: pd.DataFrame = metrics
+        self.metadata_runtime: pd.DataFrame = metadata_runtime
+        self.metrics_mode: str = metrics_mode
+
+    def __repr__(self):
+        return (
+            f"WorkflowMonitoring(workflow_id={self.workflow_id}, "
+            f"instances={len(self.runtime)}, metrics_rows={len(self.metrics)})"
+        )
+
+
+def _sort_by_workflow(table: pd.DataFrame, keys: pd.Series) -> (pd.DataFrame, dict):
+    """
+    Sort the rows of a table by workflow and get the slice of each workflow
+    :param table: Table to sort
+    :param keys: Workflow of each row, aligned with the table
+    :return: Sorted table and the (start, stop) positions of each workflow
+    """
+    keys = np.asarray(keys, dtype=object)
+    # Rows of other workflows, such as VMs of unrelated subworkflows, are dropped
+    positions = np.flatnonzero(pd.notna(keys))
+    order = positions[np.argsort(keys[positions].astype(str), kind="stable")]
+    sorted_keys = keys[order].astype(str)
+    workflows, starts = np.unique(sorted_keys, return_index=True)
+    stops = np.append(starts[1:], len(sorted_keys))
+    slices = {
+        workflow: (int(start), int(stop))
+        for workflow, start, stop in zip(workflows, starts, stops)
+    }
+    return table.iloc[order].reset_index(drop=True), slices
+
+
+class MonitoringCollection(Mapping):
+    """
+    Monitoring tables of many workflows, fetched together, indexed by workflow id.
+    The shared tables are sorted by workflow once, then collection[workflow_id]
+    returns a WorkflowMonitoring whose tables are slices of them, created on access.
+    """
+
+    def __init__(
+        self,
+        monitor: QueryBQToMonitor,
+        workflow_groups: Dict[str, List[str]],
+    ):
+        """
+        :param monitor: Monitor that queried the tables of every workflow
+        :param workflow_groups: Ids of each workflow and of its subworkflows, by
+        workflow id
+        """
+        self.monitor: QueryBQToMonitor = monitor
+        self.workflow_groups: Dict[str, List[str]] = workflow_groups
+        group_of = {
+            workflow_id: group
+            for group, workflow_ids in workflow_groups.items()
+            for workflow_id in workflow_ids
+        }
+
+        self.runtime, self._runtime_slices = _sort_by_workflow(
+            monitor.runtime, monitor.runtime.runtime_workflow_id.map(group_of)
+        )
+        self.metadata, self._metadata_slices = _sort_by_workflow(
+            monitor.metadata, monitor.metadata.meta_workflow_id.map(group_of)
+        )
+        self.metadata_runtime, self._metadata_runtime_slices = _sort_by_workflow(
+            monitor.metadata_runtime,
+            monitor.metadata_runtime.runtime_workflow_id.map(group_of),
+        )
+        group_of_instance = pd.Series(
+            monitor.runtime.runtime_workflow_id.map(group_of).values,
+            index=monitor.runtime.runtime_instance_id.values,
+        )
+        group_of_instance = group_of_instance[
+            ~group_of_instance.index.duplicated(keep="first")
+        ]
+        metrics_keys = (
+            monitor.metrics.metrics_instance_id.map(group_of_instance)
+            if "metrics_instance_id" in monitor.metrics.columns
+            else pd.Series(np.nan, index=monitor.metrics.index)
+        )
+        self.metrics, self._metrics_slices = _sort_by_workflow(
+            monitor.metrics, metrics_keys
+        )
+
+    @staticmethod
+    def _slice(table: pd.DataFrame, slices: dict, workflow_id: str) -> pd.DataFrame:
+        start, stop = slices.get(workflow_id, (0, 0))
+        return table.iloc[start:stop]
+
+    def __getitem__(self, workflow_id: str) -> WorkflowMonitoring:
+        if workflow_id not in self.workflow_groups:
+            raise KeyError(workflow_id)
+        return WorkflowMonitoring(
+            workflow_id=workflow_id,
+            workflow_ids=self.workflow_groups[workflow_id],
+            runtime=self._slice(self.runtime, self._runtime_slices, workflow_id),
+            metadata=self._slice(self.metadata, self._metadata_slices, workflow_id),
+            metrics=self._slice(self.metrics, self._metrics_slices, workflow_id),
+            metadata_runtime=self._slice(
+                self.metadata_runtime, self._metadata_runtime_slices, workflow_id
+            ),
+            metrics_mode=self.monitor.metrics_mode,
+        )
+
+    def __iter__(self):
+        return iter(self.workflow_groups)
+
+    def __len__(self):
+        return len(self.workflow_groups)
+
+    def instance_counts(self) -> pd.Series:
+        """
+        Get the number of VMs of each workflow
+        :return:
+        """
+        return pd.Series(
+            {
+                workflow_id: stop - start
+                for workflow_id, (start, stop) in self._runtime_slices.items()
+            },
+            dtype="int64",
+        ).reindex(list(self.workflow_groups), fill_value=0)
+
+
+def query_workflows(
+    workflows: Union[Iterable[str], Dict[str, Iterable[str]]],
+    bq_goolge_project: str,
+    **kwargs,
+) -> MonitoringCollection:
+    """
+    Query the monitoring tables of many workflows at once
+    :param workflows: Workflow ids, or the ids of the subworkflows of each workflow
+    by workflow id, the workflow id itself being added to its subworkflows
+    :param bq_goolge_project: Google project of the monitoring dataset
+    :param kwargs: Arguments of QueryBQToMonitor, such as the time window covering
+    every workflow (start_time and end_time, or days_back_upper_bound and
+    days_back_lower_bound)
+    :return: Monitoring tables indexed by workflow id
+    """
+    if not isinstance(workflows, Mapping):
+        workflows = {workflow_id: [] for workflow_id in workflows}
+    workflow_groups = {
+        workflow_id: list(dict.fromkeys([workflow_id, *subworkflow_ids]))
+        for workflow_id, subworkflow_ids in workflows.items()
+    }
+    all_workflow_ids = list(
+        dict.fromkeys(
+            workflow_id
+            for workflow_ids in workflow_groups.values()
+            for workflow_id in workflow_ids
+        )
+    )
+
+    monitor = QueryBQToMonitor(
+        workflow_ids=all_workflow_ids, bq_goolge_project=bq_goolge_project, **kwargs
+    )
+    monitor.query()
+    return MonitoringCollection(monitor=monitor, workflow_groups=workflow_groups)
+
+
+def query_submission(
+    workspace_namespace: str,
+    workspace_name: str,
+    submission_id: str,
+    bq_goolge_project: str,
+    expand_subworkflows: bool = False,
+    **kwargs,
+) -> Optional[MonitoringCollection]:
+    """
+    Query the monitoring tables of every workflow of a Terra submission at once
+    :param workspace_namespace: Namespace of the workspace
+    :param workspace_name: Name of the workspace
+    :param submission_id: Id of the submission
+    :param bq_goolge_project: Google project of the monitoring dataset
+    :param expand_subworkflows: Whether to also fetch the metadata of each workflow
+    to query its subworkflows, one FireCloud call per workflow
+    :param kwargs: Arguments of QueryBQToMonitor, see query_workflows()
+    :return: Monitoring tables indexed by workflow id, None if the workflows of the
+    submission can not be listed
+    """
+    submission_workflows = get_submission_workflow_ids(
+        workspace_namespace=workspace_namespace,
+        workspace_name=workspace_name,
+        submission_id=submission_id,
+    )
+    if submission_workflows.empty:
+        return None
+
+    workflows = {
+        workflow_id: []
+        for workflow_id in submission_workflows.workflowId.dropna().tolist()
+    }
+    if expand_subworkflows:
+        for workflow_id in workflows:
+            workflows[workflow_id] = Workflow(
+                workspace_namespace=workspace_namespace,
+                workspace_name=workspace_name,
+                submission_id=submission_id,
+                parent_workflow_id=workflow_id,
+            ).get_subworkflow_ids()
+    return query_workflows(
+        workflows=workflows, bq_goolge_project=bq_goolge_project, **kwargs
+    )
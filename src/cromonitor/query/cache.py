@@ -0,0 +1,246 @@
+"""
+This module contains a persistent local cache of query results.
+
+Results are stored as Parquet files named after a fingerprint of the query (project,
+workflow ids, time window and SQL), next to a small JSON file recording when the
+entry was created and last used. The cache is bounded in size: the least recently
+used entries are evicted first. Entries of workflows that were still running when
+they were queried expire after running_ttl_sec, while entries of finished workflows
+are kept until evicted.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterable, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from .utils import arrow_table_to_dataframe
+
+DEFAULT_CACHE_MAX_BYTES = 2 * 1024**3
+DEFAULT_RUNNING_TTL_SEC = 10 * 60
+
+# Execution statuses of a call after which its monitoring data no longer changes
+TERMINAL_EXECUTION_STATUSES = {
+    "Aborted",
+    "Bypassed",
+    "Done",
+    "Failed",
+    "RetryableFailure",
+    "Unstartable",
+}
+
+
+def query_fingerprint(
+    project: str,
+    workflow_ids: Iterable[str],
+    start_time,
+    end_time,
+    sql: str,
+    query_parameters: Optional[list] = None,
+) -> str:
+    """
+    Create the cache key of a query. Array parameter values are sorted, as the
+    monitoring queries only use them as sets.
+    :param project: Google project the query runs against
+    :param workflow_ids: Workflow ids of the report
+    :param start_time: Start of the queried time window
+    :param end_time: End of the queried time window
+    :param sql: Text of the query
+    :param query_parameters: BigQuery parameters of the query
+    :return: Hexadecimal digest identifying the query results
+    """
+    parameters = []
+    for parameter in query_parameters or []:
+        api_repr = parameter.to_api_repr()
+        array_values = api_repr["parameterValue"].get("arrayValues")
+        if array_values is not None:
+            array_values.sort(key=lambda value: str(value["value"]))
+        parameters.append(api_repr)
+
+    fingerprint = {
+        "project": project,
+        "workflow_ids": sorted(str(workflow_id) for workflow_id in workflow_ids),
+        "start_time": str(start_time),
+        "end_time": str(end_time),
+        "sql": hashlib.sha256(sql.encode("utf-8")).hexdigest(),
+        "parameters": parameters,
+    }
+    return hashlib.sha256(
+        json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def workflows_finished(metadata: pd.DataFrame) -> bool:
+    """
+    Check whether every call of the metadata table reached a terminal status
+    :param metadata: Metadata table of the workflows
+    :return:
+    """
+    if metadata is None or metadata.empty:
+        return False
+    return bool(
+        metadata.meta_execution_status.isin(TERMINAL_EXECUTION_STATUSES).all()
+        and metadata.meta_end_time.notna().all()
+    )
+
+
+class QueryResultCache:
+    """
+    Size bounded cache of query results stored as Parquet files in cache_dir.
+    It is safe to use from the threads fetching the metrics batches.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+        running_ttl_sec: float = DEFAULT_RUNNING_TTL_SEC,
+    ):
+        self.cache_dir: str = cache_dir
+        self.max_size_bytes: int = max_size_bytes
+        self.running_ttl_sec: float = running_ttl_sec
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key: str, dtype_backend: str = "numpy") -> Optional[pd.DataFrame]:
+        """
+        Get the results stored for a key
+        :param key: Fingerprint of the query
+        :param dtype_backend: numpy or pyarrow, see utils.DTYPE_BACKENDS
+        :return: Dataframe of the results, None if missing or expired
+        """
+        with self._lock:
+            info = self._read_info(key)
+            if info is None:
+                return None
+
+            age_sec = time.time() - info["created"]
+            if not info["finished"] and age_sec > self.running_ttl_sec:
+                logging.debug(f"Cache entry {key} of a running workflow expired.")
+                self._remove(key)
+                return None
+
+            try:
+                if dtype_backend == "numpy":
+                    df = pd.read_parquet(self._data_path(key))
+                else:
+                    df = arrow_table_to_dataframe(
+                        pq.read_table(self._data_path(key)),
+                        dtype_backend=dtype_backend,
+                    )
+            except (OSError, ValueError) as e:
+                logging.warning(f"Dropping unreadable cache entry {key}: {e}")
+                self._remove(key)
+                return None
+
+            info["last_used"] = time.time()
+            self._write_info(key, info)
+            return df
+
+    def put(self, key: str, df: pd.DataFrame, finished: bool = False):
+        """
+        Store the results of a query, then evict entries over the size limit
+        :param key: Fingerprint of the query
+        :param df: Dataframe of the results
+        :param finished: Whether the queried workflows are finished
+        :return:
+        """
+        data_path = self._data_path(key)
+        tmp_path = f"{data_path}.{threading.get_ident()}.tmp"
+        df.to_parquet(tmp_path)
+
+        with self._lock:
+            os.replace(tmp_path, data_path)
+            now = time.time()
+            self._write_info(
+                key,
+                {
+                    "created": now,
+                    "last_used": now,
+                    "finished": finished,
+                    "size": os.path.getsize(data_path),
+                },
+            )
+            self._evict(keep=key)
+
+    def mark_finished(self, keys: Iterable[str]):
+        """
+        Mark entries as results of finished workflows, so they no longer expire
+        :param keys: Fingerprints of the queries
+        :return:
+        """
+        with self._lock:
+            for key in keys:
+                info = self._read_info(key)
+                if info is not None and not info["finished"]:
+                    info["finished"] = True
+                    self._write_info(key, info)
+
+    def invalidate(self, key: str):
+        """
+        Remove the entry of a key
+        :param key: Fingerprint of the query
+        :return:
+        """
+        with self._lock:
+            self._remove(key)
+
+    def size_bytes(self) -> int:
+        """
+        Get the size of the stored results
+        :return:
+        """
+        with self._lock:
+            return sum(info["size"] for _, info in self._entries())
+
+    def _evict(self, keep: Optional[str] = None):
+        entries = sorted(self._entries(), key=lambda entry: entry[1]["last_used"])
+        total_size = sum(info["size"] for _, info in entries)
+        for key, info in entries:
+            if total_size <= self.max_size_bytes:
+                break
+            if key == keep:
+                continue
+            logging.debug(f"Evicting cache entry {key}.")
+            self._remove(key)
+            total_size -= info["size"]
+
+    def _entries(self):
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".json"):
+                key = filename[: -len(".json")]
+                info = self._read_info(key)
+                if info is not None:
+                    yield key, info
+
+    def _data_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def _info_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_info(self, key: str) -> Optional[dict]:
+        if not os.path.exists(self._data_path(key)):
+            return None
+        try:
+            with open(self._info_path(key)) as info_file:
+                return json.load(info_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_info(self, key: str, info: dict):
+        tmp_path = f"{self._info_path(key)}.tmp"
+        with open(tmp_path, "w") as info_file:
+            json.dump(info, info_file)
+        os.replace(tmp_path, self._info_path(key))
+
+    def _remove(self, key: str):
+        for path in [self._data_path(key), self._info_path(key)]:
+            if os.path.exists(path):
+                os.remove(path)
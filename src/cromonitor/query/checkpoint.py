@@ -0,0 +1,259 @@
+"""
+This module contains the checkpoint of the metrics download of a QueryBQToMonitor.
+
+Fetching the metrics of a large workflow runs many batch queries over several
+minutes. With a checkpoint, the metrics of each batch are written to checkpoint_dir
+as soon as they are downloaded, and a manifest records the instance ids of every
+batch, the id of its query job and whether it finished. When the download is
+interrupted, by an error or a restart of the kernel, querying the same workflows
+again loads the finished batches from disk, downloads the results of the jobs that
+were still running when they are still available, and only queries the metrics of
+the remaining VMs.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Iterable, List, Optional
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from .utils import arrow_table_to_dataframe
+
+MANIFEST_FILE = "manifest.json"
+
+# started: the query of the batch was submitted, its metrics are not on disk yet
+# finished: the metrics of the batch are on disk
+BATCH_STATUSES = ["started", "finished"]
+
+
+def batch_key(instance_ids: Iterable[int]) -> str:
+    """
+    Create the key of a batch from its instance ids, in any order
+    :param instance_ids: Instance ids of the VMs of the batch
+    :return: Hexadecimal digest identifying the batch
+    """
+    ids = ",".join(str(instance_id) for instance_id in sorted(map(int, instance_ids)))
+    return hashlib.sha256(ids.encode("utf-8")).hexdigest()
+
+
+class CheckpointBatch:
+    """
+    A batch of VMs whose metrics are recorded in a MetricsCheckpoint
+    """
+
+    def __init__(self, checkpoint: "MetricsCheckpoint", instance_ids: list):
+        self.checkpoint: MetricsCheckpoint = checkpoint
+        self.instance_ids: list = [int(instance_id) for instance_id in instance_ids]
+        self.key: str = batch_key(self.instance_ids)
+
+    @property
+    def job(self) -> Optional[dict]:
+        """
+        Id and location of the query job of the batch, if one was started
+        """
+        return self.checkpoint.batch_job(self.key)
+
+    def start(self, query_job):
+        """
+        Record the query job started for the batch
+        :param query_job: Query job, jobs without an id (local backends) are not
+        recorded
+        :return:
+        """
+        job_id = getattr(query_job, "job_id", None)
+        if job_id is not None:
+            self.checkpoint.start_batch(
+                self, job_id=job_id, location=getattr(query_job, "location", None)
+            )
+
+    def finish(self, metrics: pd.DataFrame):
+        """
+        Write the metrics of the batch to disk and record the batch as finished
+        :param metrics: Metrics of the VMs of the batch
+        :return:
+        """
+        self.checkpoint.finish_batch(self, metrics)
+
+
+class MetricsCheckpoint:
+    """
+    Metrics batches of a query written to checkpoint_dir, with a manifest of the
+    batches. A checkpoint left by a different query (see session_key) is discarded.
+    It is safe to record batches from the threads fetching them.
+    """
+
+    def __init__(self, checkpoint_dir: str, session_key: str):
+        """
+        :param checkpoint_dir: Directory of the manifest and batch files, created if
+        missing
+        :param session_key: Fingerprint of the metrics query (project, workflows,
+        time window, query text) the batches are results of
+        """
+        self.checkpoint_dir: str = checkpoint_dir
+        self.session_key: str = session_key
+        self._lock = threading.Lock()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        manifest = self._read_manifest()
+        if manifest is not None and manifest["session"] != session_key:
+            logging.info(
+                f"Discarding the metrics checkpoint in {checkpoint_dir} of another "
+                f"query."
+            )
+            manifest = None
+        if manifest is None:
+            self.clear()
+        else:
+            self._manifest = manifest
+
+    def batch(self, instance_ids: list) -> CheckpointBatch:
+        """
+        Get the batch of a list of VMs
+        :param instance_ids: Instance ids of the VMs of the batch
+        :return:
+        """
+        return CheckpointBatch(self, instance_ids)
+
+    def finished_instance_ids(self) -> set:
+        """
+        Get the ids of the VMs of the finished batches
+        :return:
+        """
+        with self._lock:
+            return {
+                instance_id
+                for batch in self._manifest["batches"].values()
+                if batch["status"] == "finished"
+                for instance_id in batch["instance_ids"]
+            }
+
+    def started_batches(self) -> List[list]:
+        """
+        Get the instance ids of the batches whose query was started but whose
+        metrics are not on disk, such as batches interrupted by a restart
+        :return:
+        """
+        with self._lock:
+            return [
+                batch["instance_ids"]
+                for batch in self._manifest["batches"].values()
+                if batch["status"] == "started"
+            ]
+
+    def batch_job(self, key: str) -> Optional[dict]:
+        """
+        Get the query job recorded for a batch
+        :param key: Key of the batch, see batch_key
+        :return: job_id and location of the job, None if no job was recorded
+        """
+        with self._lock:
+            batch = self._manifest["batches"].get(key)
+            if batch is None or batch.get("job_id") is None:
+                return None
+            return {"job_id": batch["job_id"], "location": batch.get("location")}
+
+    def start_batch(
+        self, batch: CheckpointBatch, job_id: str, location: Optional[str] = None
+    ):
+        """
+        Record the query job started for a batch
+        :param batch: Batch of VMs
+        :param job_id: Id of the query job
+        :param location: Location of the query job
+        :return:
+        """
+        with self._lock:
+            self._manifest["batches"][batch.key] = {
+                "instance_ids": batch.instance_ids,
+                "status": "started",
+                "job_id": job_id,
+                "location": location,
+            }
+            self._write_manifest()
+
+    def finish_batch(self, batch: CheckpointBatch, metrics: pd.DataFrame):
+        """
+        Write the metrics of a batch, then record it as finished in the manifest, so
+        a batch is only finished once its metrics are fully written
+        :param batch: Batch of VMs
+        :param metrics: Metrics of the VMs of the batch
+        :return:
+        """
+        path = None
+        if not metrics.empty:
+            path = self._data_path(batch.key)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            metrics.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+
+        with self._lock:
+            entry = self._manifest["batches"].get(batch.key, {})
+            entry.update(
+                {
+                    "instance_ids": batch.instance_ids,
+                    "status": "finished",
+                    "path": None if path is None else os.path.basename(path),
+                    "rows": len(metrics),
+                }
+            )
+            self._manifest["batches"][batch.key] = entry
+            self._write_manifest()
+
+    def load_metrics(self, dtype_backend: str = "numpy") -> pd.DataFrame:
+        """
+        Read the metrics of the finished batches
+        :param dtype_backend: numpy or pyarrow, see utils.DTYPE_BACKENDS
+        :return: Metrics of every finished batch, an empty dataframe if none
+        """
+        with self._lock:
+            paths = [
+                os.path.join(self.checkpoint_dir, batch["path"])
+                for batch in self._manifest["batches"].values()
+                if batch["status"] == "finished" and batch.get("path")
+            ]
+        frames = [
+            (
+                pd.read_parquet(path)
+                if dtype_backend == "numpy"
+                else arrow_table_to_dataframe(
+                    pq.read_table(path), dtype_backend=dtype_backend
+                )
+            )
+            for path in paths
+        ]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def clear(self):
+        """
+        Remove every batch and start an empty manifest
+        :return:
+        """
+        with self._lock:
+            for filename in os.listdir(self.checkpoint_dir):
+                if filename.startswith("batch-"):
+                    os.remove(os.path.join(self.checkpoint_dir, filename))
+            self._manifest = {"session": self.session_key, "batches": {}}
+            self._write_manifest()
+
+    def _data_path(self, key: str) -> str:
+        return os.path.join(self.checkpoint_dir, f"batch-{key}.parquet")
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.checkpoint_dir, MANIFEST_FILE)
+
+    def _read_manifest(self) -> Optional[dict]:
+        try:
+            with open(self._manifest_path()) as manifest_file:
+                return json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self):
+        tmp_path = f"{self._manifest_path()}.tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump(self._manifest, manifest_file)
+        os.replace(tmp_path, self._manifest_path())
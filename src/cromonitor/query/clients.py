@@ -0,0 +1,110 @@
+"""
+This module contains the process wide registry of Google credentials and BigQuery
+clients.
+
+Building a QueryBQToMonitor or a CostQuery used to look up the default credentials
+and create a new BigQuery client each time, so a batch of reports over many
+workflows repeated the authentication round trips and opened new connections for
+every workflow. The registry looks up the credentials once, and creates one
+BigQuery client per project, whose HTTP connection pool is sized for the threads
+querying it, and one BigQuery Storage read client, shared by every query object.
+"""
+
+from __future__ import annotations
+
+import threading
+from typing import Dict, Optional
+
+from ..lazy import lazy_import
+from .utils import create_bqstorage_client
+
+bigquery = lazy_import("google.cloud.bigquery")
+google_auth = lazy_import("google.auth")
+google_auth_requests = lazy_import("google.auth.transport.requests")
+requests_adapters = lazy_import("requests.adapters")
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# Connections kept open per host by a client, requests keeps 10 by default
+DEFAULT_POOL_SIZE = 10
+
+_lock = threading.RLock()
+_credentials = None
+_default_project: Optional[str] = None
+# Client and size of its connection pool, by project
+_clients: Dict[Optional[str], tuple] = {}
+_bqstorage_client = None
+
+
+def get_credentials():
+    """
+    Get the default Google credentials and project, looked up once per process
+    :return: Credentials and the id of their default project
+    """
+    global _credentials, _default_project
+    with _lock:
+        if _credentials is None:
+            _credentials, _default_project = google_auth.default(scopes=SCOPES)
+        return _credentials, _default_project
+
+
+def _mount_pool(session, pool_size: int):
+    adapter = requests_adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+
+
+def get_bigquery_client(
+    project: Optional[str] = None, pool_size: int = DEFAULT_POOL_SIZE
+) -> bigquery.Client:
+    """
+    Get the BigQuery client of a project, created on the first call. Its connection
+    pool is grown when more connections are requested than it holds.
+    :param project: Project the queries are billed to, the project of the default
+    credentials if None
+    :param pool_size: Number of connections the client keeps open, at least the
+    number of threads running queries with it
+    :return:
+    """
+    with _lock:
+        credentials, default_project = get_credentials()
+        project = project or default_project
+        client, client_pool_size = _clients.get(project, (None, 0))
+        if client is None:
+            session = google_auth_requests.AuthorizedSession(credentials)
+            _mount_pool(session, pool_size)
+            client = bigquery.Client(
+                project=project, credentials=credentials, _http=session
+            )
+        elif pool_size > client_pool_size:
+            _mount_pool(client._http, pool_size)
+        _clients[project] = (client, max(pool_size, client_pool_size))
+        return client
+
+
+def get_bqstorage_client():
+    """
+    Get the BigQuery Storage read client, created on the first call
+    :return: BigQueryReadClient or None if google-cloud-bigquery-storage is missing
+    """
+    global _bqstorage_client
+    with _lock:
+        if _bqstorage_client is None:
+            credentials, _ = get_credentials()
+            _bqstorage_client = create_bqstorage_client(credentials=credentials)
+        return _bqstorage_client
+
+
+def clear_clients():
+    """
+    Forget the credentials and clients, for example after changing accounts.
+    Clients in use are not closed.
+    :return:
+    """
+    global _credentials, _default_project, _bqstorage_client
+    with _lock:
+        _credentials = None
+        _default_project = None
+        _clients.clear()
+        _bqstorage_client = None
@@ -1,23 +1,30 @@
 # This module contains the class and functions to query the cost of a workflow
 # from bigquery.
+from __future__ import annotations
+
 import logging
+import time
 from datetime import date, datetime, timedelta
 from typing import List, Union
 
 import pandas as pd
-from google.cloud import bigquery
-from google.cloud.bigquery import ScalarQueryParameter
-from google.cloud.bigquery.table import RowIterator
 
+from ..lazy import lazy_import
 from ..logging import logging as log
-from .table_schema import TERRA_GCP_BILLING_SCHEMA
+from .backends import BigQueryBackend, QueryBackend
+from .clients import get_bigquery_client, get_bqstorage_client
+from .instrumentation import QUERY_STEPS, JobStatsReport, QueryJobStats
 from .utils import (
-    bq_query_cost_calculation,
+    bytes_to_query_cost,
     check_bq_table_exists,
     check_bq_table_schema,
     check_cost_to_query_bq,
 )
 
+bigquery = lazy_import("google.cloud.bigquery")
+# Builds the schemas of the tables with the BigQuery client library
+table_schema = lazy_import("cromonitor.query.table_schema")
+
 
 def check_minimum_time_passed_since_workflow_completion(
     end_time: datetime, min_hours: int = 24
@@ -41,6 +48,10 @@ def check_minimum_time_passed_since_workflow_completion(
 class CostQuery:
     """
     Class for querying and holding the query results on cost.
+    The billing table is queried in BigQuery unless another backend is given, such
+    as a DuckDBBackend holding a local copy of the billing export. The BigQuery
+    client of the billing project is shared by the query objects of the process,
+    unless bq_client is given.
     """
 
     def __init__(
@@ -50,6 +61,10 @@ class CostQuery:
         start_time: datetime,
         end_time: datetime,
         debug: bool = False,
+        use_bqstorage_api: bool = False,
+        bqstorage_client=None,
+        backend: Union[QueryBackend, None] = None,
+        bq_client: Union[bigquery.Client, None] = None,
     ):
 
         if not workflow_id:
@@ -61,22 +76,35 @@ class CostQuery:
         if not end_time:
             log.handle_user_error(err=None, message="end_time cannot be empty")
 
-        self.logger = logging.getLogger()
-        self.logger.setLevel(logging.INFO)
-        if debug:
-            self.logger.setLevel(logging.DEBUG)
+        self.logger = log.configure_logger(debug=debug)
 
         self.end_time: datetime = end_time
         self.start_time: datetime = start_time
         self.bq_cost_table: str = bq_cost_table
         self.project_id: str = bq_cost_table.split(".")[0]
-        self.bq_client: bigquery.Client = bigquery.Client(project=self.project_id)
+
+        if backend is None:
+            # The clients are shared by every query object of the process
+            if bq_client is None:
+                bq_client = get_bigquery_client(project=self.project_id)
+            if bqstorage_client is None and use_bqstorage_api:
+                bqstorage_client = get_bqstorage_client()
+            backend = BigQueryBackend(
+                client=bq_client, bqstorage_client=bqstorage_client
+            )
+        self.backend: QueryBackend = backend
+        self.bq_client: Union[bigquery.Client, None] = getattr(backend, "client", None)
+        self.bqstorage_client = getattr(backend, "bqstorage_client", None)
+
         self.workflow_id: str = workflow_id
         self.query_template: str = self._create_cost_query()
         self.query_config: bigquery.QueryJobConfig = self._create_bq_query_job_config()
         self.query_job: Union[bigquery.QueryJob, None] = None
+        # Statistics of the cost queries run, see instrumentation.JobStatsReport
+        self.job_stats: JobStatsReport = JobStatsReport()
+        self.query_stats: Union[QueryJobStats, None] = None
 
-    def query_cost(self) -> Union[RowIterator, None]:
+    def query_cost(self) -> Union[bigquery.table.RowIterator, None]:
         """
         Execute the cost query in bigquery
         :return:
@@ -85,14 +113,22 @@ class CostQuery:
         self._checks_before_querying_bigquery()
 
         query_job: Union[bigquery.QueryJob, None] = None
+        self.query_stats = self.job_stats.add(
+            QueryJobStats(name="cost", source=self.backend.name)
+        )
 
+        started = time.perf_counter()
         try:
             logging.debug("Executing the query.")
-            query_job = self.bq_client.query(
-                self.query_template, job_config=self.query_config
+            query_job = self.backend.query(
+                self.query_template,
+                query_parameters=self.query_config.query_parameters,
             )
         except Exception as e:
+            self.query_stats.error = repr(e)
             log.handle_bq_error(err=e, message="Error while querying BigQuery")
+        self.query_stats.submit_sec = time.perf_counter() - started
+        self.query_stats.total_sec = self.query_stats.submit_sec
 
         self.query_job = query_job
         logging.info("Query executed successfully.")
@@ -107,13 +143,16 @@ class CostQuery:
         :return: Query string
         """
 
-        query_parameters: List[ScalarQueryParameter] = (
+        query_parameters: List[bigquery.ScalarQueryParameter] = (
             self.query_config.query_parameters
         )
         dry_run_string: str = self.query_template
 
         # Adding '@' to the parameter name to match bq param naming convention
-        params_dict = {"@" + param.name: param.value for param in query_parameters}
+        params_dict = {
+            self.backend.dialect.parameter(param.name): param.value
+            for param in query_parameters
+        }
 
         for param_name, param_value in params_dict.items():
             if isinstance(param_value, date):
@@ -144,9 +183,15 @@ class CostQuery:
             )
         else:
             if to_dataframe:
-                return self.query_job.to_dataframe()
+                results = self.backend.to_dataframe(
+                    self.query_job, stats=self.query_stats
+                )
             else:
-                return self._format_bq_cost_query_results()
+                results = self._format_bq_cost_query_results()
+            self.query_stats.total_sec = sum(
+                getattr(self.query_stats, step) or 0 for step in QUERY_STEPS
+            )
+            return results
 
     def get_cost_to_query(self) -> float:
         """
@@ -159,10 +204,11 @@ class CostQuery:
 
         :return: Float
         """
-        return bq_query_cost_calculation(
-            query=self.query_template,
-            bq_client=self.bq_client,
-            job_config=self.query_config,
+        return bytes_to_query_cost(
+            self.backend.dry_run_bytes(
+                self.query_template,
+                query_parameters=self.query_config.query_parameters,
+            )
         )
 
     def _create_bq_query_job_config(
@@ -197,10 +243,13 @@ class CostQuery:
 
     def _checks_before_querying_bigquery(self):
         check_minimum_time_passed_since_workflow_completion(end_time=self.end_time)
+        if not isinstance(self.backend, BigQueryBackend):
+            # Local copies are created from the expected schema and free to query
+            return
         check_bq_table_schema(
             bq_client=self.bq_client,
             table_id=self.bq_cost_table,
-            expected_schema=TERRA_GCP_BILLING_SCHEMA,
+            expected_schema=table_schema.TERRA_GCP_BILLING_SCHEMA,
         )
         check_bq_table_exists(bq_client=self.bq_client, table_id=self.bq_cost_table)
         check_cost_to_query_bq(
@@ -216,7 +265,16 @@ class CostQuery:
         :return: List[dict]
         """
 
-        return [dict(row) for row in self.query_job.result()]
+        started = time.perf_counter()
+        rows = self.query_job.result()
+        self.query_stats.wait_sec = time.perf_counter() - started
+        self.query_stats.update_from_job(self.query_job)
+
+        started = time.perf_counter()
+        results = [dict(row) for row in rows]
+        self.query_stats.download_sec = time.perf_counter() - started
+        self.query_stats.rows = len(results)
+        return results
 
     def _create_cost_query(self) -> str:
         """
@@ -224,31 +282,32 @@ class CostQuery:
         cost breakdown per workflow task.
         :return:
         """
+        sql = self.backend.dialect
 
         return f"""
             SELECT
               -- Workflow details
               project.id AS google_project_id,
-              (SELECT REGEXP_REPLACE(value, r'^terra-', '') FROM UNNEST(labels) AS l WHERE l.key = 'terra-submission-id') AS submission_id,
-              (SELECT REGEXP_REPLACE(value, r'^cromwell-', '') FROM UNNEST(labels) AS l WHERE l.key = 'cromwell-workflow-id') AS workflow_id,
-              (SELECT value FROM UNNEST(labels) AS l WHERE l.key = 'wdl-task-name') AS task_name,
-              (SELECT value FROM UNNEST(labels) AS l WHERE l.key = 'cromwell-sub-workflow-name') AS subworkflow_name,
-              (SELECT value FROM UNNEST(labels) AS l WHERE l.key = 'wdl-call-alias') AS task_alias,
+              {sql.remove_prefix(sql.label_value("labels", "terra-submission-id"), "terra-")} AS submission_id,
+              {sql.remove_prefix(sql.label_value("labels", "cromwell-workflow-id"), "cromwell-")} AS workflow_id,
+              {sql.label_value("labels", "wdl-task-name")} AS task_name,
+              {sql.label_value("labels", "cromwell-sub-workflow-name")} AS subworkflow_name,
+              {sql.label_value("labels", "wdl-call-alias")} AS task_alias,
               -- Cost breakdown
               service.description AS cost_service,
               sku.description AS cost_description,
               cost,
               -- Machine specs
-              (SELECT value FROM UNNEST(system_labels) AS l WHERE l.key = 'compute.googleapis.com/machine_spec') AS machine_spec,
-              (SELECT value FROM UNNEST(system_labels) AS l WHERE l.key = 'compute.googleapis.com/cores') AS machine_cores,
-              (SELECT value FROM UNNEST(system_labels) AS l WHERE l.key = 'compute.googleapis.com/memory') AS machine_memory,
+              {sql.label_value("system_labels", "compute.googleapis.com/machine_spec")} AS machine_spec,
+              {sql.label_value("system_labels", "compute.googleapis.com/cores")} AS machine_cores,
+              {sql.label_value("system_labels", "compute.googleapis.com/memory")} AS machine_memory,
               usage_start_time,
               usage_end_time
-            FROM {self.bq_cost_table} AS billing,
-             UNNEST(labels) AS label
+            FROM {sql.table(self.bq_cost_table)} AS billing,
+             {sql.unnest_join("labels", "label")}
             WHERE
              cost > 0
-             AND TIMESTAMP_TRUNC(_PARTITIONTIME, DAY) BETWEEN TIMESTAMP(@start_date) AND TIMESTAMP(@end_date)
+             AND {sql.billing_partition_between("start_date", "end_date")}
              AND label.key IN ('cromwell-workflow-id', 'terra-submission-id')
-             AND label.value LIKE @workflow_id
+             AND label.value LIKE {sql.parameter("workflow_id")}
     """
@@ -0,0 +1,224 @@
+"""
+This module contains the SQL dialects the monitoring and cost queries are written in.
+
+The queries are built once for every engine they can run on: BigQuery, and DuckDB
+for the local copies of the tables. A dialect renders the few expressions that are
+spelled differently between the engines, such as query parameters, table
+references, arrays and timestamp arithmetic.
+"""
+
+from abc import ABC, abstractmethod
+
+
+class SqlDialect(ABC):
+    """
+    Renders the engine specific expressions of the queries. Parameter names are
+    given without their prefix.
+    """
+
+    name: str = ""
+
+    @abstractmethod
+    def parameter(self, name: str) -> str:
+        """
+        Reference to a query parameter
+        :param name: Name of the parameter
+        :return:
+        """
+
+    @abstractmethod
+    def table(self, table_id: str) -> str:
+        """
+        Reference to a table
+        :param table_id: Table id as project.dataset.table
+        :return:
+        """
+
+    @abstractmethod
+    def in_array(self, column: str, parameter_name: str) -> str:
+        """
+        Condition on a column being one of the values of an array parameter
+        :param column: Column or expression
+        :param parameter_name: Name of the array parameter
+        :return:
+        """
+
+    @abstractmethod
+    def timestamp_diff_sec(self, end: str, start: str) -> str:
+        """
+        Whole number of seconds between two timestamps
+        :param end: Latest timestamp expression
+        :param start: Earliest timestamp expression
+        :return:
+        """
+
+    @abstractmethod
+    def array_aggregate(self, aggregation: str, column: str) -> str:
+        """
+        Aggregation of the values of an array column, in each row
+        :param aggregation: MIN, MAX or AVG
+        :param column: Array column
+        :return:
+        """
+
+    @abstractmethod
+    def array_first(self, column: str) -> str:
+        """
+        First value of an array column, NULL if the array is empty
+        :param column: Array column
+        :return:
+        """
+
+    @abstractmethod
+    def bucket_timestamp(self, expression: str, interval_parameter_name: str) -> str:
+        """
+        Start of the time bucket of a timestamp
+        :param expression: Timestamp expression
+        :param interval_parameter_name: Name of the parameter holding the length of
+        a bucket in seconds
+        :return:
+        """
+
+    @abstractmethod
+    def unnest_join(self, column: str, alias: str) -> str:
+        """
+        FROM clause item joining each row with the elements of an array column
+        :param column: Array column
+        :param alias: Name of an element
+        :return:
+        """
+
+    @abstractmethod
+    def label_value(self, labels_column: str, key: str) -> str:
+        """
+        Value of the label of a key in a column of key/value records
+        :param labels_column: Column of key/value records
+        :param key: Key of the label
+        :return:
+        """
+
+    @abstractmethod
+    def remove_prefix(self, expression: str, prefix: str) -> str:
+        """
+        String without a leading prefix
+        :param expression: String expression
+        :param prefix: Prefix to remove
+        :return:
+        """
+
+    @abstractmethod
+    def billing_partition_between(
+        self, start_parameter_name: str, end_parameter_name: str
+    ) -> str:
+        """
+        Condition on the billing export partition being within two DATE parameters
+        :param start_parameter_name: Name of the first day parameter
+        :param end_parameter_name: Name of the last day parameter
+        :return:
+        """
+
+
+class BigQueryDialect(SqlDialect):
+    """
+    GoogleSQL, as run by BigQuery
+    """
+
+    name = "bigquery"
+
+    def parameter(self, name: str) -> str:
+        return f"@{name}"
+
+    def table(self, table_id: str) -> str:
+        return f"`{table_id}`"
+
+    def in_array(self, column: str, parameter_name: str) -> str:
+        return f"{column} IN UNNEST({self.parameter(parameter_name)})"
+
+    def timestamp_diff_sec(self, end: str, start: str) -> str:
+        return f"TIMESTAMP_DIFF({end}, {start}, SECOND)"
+
+    def array_aggregate(self, aggregation: str, column: str) -> str:
+        return f"(SELECT {aggregation}(value) FROM UNNEST({column}) AS value)"
+
+    def array_first(self, column: str) -> str:
+        return f"{column}[SAFE_OFFSET(0)]"
+
+    def bucket_timestamp(self, expression: str, interval_parameter_name: str) -> str:
+        interval = self.parameter(interval_parameter_name)
+        return (
+            f"TIMESTAMP_SECONDS(DIV(UNIX_SECONDS({expression}), {interval}) "
+            f"* {interval})"
+        )
+
+    def unnest_join(self, column: str, alias: str) -> str:
+        return f"UNNEST({column}) AS {alias}"
+
+    def label_value(self, labels_column: str, key: str) -> str:
+        return f"(SELECT value FROM UNNEST({labels_column}) AS l WHERE l.key = '{key}')"
+
+    def remove_prefix(self, expression: str, prefix: str) -> str:
+        return f"REGEXP_REPLACE({expression}, r'^{prefix}', '')"
+
+    def billing_partition_between(
+        self, start_parameter_name: str, end_parameter_name: str
+    ) -> str:
+        return (
+            f"TIMESTAMP_TRUNC(_PARTITIONTIME, DAY) BETWEEN "
+            f"TIMESTAMP({self.parameter(start_parameter_name)}) "
+            f"AND TIMESTAMP({self.parameter(end_parameter_name)})"
+        )
+
+
+class DuckDBDialect(SqlDialect):
+    """
+    DuckDB SQL, as run on the local copies of the tables. Tables are stored in a
+    schema named after their dataset, and timestamps are compared in UTC.
+    """
+
+    name = "duckdb"
+
+    def parameter(self, name: str) -> str:
+        return f"${name}"
+
+    def table(self, table_id: str) -> str:
+        dataset, table_name = table_id.split(".")[-2:]
+        return f'"{dataset}"."{table_name}"'
+
+    def in_array(self, column: str, parameter_name: str) -> str:
+        return f"{column} IN (SELECT UNNEST({self.parameter(parameter_name)}))"
+
+    def timestamp_diff_sec(self, end: str, start: str) -> str:
+        return f"CAST(TRUNC(EPOCH({end} - {start})) AS BIGINT)"
+
+    def array_aggregate(self, aggregation: str, column: str) -> str:
+        return f"LIST_AGGREGATE({column}, '{aggregation.lower()}')"
+
+    def array_first(self, column: str) -> str:
+        return f"{column}[1]"
+
+    def bucket_timestamp(self, expression: str, interval_parameter_name: str) -> str:
+        interval = self.parameter(interval_parameter_name)
+        return f"TO_TIMESTAMP(FLOOR(EPOCH({expression}) / {interval}) * {interval})"
+
+    def unnest_join(self, column: str, alias: str) -> str:
+        return f"UNNEST({column}) AS {alias}_elements({alias})"
+
+    def label_value(self, labels_column: str, key: str) -> str:
+        return f"LIST_FILTER({labels_column}, l -> l.key = '{key}')[1].value"
+
+    def remove_prefix(self, expression: str, prefix: str) -> str:
+        return f"REGEXP_REPLACE({expression}, '^{prefix}', '')"
+
+    def billing_partition_between(
+        self, start_parameter_name: str, end_parameter_name: str
+    ) -> str:
+        # Local copies of the billing export have no ingestion time partitions
+        return (
+            f"CAST(usage_start_time AS DATE) BETWEEN "
+            f"CAST({self.parameter(start_parameter_name)} AS DATE) "
+            f"AND CAST({self.parameter(end_parameter_name)} AS DATE)"
+        )
+
+
+BIGQUERY_DIALECT = BigQueryDialect()
+DUCKDB_DIALECT = DuckDBDialect()
@@ -0,0 +1,168 @@
+"""
+This module contains the statistics of the query jobs run by QueryBQToMonitor and
+CostQuery, to tell where the time of a query goes: submitting the job, waiting for
+BigQuery to run it, downloading its results, or converting them to a dataframe.
+
+Each query records a QueryJobStats, with the statistics BigQuery reports for its
+job (bytes processed and billed, slot time, cache hit, execution time) and the
+time spent in each step on the client. A JobStatsReport collects them, from every
+thread, and exports them as a dataframe or JSON.
+"""
+
+import json
+import threading
+from typing import Iterable, List, Optional
+
+import pandas as pd
+
+# Columns of JobStatsReport.to_dataframe()
+JOB_STATS_COLUMNS = [
+    "name",
+    "source",
+    "job_id",
+    "started_at",
+    "bytes_processed",
+    "bytes_billed",
+    "slot_ms",
+    "cache_hit",
+    "server_elapsed_sec",
+    "rows",
+    "submit_sec",
+    "wait_sec",
+    "download_sec",
+    "conversion_sec",
+    "total_sec",
+    "error",
+]
+
+# Client side steps of a query, in the order they run
+QUERY_STEPS = ["submit_sec", "wait_sec", "download_sec", "conversion_sec"]
+
+
+class QueryJobStats:
+    """
+    Statistics of a single query. Steps that do not apply, such as waiting for a
+    local backend or converting results read from the cache, are None.
+    """
+
+    def __init__(self, name: str, source: Optional[str] = None):
+        """
+        :param name: Name of the query, such as runtime or raw metrics
+        :param source: Where the results come from, the name of the backend or cache
+        """
+        self.name: str = name
+        self.source: Optional[str] = source
+        self.started_at: pd.Timestamp = pd.Timestamp.now(tz="UTC")
+        self.job_id: Optional[str] = None
+        self.bytes_processed: Optional[int] = None
+        self.bytes_billed: Optional[int] = None
+        self.slot_ms: Optional[int] = None
+        self.cache_hit: Optional[bool] = None
+        self.server_elapsed_sec: Optional[float] = None
+        self.rows: Optional[int] = None
+        self.submit_sec: Optional[float] = None
+        self.wait_sec: Optional[float] = None
+        self.download_sec: Optional[float] = None
+        self.conversion_sec: Optional[float] = None
+        self.total_sec: Optional[float] = None
+        self.error: Optional[str] = None
+
+    def update_from_job(self, query_job):
+        """
+        Copy the statistics reported by BigQuery for a finished job. Jobs of local
+        backends do not report them, and are left as None.
+        :param query_job: Query job
+        :return:
+        """
+        self.job_id = getattr(query_job, "job_id", None)
+        self.bytes_processed = getattr(query_job, "total_bytes_processed", None)
+        self.bytes_billed = getattr(query_job, "total_bytes_billed", None)
+        self.slot_ms = getattr(query_job, "slot_millis", None)
+        self.cache_hit = getattr(query_job, "cache_hit", None)
+        started = getattr(query_job, "started", None)
+        ended = getattr(query_job, "ended", None)
+        if started is not None and ended is not None:
+            self.server_elapsed_sec = (ended - started).total_seconds()
+
+    def to_dict(self) -> dict:
+        return {column: getattr(self, column) for column in JOB_STATS_COLUMNS}
+
+    def __repr__(self):
+        return f"QueryJobStats({self.to_dict()})"
+
+
+class JobStatsReport:
+    """
+    Statistics of the queries of a session, safe to add to from several threads
+    """
+
+    def __init__(self, jobs: Iterable[QueryJobStats] = ()):
+        """
+        :param jobs: Statistics of queries already run
+        """
+        self._lock = threading.Lock()
+        self.jobs: List[QueryJobStats] = list(jobs)
+
+    def add(self, stats: QueryJobStats) -> QueryJobStats:
+        """
+        Add the statistics of a query. They can still be updated once added.
+        :param stats: Statistics of the query
+        :return: stats
+        """
+        with self._lock:
+            self.jobs.append(stats)
+        return stats
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Get the statistics of every query, one row per query (see JOB_STATS_COLUMNS)
+        :return:
+        """
+        with self._lock:
+            records = [stats.to_dict() for stats in self.jobs]
+        return pd.DataFrame(records, columns=JOB_STATS_COLUMNS)
+
+    def to_json(self, **kwargs) -> str:
+        """
+        Get the statistics of every query as a JSON list of objects
+        :param kwargs: Arguments of json.dumps, such as indent
+        :return:
+        """
+        records = json.loads(
+            self.to_dataframe().to_json(orient="records", date_format="iso")
+        )
+        return json.dumps(records, **kwargs)
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Get the number of queries, the time spent in each step and the bytes
+        processed by each query name
+        :return:
+        """
+        df = self.to_dataframe()
+        numeric_columns = QUERY_STEPS + [
+            "total_sec",
+            "server_elapsed_sec",
+            "bytes_processed",
+            "bytes_billed",
+            "rows",
+        ]
+        df[numeric_columns] = df[numeric_columns].astype(float)
+        summary = df.groupby("name", sort=False)[numeric_columns].sum(min_count=1)
+        summary.insert(0, "count", df.groupby("name", sort=False).size())
+        return summary
+
+    def __str__(self):
+        if not self.jobs:
+            return "No queries run"
+        totals = self.to_dataframe()[QUERY_STEPS + ["total_sec"]].astype(float).sum()
+        return (
+            f"{len(self.jobs)} queries taking {totals.total_sec:.1f}s in total: "
+            f"{totals.submit_sec:.1f}s submitting, "
+            f"{totals.wait_sec:.1f}s waiting for the backend, "
+            f"{totals.download_sec:.1f}s downloading, "
+            f"{totals.conversion_sec:.1f}s converting to dataframes"
+        )
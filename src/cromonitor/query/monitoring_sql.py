@@ -0,0 +1,433 @@
+"""
+This module builds the SQL queries run against the cromwell_monitoring dataset
+(runtime, metadata and metrics tables) and their query parameters.
+
+Values that change from one report to the next (workflow ids, instance ids, time
+window) are passed as query parameters instead of being pasted into the SQL, so the
+text of a query only depends on the project it runs against. This keeps queries
+small for large submissions and lets BigQuery serve repeated reports from its result
+cache.
+
+The time window is a range of timestamps compared directly to the partitioning
+column of each table, so BigQuery only scans the partitions overlapping the run of
+a workflow.
+"""
+
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from ..lazy import lazy_import
+from .dialects import BIGQUERY_DIALECT, SqlDialect
+from .utils import to_utc_timestamp
+
+bigquery = lazy_import("google.cloud.bigquery")
+
+MONITORING_DATASET = "cromwell_monitoring"
+
+# Resources reduced to one value per sample and the aggregations of each bucket
+BUCKETED_RESOURCES = [
+    "cpu_used_percent",
+    "mem_used_gb",
+    "disk_used_gb",
+    "disk_read_iops",
+    "disk_write_iops",
+]
+BUCKET_STATISTICS = {"min": "MIN", "mean": "AVG", "max": "MAX"}
+
+# Margin around the run of a workflow, as VMs are provisioned before their task
+# starts and send their last metrics after it ends
+DEFAULT_TIME_PADDING = timedelta(minutes=10)
+
+
+def days_back_to_date(days_back: int) -> date:
+    """
+    Get the UTC date a number of days before today, the equivalent of
+    DATE_SUB(CURRENT_DATE(), INTERVAL days_back DAY) in BigQuery.
+    :param days_back: Number of days before today
+    :return:
+    """
+    return datetime.now(timezone.utc).date() - timedelta(days=int(days_back))
+
+
+def days_back_to_time_window(
+    days_back_upper_bound: int, days_back_lower_bound: int
+) -> Tuple[pd.Timestamp, pd.Timestamp]:
+    """
+    Get the time window covering whole UTC days, from days_back_upper_bound days
+    before today to days_back_lower_bound days before today, both days included.
+    :param days_back_upper_bound: Number of days before today of the first day
+    :param days_back_lower_bound: Number of days before today of the last day
+    :return: Start and end of the window, the end is excluded
+    """
+    start_time = pd.Timestamp(days_back_to_date(days_back_upper_bound), tz="UTC")
+    end_time = pd.Timestamp(
+        days_back_to_date(days_back_lower_bound) + timedelta(days=1), tz="UTC"
+    )
+    return start_time, end_time
+
+
+def workflow_time_window(
+    start_time,
+    end_time=None,
+    padding: timedelta = DEFAULT_TIME_PADDING,
+) -> Tuple[pd.Timestamp, pd.Timestamp]:
+    """
+    Get the time window of the run of a workflow, padded on both sides. The window
+    of a running workflow, without end time, ends at the next whole hour.
+    :param start_time: Start time of the workflow, timezone naive values are UTC
+    :param end_time: End time of the workflow, None if it is still running
+    :param padding: Margin added before the start and after the end
+    :return: Start and end of the window, the end is excluded
+    """
+    start_time = to_utc_timestamp(start_time)
+    if end_time is None:
+        end_time = pd.Timestamp.now(tz="UTC").ceil("h")
+    else:
+        end_time = to_utc_timestamp(end_time)
+    return start_time - padding, end_time + padding
+
+
+def workflow_ids_parameter(workflow_ids: Iterable[str]) -> bigquery.ArrayQueryParameter:
+    """
+    Create the @workflow_ids query parameter
+    :param workflow_ids: Workflow ids to query
+    :return:
+    """
+    return bigquery.ArrayQueryParameter(
+        "workflow_ids", "STRING", [str(workflow_id) for workflow_id in workflow_ids]
+    )
+
+
+def instance_ids_parameter(instance_ids: Iterable) -> bigquery.ArrayQueryParameter:
+    """
+    Create the @instance_ids query parameter
+    :param instance_ids: VM instance ids to query
+    :return:
+    """
+    return bigquery.ArrayQueryParameter(
+        "instance_ids", "INT64", [int(instance_id) for instance_id in instance_ids]
+    )
+
+
+def time_window_parameters(
+    start_time, end_time: Optional[datetime]
+) -> List[bigquery.ScalarQueryParameter]:
+    """
+    Create the @start_time and @end_time query parameters
+    :param start_time: Start of the window
+    :param end_time: End of the window, excluded
+    :return:
+    """
+    return [
+        timestamp_parameter("start_time", start_time),
+        timestamp_parameter("end_time", end_time),
+    ]
+
+
+def timestamp_parameter(name: str, timestamp) -> bigquery.ScalarQueryParameter:
+    """
+    Create a TIMESTAMP query parameter, such as @metrics_since or @runtime_since
+    :param name: Name of the parameter
+    :param timestamp: Timestamp, timezone naive values are taken as UTC
+    :return:
+    """
+    return bigquery.ScalarQueryParameter(
+        name, "TIMESTAMP", to_utc_timestamp(timestamp).to_pydatetime()
+    )
+
+
+def bucket_interval_parameter(
+    bucket_interval_sec: int,
+) -> bigquery.ScalarQueryParameter:
+    """
+    Create the @bucket_interval_sec query parameter
+    :param bucket_interval_sec: Length of a time bucket in seconds
+    :return:
+    """
+    return bigquery.ScalarQueryParameter(
+        "bucket_interval_sec", "INT64", int(bucket_interval_sec)
+    )
+
+
+class MonitoringQueryBuilder:
+    """
+    Builds the SQL text of the monitoring queries of a project. Queries expect the
+    parameters created by the functions of this module:
+    @workflow_ids, @instance_ids, @start_time, @end_time and @bucket_interval_sec.
+
+    The since variants of the runtime and metrics queries also expect
+    @runtime_since or @metrics_since, and only select the rows recorded from that
+    time on. They are used to refresh the tables of running workflows.
+
+    Queries are written in the dialect of the engine they run on, BigQuery by
+    default.
+    """
+
+    def __init__(
+        self,
+        bq_project: str,
+        dataset: str = MONITORING_DATASET,
+        dialect: SqlDialect = BIGQUERY_DIALECT,
+    ):
+        self.bq_project: str = bq_project
+        self.dataset: str = dataset
+        self.dialect: SqlDialect = dialect
+
+    def table(self, table_name: str) -> str:
+        """
+        Get the fully qualified reference to a table of the monitoring dataset
+        :param table_name: runtime, metadata or metrics
+        :return:
+        """
+        return self.dialect.table(f"{self.bq_project}.{self.dataset}.{table_name}")
+
+    def time_window_filter(self, timestamp_column: str) -> str:
+        """
+        Filter selecting the rows of a timestamp column from @start_time to
+        @end_time, excluded. The column is compared as is, so that the filter prunes
+        the partitions of the table.
+        :param timestamp_column: Timestamp column the table is partitioned on
+        :return:
+        """
+        start_time = self.dialect.parameter("start_time")
+        end_time = self.dialect.parameter("end_time")
+        return f"{timestamp_column} >= {start_time} AND {timestamp_column} < {end_time}"
+
+    def runtime_query(self, since: bool = False) -> str:
+        """
+        Query the runtime table for the VMs of the workflows in @workflow_ids, with
+        the duration they sent metrics for and the times of their first and last
+        samples. The metrics are restricted to these VMs
+        before being grouped, instead of grouping the metrics of every VM of the
+        project and only then joining the few VMs of the workflows.
+        :param since: Only select the VMs started from @runtime_since on
+        :return:
+        """
+        sql = self.dialect
+        since_filter = ""
+        if since:
+            since_filter = f"AND runtime.start_time >= {sql.parameter('runtime_since')}"
+        return f"""
+
+        WITH workflow_runtime AS (
+            SELECT
+                runtime.*
+            FROM
+                {self.table("runtime")} runtime
+            WHERE
+                  {self.time_window_filter("runtime.start_time")}
+
+              AND {sql.in_array("runtime.workflow_id", "workflow_ids")}
+              {since_filter}
+        ),
+        workflow_metrics AS (
+            SELECT
+                metrics.instance_id,
+                MIN(metrics.timestamp) AS min_timestamp,
+                MAX(metrics.timestamp) AS max_timestamp
+            FROM
+                {self.table("metrics")} metrics
+            WHERE
+                  {self.time_window_filter("metrics.timestamp")}
+
+              AND metrics.instance_id IN (
+                SELECT instance_id FROM workflow_runtime
+              )
+            GROUP BY
+                metrics.instance_id
+        )
+
+        SELECT
+
+          runtime.attempt AS runtime_attempt,
+          runtime.cpu_count AS runtime_cpu_count,
+          runtime.cpu_platform AS runtime_cpu_platform,
+          runtime.disk_mounts AS runtime_disk_mounts,
+          runtime.disk_total_gb AS runtime_disk_total_gb,
+          runtime.instance_id AS runtime_instance_id,
+          runtime.instance_name AS runtime_instance_name,
+          runtime.mem_total_gb AS runtime_mem_total_gb,
+          runtime.preemptible AS runtime_preemptible,
+          runtime.project_id AS runtime_project_id,
+          runtime.shard AS runtime_shard,
+          runtime.start_time AS runtime_start_time,
+          runtime.task_call_name AS runtime_task_call_name,
+          runtime.workflow_id AS runtime_workflow_id,
+          runtime.zone AS runtime_zone,
+          {sql.timestamp_diff_sec("metrics.max_timestamp", "metrics.min_timestamp")} AS metrics_duration_sec,
+          metrics.max_timestamp AS metrics_end_time,
+          metrics.min_timestamp AS metrics_start_time
+
+        FROM
+          workflow_runtime runtime
+        LEFT JOIN
+          workflow_metrics metrics
+        ON
+            runtime.instance_id = metrics.instance_id
+        """
+
+    def metadata_query(self) -> str:
+        """
+        Query the metadata table for the calls of the workflows in @workflow_ids.
+        :return:
+        """
+        sql = self.dialect
+        return f"""
+
+        SELECT
+          metadata.attempt AS meta_attempt,
+          metadata.cpu_count AS meta_cpu,
+          metadata.disk_mounts AS meta_disk_mounts,
+          metadata.disk_total_gb AS meta_disk_total_gb,
+          metadata.disk_types AS meta_disk_types,
+          metadata.docker_image AS meta_docker_image,
+          metadata.end_time AS meta_end_time,
+          metadata.execution_status AS meta_execution_status,
+          metadata.inputs AS meta_inputs,
+          metadata.instance_name AS meta_instance_name,
+          metadata.mem_total_gb AS meta_mem_total_gb,
+          metadata.preemptible AS meta_preemptible,
+          metadata.project_id AS meta_project_id,
+          metadata.shard AS meta_shard,
+          metadata.start_time AS meta_start_time,
+          metadata.task_call_name AS meta_task_call_name,
+          metadata.workflow_id AS meta_workflow_id,
+          metadata.workflow_name AS meta_workflow_name,
+          metadata.zone AS meta_zone,
+          {sql.timestamp_diff_sec("metadata.end_time", "metadata.start_time")} meta_duration_sec
+
+        FROM
+          {self.table("metadata")} metadata
+
+        WHERE
+              {self.time_window_filter("metadata.start_time")}
+
+          AND {sql.in_array("metadata.workflow_id", "workflow_ids")}
+        """
+
+    def metrics_filter(self, since: bool = False) -> str:
+        """
+        Filter on the metrics table selecting the samples of the VMs in
+        @instance_ids within the queried window.
+        :param since: Only select the samples recorded from @metrics_since on
+        :return:
+        """
+        sql = self.dialect
+        metrics_filter = f"""
+                {self.time_window_filter("metrics.timestamp")}
+                AND {sql.in_array("metrics.instance_id", "instance_ids")}"""
+        if since:
+            metrics_filter += f"""
+                AND metrics.timestamp >= {sql.parameter("metrics_since")}"""
+        return metrics_filter
+
+    def metrics_query(self, since: bool = False) -> str:
+        """
+        Query every metrics sample of the VMs in @instance_ids.
+        :param since: Only select the samples recorded from @metrics_since on
+        :return:
+        """
+        return f"""
+
+        SELECT
+
+          metrics.cpu_used_percent AS metrics_cpu_used_percent,
+          metrics.disk_read_iops AS metrics_disk_read_iops,
+          metrics.disk_used_gb AS metrics_disk_used_gb,
+          metrics.disk_write_iops AS metrics_disk_write_iops,
+          metrics.instance_id AS metrics_instance_id,
+          metrics.mem_used_gb AS metrics_mem_used_gb,
+          metrics.timestamp AS metrics_timestamp
+
+        FROM
+          {self.table("metrics")}  metrics
+
+        WHERE{self.metrics_filter(since=since)}
+
+        """
+
+    def metrics_summary_query(self) -> str:
+        """
+        Query the resource usage summary of each VM in @instance_ids. The per core
+        cpu usage and the first disk usage are reduced in BigQuery by unnesting the
+        repeated fields, so a single row is returned per VM.
+        :return:
+        """
+        sql = self.dialect
+        return f"""
+
+        SELECT
+
+          samples.instance_id AS metrics_instance_id,
+          COUNT(*) AS summary_sample_count,
+          AVG(samples.cpu_mean_percent) AS summary_cpu_mean_percent,
+          MAX(samples.cpu_mean_percent) AS summary_cpu_max_percent,
+          MAX(samples.mem_used_gb) AS summary_mem_max_gb,
+          MAX(samples.first_disk_used_gb) AS summary_disk_max_gb,
+          MIN(samples.timestamp) AS summary_start_timestamp,
+          MAX(samples.timestamp) AS summary_end_timestamp
+
+        FROM (
+            SELECT
+                metrics.instance_id,
+                metrics.timestamp,
+                metrics.mem_used_gb,
+                {sql.array_aggregate("AVG", "metrics.cpu_used_percent")} AS cpu_mean_percent,
+                {sql.array_first("metrics.disk_used_gb")} AS first_disk_used_gb
+            FROM
+                {self.table("metrics")} metrics
+            WHERE{self.metrics_filter()}
+        ) samples
+
+        GROUP BY
+          samples.instance_id
+
+        """
+
+    def metrics_bucketed_query(self, since: bool = False) -> str:
+        """
+        Query the metrics of the VMs in @instance_ids downsampled to one row per VM
+        and time bucket of @bucket_interval_sec seconds. Each sample is first reduced
+        to the mean cpu usage over its cores and the max usage over its disks, then
+        the min, mean and max of these values are computed for every bucket.
+        :param since: Only select the samples recorded from @metrics_since on
+        :return:
+        """
+        sql = self.dialect
+        resource_statistics = ",\n          ".join(
+            f"{aggregation}(samples.{resource}) AS metrics_{resource}_{statistic}"
+            for resource in BUCKETED_RESOURCES
+            for statistic, aggregation in BUCKET_STATISTICS.items()
+        )
+        return f"""
+
+        SELECT
+
+          samples.instance_id AS metrics_instance_id,
+          {sql.bucket_timestamp("samples.timestamp", "bucket_interval_sec")} AS metrics_timestamp,
+          COUNT(*) AS metrics_sample_count,
+          {resource_statistics}
+
+        FROM (
+            SELECT
+                metrics.instance_id,
+                metrics.timestamp,
+                {sql.array_aggregate("AVG", "metrics.cpu_used_percent")} AS cpu_used_percent,
+                metrics.mem_used_gb,
+                {sql.array_aggregate("MAX", "metrics.disk_used_gb")} AS disk_used_gb,
+                {sql.array_aggregate("MAX", "metrics.disk_read_iops")} AS disk_read_iops,
+                {sql.array_aggregate("MAX", "metrics.disk_write_iops")} AS disk_write_iops
+            FROM
+                {self.table("metrics")} metrics
+            WHERE{self.metrics_filter(since=since)}
+        ) samples
+
+        GROUP BY
+          metrics_instance_id,
+          metrics_timestamp
+
+        """
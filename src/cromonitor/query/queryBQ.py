@@ -1,14 +1,63 @@
 import concurrent.futures
 import datetime
+import functools
 import logging
-import sys
+import time
+import uuid
 
-import google.auth
 import pandas as pd
-from google.api_core.exceptions import NotFound
-from google.cloud import bigquery
 
+from ..lazy import lazy_import
 from ..logging import logging as log
+from ..table.dataset import MonitoringDataset
+from ..table.ragged import add_sample_reductions
+from .backends import BigQueryBackend
+from .batching import DEFAULT_TARGET_BATCH_BYTES, MetricsBatch, plan_metrics_batches
+from .budget import (
+    MetricsStrategy,
+    PlannedQuery,
+    QueryBudgetExceededError,
+    QueryPlan,
+    choose_plan,
+    metrics_strategies,
+)
+from .cache import (
+    DEFAULT_CACHE_MAX_BYTES,
+    DEFAULT_RUNNING_TTL_SEC,
+    QueryResultCache,
+    query_fingerprint,
+    workflows_finished,
+)
+from .checkpoint import MetricsCheckpoint
+from .clients import DEFAULT_POOL_SIZE, get_bigquery_client, get_bqstorage_client
+from .instrumentation import JobStatsReport, QueryJobStats
+from .monitoring_sql import (
+    BUCKET_STATISTICS,
+    BUCKETED_RESOURCES,
+    DEFAULT_TIME_PADDING,
+    MonitoringQueryBuilder,
+    bucket_interval_parameter,
+    days_back_to_time_window,
+    instance_ids_parameter,
+    time_window_parameters,
+    timestamp_parameter,
+    workflow_ids_parameter,
+    workflow_time_window,
+)
+from .reconcile import (
+    DEFAULT_MAX_CONCURRENT_REFETCHES,
+    DEFAULT_MAX_REFETCH_ATTEMPTS,
+    DEFAULT_REFETCH_BACKOFF_SEC,
+    backoff_delay_sec,
+    completeness_report,
+    deduplicate_metrics,
+    missing_instance_ids,
+)
+from .scheduling import DEFAULT_HEDGE_SPLITS, RunningJobs, job_labels, run_batches
+from .streaming import DEFAULT_STREAM_BUFFER_ROWS, StreamedMetrics
+from .utils import DTYPE_BACKENDS, convert_dtype_backend, nullable_int_dtype
+
+api_exceptions = lazy_import("google.api_core.exceptions")
 
 METADATA_COLUMNS = [
     "meta_attempt",
@@ -56,6 +105,32 @@ METADATA_COLUMNS_TYPES = {
     "meta_duration_sec": "Int64",
 }
 
+# raw: every metrics sample of every VM
+# summary: one row per VM with its resource usage aggregated in BigQuery
+# bucketed: min/mean/max of the samples of each VM per time bucket
+METRICS_MODES = ["raw", "summary", "bucketed"]
+
+METRICS_SUMMARY_COLUMNS = [
+    "metrics_instance_id",
+    "summary_sample_count",
+    "summary_cpu_mean_percent",
+    "summary_cpu_max_percent",
+    "summary_mem_max_gb",
+    "summary_disk_max_gb",
+    "summary_start_timestamp",
+    "summary_end_timestamp",
+]
+
+METRICS_BUCKETED_COLUMNS = [
+    "metrics_instance_id",
+    "metrics_timestamp",
+    "metrics_sample_count",
+] + [
+    f"metrics_{resource}_{statistic}"
+    for resource in BUCKETED_RESOURCES
+    for statistic in BUCKET_STATISTICS
+]
+
 
 class QueryBQToMonitor:
     """
@@ -64,54 +139,599 @@ class QueryBQToMonitor:
     of subworkflows (if any) and estimated dates when the job was submitted and
     successfully finished. It uses these parameters to query the
     BQ tables and produces a pandas datafram.
+
+    query() fetches the tables, refresh() updates those of running workflows. The
+    options of a session, see __init__:
+    - time window: days back or start_time/end_time, see monitoring_sql.py
+    - metrics batches and their time ranges: batching.py
+    - metrics modes (raw, bucketed, summary): METRICS_MODES and monitoring_sql.py
+    - query engine and shared clients: backends.py and clients.py
+    - result cache: cache.py
+    - refetch of missing VMs: reconcile.py
+    - query budget: budget.py
+    - streaming the metrics to disk: streaming.py
+    - checkpoints of interrupted downloads: checkpoint.py
+    - cancellation, timeouts and hedging of batches: scheduling.py
+    - job statistics: instrumentation.py
+    - dtypes of the tables: utils.DTYPE_BACKENDS
+    - tables indexed by task and shard: table/dataset.py
     """
 
     def __init__(
         self,
         workflow_ids,
-        days_back_upper_bound,
-        days_back_lower_bound,
-        bq_goolge_project,
+        days_back_upper_bound=None,
+        days_back_lower_bound=None,
+        bq_goolge_project=None,
         debug=False,
+        num_threads=8,
+        target_batch_bytes=DEFAULT_TARGET_BATCH_BYTES,
+        use_bqstorage_api=False,
+        bqstorage_client=None,
+        metrics_mode="raw",
+        bucket_interval_sec=60,
+        cache_dir=None,
+        cache_max_bytes=DEFAULT_CACHE_MAX_BYTES,
+        cache_running_ttl_sec=DEFAULT_RUNNING_TTL_SEC,
+        backend=None,
+        start_time=None,
+        end_time=None,
+        time_padding=DEFAULT_TIME_PADDING,
+        max_refetch_attempts=DEFAULT_MAX_REFETCH_ATTEMPTS,
+        refetch_backoff_sec=DEFAULT_REFETCH_BACKOFF_SEC,
+        max_concurrent_refetches=DEFAULT_MAX_CONCURRENT_REFETCHES,
+        query_budget_bytes=None,
+        allow_cheaper_strategies=True,
+        metrics_dir=None,
+        stream_buffer_rows=DEFAULT_STREAM_BUFFER_ROWS,
+        bq_client=None,
+        dtype_backend="numpy",
+        checkpoint_dir=None,
+        batch_timeout_sec=None,
+        hedge_after_sec=None,
+        hedge_splits=DEFAULT_HEDGE_SPLITS,
     ):
+        """
+        @param workflow_ids: Ids of the workflows and of their subworkflows
+        @param days_back_upper_bound: Days before today the window starts at
+        @param days_back_lower_bound: Days before today the window ends at
+        @param bq_goolge_project: Project of the monitoring dataset
+        @param debug: Log at debug level
+        @param num_threads: Number of threads fetching metrics batches
+        @param target_batch_bytes: Estimated bytes of a metrics batch, inf for a
+        single query
+        @param use_bqstorage_api: Download results through the Storage Read API
+        @param bqstorage_client: BigQueryReadClient to download results with
+        @param metrics_mode: raw, bucketed or summary, see METRICS_MODES
+        @param bucket_interval_sec: Length of a bucket of bucketed metrics
+        @param cache_dir: Directory caching the query results, no cache if None
+        @param cache_max_bytes: Maximum size of the cache
+        @param cache_running_ttl_sec: Seconds the results of running workflows are
+        cached for
+        @param backend: QueryBackend running the queries, BigQuery if None
+        @param start_time: Start of the workflows, instead of days_back_upper_bound
+        @param end_time: End of the workflows, None if they are still running
+        @param time_padding: Padding of the window and of the batch time ranges
+        @param max_refetch_attempts: Times the VMs missing from the metrics are
+        fetched again
+        @param refetch_backoff_sec: Wait before the first refetch of failed batches
+        @param max_concurrent_refetches: Maximum number of refetch queries at a time
+        @param query_budget_bytes: Bytes the queries may process, no budget if None
+        @param allow_cheaper_strategies: Fall back to cheaper metrics modes to fit
+        query_budget_bytes
+        @param metrics_dir: Directory the metrics are streamed to, in memory if None
+        @param stream_buffer_rows: Rows of a batch held in memory while streaming
+        @param bq_client: BigQuery client, the shared client if None
+        @param dtype_backend: numpy or pyarrow, see utils.DTYPE_BACKENDS
+        @param checkpoint_dir: Directory checkpointing the metrics batches
+        @param batch_timeout_sec: Seconds after which a metrics batch is abandoned
+        @param hedge_after_sec: Seconds after which a metrics batch is re-issued
+        in smaller batches
+        @param hedge_splits: Number of batches a hedged batch is split into
+        """
+        if metrics_mode not in METRICS_MODES:
+            raise ValueError(
+                f"Unknown metrics_mode {metrics_mode}, expected one of {METRICS_MODES}"
+            )
+        if dtype_backend not in DTYPE_BACKENDS:
+            raise ValueError(
+                f"Unknown dtype_backend {dtype_backend}, expected one of "
+                f"{DTYPE_BACKENDS}"
+            )
+        if bq_goolge_project is None:
+            raise ValueError("bq_goolge_project is required")
+        if start_time is None and (
+            days_back_upper_bound is None or days_back_lower_bound is None
+        ):
+            raise ValueError(
+                "Either start_time, or days_back_upper_bound and "
+                "days_back_lower_bound are required"
+            )
+        if start_time is not None and days_back_upper_bound is not None:
+            raise ValueError(
+                "start_time and days_back_upper_bound can not be used together"
+            )
 
-        self.logger = logging.getLogger()
-        self.logger.setLevel(logging.INFO)
-        if debug:
-            self.logger.setLevel(logging.DEBUG)
-
-        h = logging.StreamHandler(sys.stderr)
-        h.flush = sys.stderr.flush
-        self.logger.addHandler(h)
+        self.logger = log.configure_logger(debug=debug)
 
-        self.formated_workflow_ids = (
-            '"' + '","'.join(workflow_ids) + '"'
-        )  # format workflow ids for query
+        self.workflow_ids = list(workflow_ids)
 
         self.days_back_upper_bound = days_back_upper_bound
         self.days_back_lower_bound = days_back_lower_bound
+        self.workflow_start_time = start_time
+        self.workflow_end_time = end_time
+        self.time_padding = time_padding
+        # The window is resolved once, so every query of the session covers the
+        # same time range and the SQL text does not depend on the current date.
+        self.start_time, self.end_time = self._time_window()
 
         self.bq_goolge_project = bq_goolge_project
 
-        # Explicitly create a credentials object. This allows you to use the same
-        # credentials for both the BigQuery and BigQuery Storage clients, avoiding
-        # unnecessary API calls to fetch duplicate authentication tokens.
-        credentials, project_id = google.auth.default(
-            scopes=["https://www.googleapis.com/auth/cloud-platform"]
+        # Number of threads fetching metrics batches and the estimated size of a batch
+        self.num_threads = num_threads
+        self.target_batch_bytes = target_batch_bytes
+        self._requested_target_batch_bytes = target_batch_bytes
+        self.metrics_mode = metrics_mode
+        self._requested_metrics_mode = metrics_mode
+        self.bucket_interval_sec = int(bucket_interval_sec)
+        self.max_refetch_attempts = max_refetch_attempts
+        self.refetch_backoff_sec = refetch_backoff_sec
+        self.max_concurrent_refetches = max_concurrent_refetches
+        self.metrics_completeness = None
+        self.query_budget_bytes = query_budget_bytes
+        self.allow_cheaper_strategies = allow_cheaper_strategies
+        self.query_plan = None
+        # Bytes processed by each query of the session, from its dry run
+        self._dry_run_bytes = {}
+
+        if backend is None:
+            # Clients are shared by every query object of the process, see
+            # clients.py. A client can be passed in to use another one or to test.
+            # The metrics batches, runtime and metadata tables are fetched at once.
+            if bq_client is None:
+                bq_client = get_bigquery_client(
+                    pool_size=max(DEFAULT_POOL_SIZE, num_threads + 2)
+                )
+
+            # Optionally download results as Arrow record batches through the
+            # BigQuery Storage Read API.
+            if bqstorage_client is None and use_bqstorage_api:
+                bqstorage_client = get_bqstorage_client()
+            backend = BigQueryBackend(
+                client=bq_client, bqstorage_client=bqstorage_client
+            )
+        self.backend = backend
+        self.bq_client = getattr(backend, "client", None)
+        self.bqstorage_client = getattr(backend, "bqstorage_client", None)
+        self.query_builder = MonitoringQueryBuilder(
+            bq_project=bq_goolge_project, dialect=backend.dialect
         )
 
-        # Make clients.
-        self.bq_client = bigquery.Client(credentials=credentials, project=project_id)
+        self.cache = None
+        if cache_dir:
+            self.cache = QueryResultCache(
+                cache_dir=cache_dir,
+                max_size_bytes=cache_max_bytes,
+                running_ttl_sec=cache_running_ttl_sec,
+            )
+        # Keys of the results queried from BigQuery and cached during this session
+        self._cached_keys = []
+        # Statistics of every query run by the session
+        self.job_stats = JobStatsReport()
+
+        self.dtype_backend = dtype_backend
+        self.metrics_dataset = None
+        if metrics_dir:
+            self.metrics_dataset = StreamedMetrics(
+                metrics_dir=metrics_dir,
+                buffer_rows=stream_buffer_rows,
+                dtype_backend=dtype_backend,
+            )
+
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint = None
+
+        # Deadline of a metrics batch and when it is re-issued in smaller batches
+        self.batch_timeout_sec = batch_timeout_sec
+        self.hedge_after_sec = hedge_after_sec
+        self.hedge_splits = hedge_splits
+        # Id labelling the query jobs of the session, and its jobs still running
+        self.session_id = uuid.uuid4().hex[:16]
+        self.running_jobs = RunningJobs()
+
+        self.runtime = None
+
+        # Start time of the last VM and time of the last metrics row of each VM,
+        # from which refresh() fetches new data, and when they were fetched
+        self.runtime_watermark = None
+        self.metrics_watermarks = None
+        self.fetched_at = None
+
+        # MonitoringDataset of the tables and the tables it was built from
+        self._monitoring_dataset = None
+        self._monitoring_dataset_tables = None
+
+    @property
+    def monitoring_dataset(self) -> MonitoringDataset:
+        """
+        Metrics and metadata_runtime tables as a MonitoringDataset, indexed by task
+        and shard, built on first use and again once the tables change. With
+        metrics_dir set, self.metrics and so the dataset only hold the instance ids
+        and timestamps of the samples.
+        """
+        tables = (self.metrics, self.metadata_runtime)
+        if self._monitoring_dataset_tables is None or any(
+            table is not built_from
+            for table, built_from in zip(tables, self._monitoring_dataset_tables)
+        ):
+            self._monitoring_dataset = MonitoringDataset(
+                metrics=self.metrics, metadata_runtime=self.metadata_runtime
+            )
+            self._monitoring_dataset_tables = tables
+        return self._monitoring_dataset
 
     def query(self):
-        self._get_runtime_and_metadata()
-        self._get_metrics()
+        fetch_started_at = pd.Timestamp.now(tz="UTC")
+        if self.query_budget_bytes is not None:
+            self.plan()
+
+        # The metadata table does not depend on the other tables, so it is fetched
+        # in the background while the runtime table, then the metrics, are fetched.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            metadata_job = executor.submit(self._fetch_metadata)
+            try:
+                self._fetch_runtime()
+                if self.query_budget_bytes is not None:
+                    # The number of metrics batches is only known from the VMs
+                    self.plan()
+                self._get_metrics()
+                metadata_job.result()
+            except KeyboardInterrupt:
+                # Cancelling the metadata job also stops the thread waiting for it
+                self.cancel_running_jobs()
+                raise
+
+        self._merge_runtime_and_metadata()
+        print()
+        self.metadata_runtime.runtime_task_call_name.describe()
+        self._update_watermarks(fetched_at=fetch_started_at)
+        self._mark_cache_finished()
+
+    def plan(self):
+        """
+        Dry runs the queries of the session and chooses how to fetch the metrics
+        within query_budget_bytes. Until the runtime table is fetched, the metrics
+        are assumed to be fetched in num_threads batches over the whole window. The
+        chosen plan is logged, kept in self.query_plan, and the metrics mode and
+        batches of the session are set to its strategy.
+        @return: Chosen QueryPlan
+        """
+        if self.allow_cheaper_strategies:
+            strategies = metrics_strategies(self._requested_metrics_mode)
+        else:
+            strategies = [
+                MetricsStrategy(
+                    self._requested_metrics_mode,
+                    single_query=self._requested_target_batch_bytes == float("inf"),
+                )
+            ]
+
+        window_parameters = [
+            workflow_ids_parameter(self.workflow_ids)
+        ] + self._window_parameters()
+        queries = [
+            PlannedQuery(
+                "runtime",
+                self._dry_run(
+                    "runtime", self.query_builder.runtime_query(), window_parameters
+                ),
+            ),
+            PlannedQuery(
+                "metadata",
+                self._dry_run(
+                    "metadata", self.query_builder.metadata_query(), window_parameters
+                ),
+            ),
+        ]
+        plans = [
+            QueryPlan(
+                strategy=strategy,
+                queries=queries + [self._plan_metrics_query(strategy)],
+                budget_bytes=self.query_budget_bytes,
+            )
+            for strategy in strategies
+        ]
+
+        try:
+            self.query_plan = choose_plan(plans)
+        except QueryBudgetExceededError as e:
+            log.handle_bq_error(err=e, message="Not running the monitoring queries")
+            raise
+        self.logger.info(str(self.query_plan))
+        if self.query_plan.strategy != strategies[0]:
+            log.handle_bq_warning(
+                err=None,
+                message=f"Fetching {self.query_plan.strategy.name} metrics "
+                f"instead of {strategies[0].name} metrics to fit the query budget",
+            )
+
+        self.metrics_mode = self.query_plan.strategy.metrics_mode
+        self.target_batch_bytes = self._requested_target_batch_bytes
+        if self.query_plan.strategy.single_query:
+            self.target_batch_bytes = float("inf")
+        return self.query_plan
+
+    def _plan_metrics_query(self, strategy):
+        """
+        Estimates the metrics queries of a strategy. Until the VMs are known, a query
+        is dry run over the whole window. Then every planned batch is dry run over
+        its own time range, as it only scans the partitions of that range.
+        @param strategy: MetricsStrategy
+        @return: PlannedQuery
+        """
+        mode = strategy.metrics_mode
+        name = f"{mode} metrics"
+        if self.runtime is None:
+            metrics_sql, query_parameters = self._metrics_query_of_mode(mode)
+            return PlannedQuery(
+                name,
+                self._dry_run(name, metrics_sql, query_parameters),
+                count=1 if strategy.single_query else self.num_threads,
+            )
+
+        batches = plan_metrics_batches(
+            runtime=self.runtime,
+            num_threads=self.num_threads,
+            target_batch_bytes=(
+                float("inf")
+                if strategy.single_query
+                else self._requested_target_batch_bytes
+            ),
+            sample_interval_sec=self.bucket_interval_sec if mode == "bucketed" else 1,
+            time_padding=self.time_padding,
+        )
+
+        def dry_run_batch(batch):
+            time_bounds = (batch.start_time, batch.end_time)
+            metrics_sql, query_parameters = self._metrics_query_of_mode(
+                mode, time_bounds=time_bounds
+            )
+            return self._dry_run(
+                name, metrics_sql, query_parameters, time_bounds=time_bounds
+            )
+
+        # Dry runs are not billed, they only wait for BigQuery to plan the query
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.num_threads
+        ) as executor:
+            batch_bytes = list(executor.map(dry_run_batch, batches))
+        return PlannedQuery(
+            name,
+            max(batch_bytes, default=0),
+            count=len(batches),
+            total_bytes=sum(batch_bytes),
+        )
+
+    def _metrics_query_of_mode(self, mode, time_bounds=None):
+        """
+        Gets the metrics query of a metrics mode and its parameters, without VMs
+        @param mode: Metrics mode, see METRICS_MODES
+        @param time_bounds: Start and end of the time range of a batch
+        @return: Query and its parameters
+        """
+        query_parameters = self._metrics_parameters([], time_bounds=time_bounds)
+        if mode == "summary":
+            metrics_sql = self.query_builder.metrics_summary_query()
+        elif mode == "bucketed":
+            metrics_sql = self.query_builder.metrics_bucketed_query()
+            query_parameters.append(bucket_interval_parameter(self.bucket_interval_sec))
+        else:
+            metrics_sql = self.query_builder.metrics_query()
+        return metrics_sql, query_parameters
+
+    def _dry_run(self, name, sql, query_parameters, time_bounds=None):
+        """
+        Gets the bytes a query would process, dry running it once per session and
+        time range
+        @param name: Name of the query
+        @param sql: Query
+        @param query_parameters: Parameters referenced by the query
+        @param time_bounds: Start and end of the time range of a batch, the whole
+        window if None
+        @return:
+        """
+        key = (name, time_bounds)
+        if key not in self._dry_run_bytes:
+            self._dry_run_bytes[key] = self.backend.dry_run_bytes(
+                sql, query_parameters=query_parameters
+            )
+        return self._dry_run_bytes[key]
+
+    def refresh(self):
+        """
+        Updates the tables of running workflows. Only the VMs started since the last
+        query and the metrics recorded since the last row of each VM (its watermark)
+        are fetched, then appended to the tables. VMs that finished before the
+        previous query or refresh are not queried again. The first call runs a full
+        query.
+        @return:
+        """
+        if self.metrics_mode == "summary":
+            raise ValueError(
+                "refresh is not available with metrics_mode='summary', "
+                "per VM summaries can not be extended with new samples."
+            )
+        if self.metrics_watermarks is None:
+            self.query()
+            return
+        fetch_started_at = pd.Timestamp.now(tz="UTC")
+
+        # Running workflows keep recording after the end of the initial window
+        self.end_time = max(self.end_time, self._time_window()[1])
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            metadata_job = executor.submit(self._fetch_metadata, read_cache=False)
+            try:
+                new_runtime = self._fetch_new_runtime()
+                metadata_job.result()
+            except KeyboardInterrupt:
+                self.cancel_running_jobs()
+                raise
+        if not new_runtime.empty:
+            self.runtime = pd.concat([self.runtime, new_runtime], ignore_index=True)
+
+        refreshed_runtime, since = self._runtime_to_refresh(
+            new_instance_ids=new_runtime.runtime_instance_id
+        )
+        if refreshed_runtime.empty:
+            self.logger.info("No running instances to refresh.")
+        else:
+            self.logger.info(
+                f"Refreshing metrics of {len(refreshed_runtime)} instances "
+                f"since {since}."
+            )
+            new_metrics, failed_instance_ids = self._fetch_metrics_in_batches(
+                refreshed_runtime, since=since
+            )
+            if failed_instance_ids:
+                # Their watermarks are not moved, the next refresh fetches them
+                self.logger.warning(
+                    f"Metrics of instances {failed_instance_ids} were not refreshed."
+                )
+            self._append_metrics(new_metrics)
 
-    def _get_runtime_and_metadata(self):
+        self._merge_runtime_and_metadata()
+        self._update_watermarks(fetched_at=fetch_started_at)
+        self._mark_cache_finished()
 
-        self._fetch_runtime()
-        self._fetch_metadata()
+    def _fetch_new_runtime(self):
+        """
+        Fetches the runtime rows of the VMs started since the runtime watermark
+        @return:
+        """
+        if pd.isna(self.runtime_watermark):
+            since = None
+            runtime_sql = self.query_builder.runtime_query()
+            query_parameters = [workflow_ids_parameter(self.workflow_ids)]
+        else:
+            since = self.runtime_watermark
+            runtime_sql = self.query_builder.runtime_query(since=True)
+            query_parameters = [
+                workflow_ids_parameter(self.workflow_ids),
+                timestamp_parameter("runtime_since", since),
+            ]
+        self.logger.debug(f"Runtime SQL: {runtime_sql}")
+        runtime = self._run_query(
+            runtime_sql,
+            query_parameters=query_parameters + self._window_parameters(since=since),
+            read_cache=False,
+            query_name="runtime",
+        )
+        if runtime.empty:
+            return runtime
+        new_runtime = runtime[
+            ~runtime.runtime_instance_id.isin(self.runtime.runtime_instance_id)
+        ]
+        self.logger.info(f"Fetched {len(new_runtime)} new runtime rows.")
+        return new_runtime
 
+    def _runtime_to_refresh(self, new_instance_ids):
+        """
+        Selects the VMs that may have recorded metrics since their watermark: new VMs
+        and VMs that are still running or finished after the previous fetch. VMs
+        without metrics yet are fetched from their start time.
+        @param new_instance_ids: Ids of the VMs started since the last refresh
+        @return: Runtime rows of the VMs, with metrics_duration_sec set to the
+        duration to fetch, and the time from which to fetch their metrics
+        """
+        runtime = self.runtime.drop_duplicates("runtime_instance_id")
+        watermarks = pd.to_datetime(
+            runtime.runtime_instance_id.map(self.metrics_watermarks), utc=True
+        )
+        end_times = runtime.runtime_instance_name.map(
+            self.metadata.groupby("meta_instance_name").meta_end_time.max()
+        )
+        to_refresh = (
+            runtime.runtime_instance_id.isin(new_instance_ids)
+            | end_times.isna()
+            | (end_times >= self.fetched_at)
+        )
+
+        since_per_instance = watermarks.fillna(runtime.runtime_start_time)[to_refresh]
+        if self.metrics_mode == "bucketed":
+            # Buckets are recomputed whole, a bucket starting before the time
+            # fetched from would only count part of its samples and replace the
+            # complete one.
+            since_per_instance = since_per_instance.dt.floor(
+                f"{self.bucket_interval_sec}s"
+            )
+        since = since_per_instance.min()
+        refreshed_runtime = runtime[to_refresh].copy()
+        refreshed_runtime["metrics_duration_sec"] = (
+            (pd.Timestamp.now(tz="UTC") - since_per_instance)
+            .dt.total_seconds()
+            .clip(lower=0)
+        )
+        return refreshed_runtime, (None if pd.isna(since) else since)
+
+    def _append_metrics(self, new_metrics):
+        """
+        Appends the metrics fetched by a refresh and updates the duration of the VMs
+        @param new_metrics:
+        @return:
+        """
+        if new_metrics.empty:
+            return
+        if self.metrics is not None and not self.metrics.empty:
+            new_metrics = pd.concat([self.metrics, new_metrics], ignore_index=True)
+        # The first rows fetched for a VM repeat its last known sample or bucket
+        self.metrics = new_metrics.drop_duplicates(
+            subset=["metrics_instance_id", "metrics_timestamp"], keep="last"
+        ).reset_index(drop=True)
+
+        timestamps = self.metrics.groupby("metrics_instance_id").metrics_timestamp
+        durations = (timestamps.max() - timestamps.min()).dt.total_seconds()
+        self.runtime["metrics_duration_sec"] = (
+            pd.concat(
+                [
+                    self.runtime.metrics_duration_sec.astype("float64"),
+                    self.runtime.runtime_instance_id.map(durations),
+                ],
+                axis=1,
+            )
+            .max(axis=1)
+            .round()
+            .astype(nullable_int_dtype(self.dtype_backend))
+        )
+
+    def _update_watermarks(self, fetched_at):
+        """
+        Records the start time of the last VM and the time of the last metrics row of
+        each VM, from which refresh() fetches new data.
+        @param fetched_at: Time the tables were fetched from
+        @return:
+        """
+        self.fetched_at = fetched_at
+        self.runtime_watermark = None
+        if not self.runtime.empty:
+            self.runtime_watermark = self.runtime.runtime_start_time.max()
+
+        self.metrics_watermarks = pd.Series(dtype="datetime64[us, UTC]")
+        if "metrics_timestamp" in self.metrics.columns:
+            self.metrics_watermarks = self.metrics.groupby(
+                "metrics_instance_id"
+            ).metrics_timestamp.max()
+
+    def _mark_cache_finished(self):
+        """
+        Keep the results cached during this session once the workflows are finished,
+        as their monitoring data will not change anymore.
+        @return:
+        """
+        if self.cache is not None and workflows_finished(self.metadata):
+            self.cache.mark_finished(self._cached_keys)
+
+    def _merge_runtime_and_metadata(self):
         runtime_nrow, runtime_ncol = self.runtime.shape
         meta_nrow, meta_ncol = self.metadata.shape
 
@@ -131,100 +751,34 @@ class QueryBQToMonitor:
             right_on="runtime_instance_name",
             how="right",
         )
-        print()
-        self.metadata_runtime.runtime_task_call_name.describe()
 
     def _fetch_runtime(self):
         # query runtime data
-        runtime_sql = f"""
-
-        SELECT
-
-          runtime.attempt AS runtime_attempt,
-          runtime.cpu_count AS runtime_cpu_count,
-          runtime.cpu_platform AS runtime_cpu_platform,
-          runtime.disk_mounts AS runtime_disk_mounts,
-          runtime.disk_total_gb AS runtime_disk_total_gb,
-          runtime.instance_id AS runtime_instance_id,
-          runtime.instance_name AS runtime_instance_name,
-          runtime.mem_total_gb AS runtime_mem_total_gb,
-          runtime.preemptible AS runtime_preemptible,
-          runtime.project_id AS runtime_project_id,
-          runtime.shard AS runtime_shard,
-          runtime.start_time AS runtime_start_time,
-          runtime.task_call_name AS runtime_task_call_name,
-          runtime.workflow_id AS runtime_workflow_id,
-          runtime.zone AS runtime_zone,
-          TIMESTAMP_DIFF(metrics.max_timestamp, metrics.min_timestamp, SECOND) AS metrics_duration_sec
-
-        FROM
-          `{self.bq_goolge_project}.cromwell_monitoring.runtime` runtime
-        LEFT JOIN (
-            SELECT
-                metrics.instance_id,
-                MIN(metrics.timestamp) AS min_timestamp,
-                MAX(metrics.timestamp) AS max_timestamp
-            FROM
-                `{self.bq_goolge_project}.cromwell_monitoring.metrics` metrics
-            WHERE
-                DATE(metrics.timestamp) >= DATE_SUB(CURRENT_DATE(), INTERVAL {self.days_back_upper_bound} DAY)
-                AND DATE(metrics.timestamp) <= DATE_SUB(CURRENT_DATE(), INTERVAL {self.days_back_lower_bound} DAY)
-            GROUP BY
-                metrics.instance_id
-        ) metrics
-        ON
-            runtime.instance_id = metrics.instance_id
-        WHERE
-              DATE(runtime.start_time) >= DATE_SUB(CURRENT_DATE(), INTERVAL {self.days_back_upper_bound} DAY)
-          AND DATE(runtime.start_time) <= DATE_SUB(CURRENT_DATE(), INTERVAL {self.days_back_lower_bound} DAY)
-
-          AND runtime.workflow_id IN ({self.formated_workflow_ids})
-        """
+        runtime_sql = self.query_builder.runtime_query()
         self.logger.debug(f"Runtime SQL: {runtime_sql}")
-        self.runtime = self.bq_client.query(query=runtime_sql).to_dataframe()
+        self.runtime = self._run_query(
+            runtime_sql,
+            query_parameters=[workflow_ids_parameter(self.workflow_ids)]
+            + self._window_parameters(),
+            query_name="runtime",
+        )
         self.logger.info("Fetched runtime table.")
 
-    def _fetch_metadata(self):
+    def _fetch_metadata(self, read_cache=True):
         # query metadata table
-        metadata_sql = f"""
-
-        SELECT
-          metadata.attempt AS meta_attempt,
-          metadata.cpu_count AS meta_cpu,
-          metadata.disk_mounts AS meta_disk_mounts,
-          metadata.disk_total_gb AS meta_disk_total_gb,
-          metadata.disk_types AS meta_disk_types,
-          metadata.docker_image AS meta_docker_image,
-          metadata.end_time AS meta_end_time,
-          metadata.execution_status AS meta_execution_status,
-          metadata.inputs AS meta_inputs,
-          metadata.instance_name AS meta_instance_name,
-          metadata.mem_total_gb AS meta_mem_total_gb,
-          metadata.preemptible AS meta_preemptible,
-          metadata.project_id AS meta_project_id,
-          metadata.shard AS meta_shard,
-          metadata.start_time AS meta_start_time,
-          metadata.task_call_name AS meta_task_call_name,
-          metadata.workflow_id AS meta_workflow_id,
-          metadata.workflow_name AS meta_workflow_name,
-          metadata.zone AS meta_zone,
-          TIMESTAMP_DIFF(metadata.end_time, metadata.start_time, SECOND) meta_duration_sec
-
-        FROM
-          `{self.bq_goolge_project}.cromwell_monitoring.metadata` metadata
-
-        WHERE
-              DATE(metadata.start_time) >= DATE_SUB(CURRENT_DATE(), INTERVAL {self.days_back_upper_bound} DAY)
-          AND DATE(metadata.start_time) <= DATE_SUB(CURRENT_DATE(), INTERVAL {self.days_back_lower_bound} DAY)
-
-          AND metadata.workflow_id IN ({self.formated_workflow_ids})
-        """
+        metadata_sql = self.query_builder.metadata_query()
         try:
             logging.debug(f"Metadata SQL: {metadata_sql}")
-            self.metadata = self.bq_client.query(query=metadata_sql).to_dataframe()
+            self.metadata = self._run_query(
+                metadata_sql,
+                query_parameters=[workflow_ids_parameter(self.workflow_ids)]
+                + self._window_parameters(),
+                read_cache=read_cache,
+                query_name="metadata",
+            )
             self.logger.info("Fetched metadata table")
 
-        except NotFound as e:
+        except api_exceptions.NotFound as e:
             # Todo: add a fiss function that attempts to fetch the metadata table again
             log.handle_bq_warning(
                 err=e,
@@ -232,52 +786,63 @@ class QueryBQToMonitor:
             )
             # create empty metadata dataframe
             self.metadata = pd.DataFrame({column: [] for column in METADATA_COLUMNS})
-            self.metadata = self.metadata.astype(METADATA_COLUMNS_TYPES)
+            self.metadata = convert_dtype_backend(
+                self.metadata.astype(METADATA_COLUMNS_TYPES), self.dtype_backend
+            )
 
         self.logger.debug(f"Metadata table shape: {self.metadata.shape}")
 
     def _get_metrics(self):
 
         # Log start time
-        start_time = datetime.datetime.now().strftime("%H:%M:%S")
-        self.logger.info(f"Started querying metrics on {start_time}.")
-
-        # Retrieve instance IDs and set up parameters
-        instance_ids = list(self.runtime.runtime_instance_id.unique())
-        num_threads = 8  # Number of threads for concurrent processing
-        batch_size = len(instance_ids) // num_threads
-
-        # Split instance IDs into pools for concurrent processing
-        ids_pool = {
-            i: (
-                instance_ids[i * batch_size : (i + 1) * batch_size]
-                if i < num_threads
-                else instance_ids[i * batch_size :]
-            )
-            for i in range(num_threads + 1)
-        }
-
-        # Submit jobs to ThreadPoolExecutor for fetching metrics
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            jobs_pool = {
-                i: executor.submit(self._fetch_metrics_on_vms_batch, ids_pool[i])
-                for i in range(num_threads + 1)
-            }
-
-        # Collect results from jobs
-        results_pool = {i: jobs_pool[i].result() for i in range(num_threads + 1)}
-
-        current_time = datetime.datetime.now()
-        finish_time = current_time.strftime("%H:%M:%S")
-        pf = current_time - datetime.datetime.strptime(start_time, "%H:%M:%S")
-        s = pf.seconds
-        hours, remainder = divmod(s, 3600)
+        start_time = datetime.datetime.now()
+        started = time.perf_counter()
+        self.logger.info(f"Started querying metrics on {start_time:%H:%M:%S}.")
+        first_job = len(self.job_stats)
+
+        runtime = self.runtime
+        checkpointed_metrics = pd.DataFrame()
+        if self.checkpoint_dir:
+            self.checkpoint = self._open_checkpoint()
+            finished_ids = self.checkpoint.finished_instance_ids()
+            if finished_ids:
+                checkpointed_metrics = self.checkpoint.load_metrics(
+                    dtype_backend=self.dtype_backend
+                )
+                runtime = runtime[~runtime.runtime_instance_id.isin(finished_ids)]
+                self.logger.info(
+                    f"Resuming from the checkpoint in {self.checkpoint_dir}: "
+                    f"loaded the metrics of {len(finished_ids)} instances."
+                )
+        if self.metrics_dataset is not None and checkpointed_metrics.empty:
+            # The parts of a previous query would be read along the new ones
+            self.metrics_dataset.clear()
+
+        self.metrics, failed_instance_ids = self._fetch_metrics_in_batches(
+            runtime, checkpoint=self.checkpoint
+        )
+        if not checkpointed_metrics.empty:
+            self.metrics = pd.concat(
+                [checkpointed_metrics, self.metrics], ignore_index=True
+            )
+        self._reconcile_metrics(failed_instance_ids)
+        if self.checkpoint is not None:
+            if self.metrics_completeness.status.eq("failed").any():
+                self.logger.info(
+                    f"Keeping the checkpoint in {self.checkpoint_dir}, querying again "
+                    f"only fetches the metrics of the failed instances."
+                )
+            else:
+                self.checkpoint.clear()
+
+        hours, remainder = divmod(int(time.perf_counter() - started), 3600)
         minutes, seconds = divmod(remainder, 60)
-        elapse = "{:02}:{:02}:{:02}".format(int(hours), int(minutes), int(seconds))
-        self.logger.info(f"Finished on {finish_time}.")
+        elapse = "{:02}:{:02}:{:02}".format(hours, minutes, seconds)
+        self.logger.info(f"Finished on {datetime.datetime.now():%H:%M:%S}.")
         self.logger.info(f"Totalling {elapse}.")
-
-        self.metrics = pd.concat(list(results_pool.values()))
+        self.logger.info(
+            f"Metrics queries: {JobStatsReport(self.job_stats.jobs[first_job:])}."
+        )
 
         # QC
         # Error if metrics is empty
@@ -288,55 +853,566 @@ class QueryBQToMonitor:
             )
             return
         # Warning if there are missing metrics
-        retries = 0
-        d = set(self.metadata_runtime.runtime_instance_id.unique()) - set(
-            self.metrics.metrics_instance_id.unique()
-        )
-        while (not d) and 10 > retries:
-            self.logger.info(f"Retrieving metrics info on leftovers: {d}")
-            left_over = self._fetch_metrics_on_vms_batch(d)
-            if not left_over.empty:
-                self.metrics = pd.concat([self.metrics, left_over], axis=0)
-            d = set(self.metadata_runtime.runtime_instance_id.unique()) - set(
-                self.metrics.metrics_instance_id.unique()
-            )
-            retries += 1
-        if 0 != d:
+        missing = self.metrics_completeness[
+            self.metrics_completeness.status.isin(["missing", "failed"])
+        ]
+        if not missing.empty:
             self.logger.warning(
-                f"Not all VMs provisioned have their metrics sent over ({d} didn't)."
+                f"Not all VMs provisioned have their metrics sent over "
+                f"({missing.instance_id.tolist()} didn't)."
+            )
+
+    def _open_checkpoint(self):
+        """
+        Opens the checkpoint of the metrics query of the session, discarding the
+        checkpoint of a different query left in checkpoint_dir
+        @return: MetricsCheckpoint
+        """
+        metrics_sql, query_parameters = self._metrics_query_of_mode(self.metrics_mode)
+        session_key = query_fingerprint(
+            project=self.bq_goolge_project,
+            workflow_ids=self.workflow_ids,
+            start_time=self.start_time,
+            end_time=self.end_time,
+            sql=metrics_sql,
+            query_parameters=query_parameters,
+        )
+        # Streamed batches only keep the key columns of the metrics
+        if self.metrics_dataset is not None:
+            session_key = f"{session_key}-streamed"
+        return MetricsCheckpoint(
+            checkpoint_dir=self.checkpoint_dir, session_key=session_key
+        )
+
+    def _reconcile_metrics(self, failed_instance_ids=()):
+        """
+        Fetches again the metrics of the VMs of the runtime table missing from the
+        metrics, with at most max_concurrent_refetches queries at a time, then
+        reports the completeness of the metrics of every VM in
+        self.metrics_completeness. Attempts back off exponentially only while some
+        missing VMs are from failed batches.
+        @param failed_instance_ids: Ids of the VMs whose batch failed
+        @return:
+        """
+        refetch_attempts = pd.Series(dtype="int64")
+        backoffs = 0
+        for attempt in range(1, self.max_refetch_attempts + 1):
+            missing_ids = missing_instance_ids(self.runtime, self.metrics)
+            if not missing_ids:
+                break
+            # Only failed batches are worth waiting for, VMs of batches that
+            # succeeded without rows may never record any metrics
+            delay_sec = 0.0
+            if set(failed_instance_ids).intersection(missing_ids):
+                backoffs += 1
+                delay_sec = backoff_delay_sec(backoffs, self.refetch_backoff_sec)
+            self.logger.info(
+                f"Fetching again the metrics of {len(missing_ids)} instances in "
+                f"{delay_sec:.1f}s (attempt {attempt}/{self.max_refetch_attempts})."
+            )
+            if delay_sec > 0:
+                time.sleep(delay_sec)
+
+            refetched_metrics, failed_instance_ids = self._fetch_metrics_in_batches(
+                self.runtime[self.runtime.runtime_instance_id.isin(missing_ids)],
+                read_cache=False,
+                max_workers=self.max_concurrent_refetches,
+                checkpoint=self.checkpoint,
+            )
+            refetch_attempts = refetch_attempts.add(
+                pd.Series(1, index=missing_ids), fill_value=0
             )
+            if not refetched_metrics.empty:
+                self.metrics = pd.concat(
+                    [self.metrics, refetched_metrics], ignore_index=True
+                )
 
-    def _fetch_metrics_on_vms_batch(self, vm_instance_ids):
+        # Batches fetched again may return samples already fetched
+        self.metrics = deduplicate_metrics(self.metrics)
+        self.metrics_completeness = completeness_report(
+            runtime=self.runtime,
+            metrics=self.metrics,
+            refetch_attempts=refetch_attempts,
+            failed_instance_ids=failed_instance_ids,
+        )
+
+    def _metrics_batch_fetcher(self):
+        """
+        Gets the function fetching a batch of VMs in the metrics mode, the target size
+        of a batch and the interval between the rows of a VM.
+        @return:
+        """
+        # Summaries are small, so they are fetched with as few queries as possible.
+        # Buckets are sized like samples recorded every bucket_interval_sec.
+        if self.metrics_mode == "summary":
+            return self._fetch_metrics_summary_on_vms_batch, float("inf"), 1
+        if self.metrics_mode == "bucketed":
+            return (
+                self._fetch_metrics_bucketed_on_vms_batch,
+                self.target_batch_bytes,
+                self.bucket_interval_sec,
+            )
+        return self._fetch_metrics_on_vms_batch, self.target_batch_bytes, 1
+
+    def _fetch_metrics_in_batches(
+        self, runtime, since=None, read_cache=True, max_workers=None, checkpoint=None
+    ):
+        """
+        Fetches the metrics of the VMs of a runtime table in batches, using
+        num_threads threads. A failed batch is logged and its VMs are reported as
+        failed, so that they can be fetched again.
+        @param runtime: Runtime rows of the VMs
+        @param since: Only fetch the metrics recorded from this time on
+        @param read_cache: Whether cached results can be returned
+        @param max_workers: Number of threads, num_threads by default
+        @param checkpoint: MetricsCheckpoint recording the batches. Batches started
+        before an interruption are fetched again as they were, reusing their jobs.
+        @return: Dataframe of the metrics of every batch that succeeded and the
+        instance ids of the batches that failed
+        """
+        (
+            fetch_metrics_batch,
+            target_batch_bytes,
+            sample_interval_sec,
+        ) = self._metrics_batch_fetcher()
+        fetch_metrics_batch = functools.partial(
+            fetch_metrics_batch, read_cache=read_cache
+        )
+        if since is not None:
+            fetch_metrics_batch = functools.partial(fetch_metrics_batch, since=since)
+        max_workers = max_workers or self.num_threads
+
+        batches = []
+        if checkpoint is not None:
+            fetch_metrics_batch = functools.partial(
+                self._fetch_checkpointed_metrics_batch, fetch_metrics_batch, checkpoint
+            )
+            remaining_ids = set(runtime.runtime_instance_id.dropna())
+            for instance_ids in checkpoint.started_batches():
+                if remaining_ids.issuperset(instance_ids):
+                    batches.append(MetricsBatch(instance_ids=instance_ids))
+                    remaining_ids.difference_update(instance_ids)
+            runtime = runtime[runtime.runtime_instance_id.isin(remaining_ids)]
+
+        # Split the instances into batches sized from their estimated metrics volume.
+        batches += plan_metrics_batches(
+            runtime=runtime,
+            num_threads=max_workers,
+            target_batch_bytes=target_batch_bytes,
+            sample_interval_sec=sample_interval_sec,
+            time_padding=self.time_padding,
+        )
+        self.logger.info(
+            f"Fetching metrics of "
+            f"{sum(len(batch) for batch in batches)} instances in "
+            f"{len(batches)} batches."
+        )
+        self.logger.debug(f"Metrics batches: {batches}")
+
+        def fetch_attempt(attempt):
+            batch = attempt.batch
+            # VMs refreshed may have recorded past the end of their batch
+            time_bounds = (batch.start_time, batch.end_time if since is None else None)
+            # Jobs of the attempt are registered so they can be cancelled
+            with self.running_jobs.owned_by(attempt):
+                return fetch_metrics_batch(batch.instance_ids, time_bounds=time_bounds)
+
+        # The executor queues the batches, largest first, and each thread pulls the
+        # next batch as soon as it is done with its current one. Threads of batches
+        # abandoned past their deadline are not waited for.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            results_pool, failures = run_batches(
+                executor=executor,
+                fetch_batch=fetch_attempt,
+                batches=batches,
+                cancel=lambda attempt: self._cancel_jobs(
+                    self.running_jobs.pop(attempt)
+                ),
+                batch_timeout_sec=self.batch_timeout_sec,
+                hedge_after_sec=self.hedge_after_sec,
+                hedge_splits=self.hedge_splits,
+            )
+        except BaseException:
+            # e.g. KeyboardInterrupt, the jobs would keep running in BigQuery
+            self.cancel_running_jobs()
+            raise
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # Any error of a batch, from the API, the network or its deadline, only
+        # loses the batch, whose VMs are fetched again
+        failed_instance_ids = []
+        for batch, error in failures:
+            log.handle_bq_warning(
+                err=error,
+                message=f"Error fetching the metrics of {len(batch)} instances",
+            )
+            failed_instance_ids.extend(batch.instance_ids)
+        metrics = pd.concat(results_pool) if results_pool else pd.DataFrame()
+        return metrics, failed_instance_ids
+
+    def cancel_running_jobs(self):
+        """
+        Cancels the query jobs of the session still running, such as the jobs of
+        the batches being fetched when a query is interrupted
+        @return: Number of jobs cancelled
+        """
+        query_jobs = self.running_jobs.pop()
+        if query_jobs:
+            self.logger.warning(f"Cancelling {len(query_jobs)} running query jobs.")
+        self._cancel_jobs(query_jobs)
+        return len(query_jobs)
+
+    def _cancel_jobs(self, query_jobs):
+        """
+        Cancels query jobs in the backend, logging the jobs that could not be
+        @param query_jobs:
+        @return:
+        """
+        for query_job in query_jobs:
+            try:
+                self.backend.cancel_job(query_job)
+            except Exception as e:
+                log.handle_bq_warning(
+                    err=e,
+                    message=f"Could not cancel query job "
+                    f"{getattr(query_job, 'job_id', None)}",
+                )
+
+    @staticmethod
+    def _fetch_checkpointed_metrics_batch(
+        fetch_metrics_batch, checkpoint, vm_instance_ids, time_bounds=None
+    ):
+        """
+        Fetches the metrics of a batch of VMs, recording its query job and then its
+        metrics in a checkpoint
+        @param fetch_metrics_batch: Function fetching the metrics of a batch
+        @param checkpoint: MetricsCheckpoint
+        @param vm_instance_ids:
+        @param time_bounds: Start and end of the time range of the batch
+        @return:
+        """
+        checkpoint_batch = checkpoint.batch(vm_instance_ids)
+        metrics = fetch_metrics_batch(
+            vm_instance_ids, time_bounds=time_bounds, checkpoint_batch=checkpoint_batch
+        )
+        checkpoint_batch.finish(metrics)
+        return metrics
+
+    def _fetch_metrics_on_vms_batch(
+        self,
+        vm_instance_ids,
+        since=None,
+        read_cache=True,
+        checkpoint_batch=None,
+        time_bounds=None,
+    ):
         """
         Fetches metrics on a batch of VMs.
         @param vm_instance_ids:
+        @param since: Only fetch the metrics recorded from this time on
+        @param read_cache: Whether cached results can be returned
+        @param checkpoint_batch: CheckpointBatch recording the query job
+        @param time_bounds: Start and end of the time range of the batch, either
+        None for the bound of the window
+        @return:
+        """
+        # if vm_instance_ids is empty, return empty dataframe
+        if 0 == len(vm_instance_ids):
+            return pd.DataFrame()
+
+        metrics_sql = self.query_builder.metrics_query(since=since is not None)
+        logging.debug(f"Metrics SQL: {metrics_sql}")
+        # Reduce the per core and per disk arrays once, in the thread of the batch
+        return self._run_metrics_query(
+            metrics_sql,
+            query_parameters=self._metrics_parameters(
+                vm_instance_ids, since=since, time_bounds=time_bounds
+            ),
+            read_cache=read_cache,
+            query_name="raw metrics",
+            transform=add_sample_reductions,
+            checkpoint_batch=checkpoint_batch,
+        )
+
+    def _fetch_metrics_summary_on_vms_batch(
+        self, vm_instance_ids, read_cache=True, checkpoint_batch=None, time_bounds=None
+    ):
+        """
+        Fetches the resource usage summary of a batch of VMs, one row per VM.
+        @param vm_instance_ids:
+        @param read_cache: Whether cached results can be returned
+        @param checkpoint_batch: CheckpointBatch recording the query job
+        @param time_bounds: Start and end of the time range of the batch, either
+        None for the bound of the window
         @return:
         """
         # if vm_instance_ids is empty, return empty dataframe
         if 0 == len(vm_instance_ids):
             return pd.DataFrame()
 
-        ids_string = ", ".join(map(str, vm_instance_ids))
-        metrics_sql = f"""
+        metrics_summary_sql = self.query_builder.metrics_summary_query()
+        logging.debug(f"Metrics summary SQL: {metrics_summary_sql}")
+        return self._run_query(
+            metrics_summary_sql,
+            query_parameters=self._metrics_parameters(
+                vm_instance_ids, time_bounds=time_bounds
+            ),
+            read_cache=read_cache,
+            query_name="summary metrics",
+            checkpoint_batch=checkpoint_batch,
+        )
 
-        SELECT
+    def _fetch_metrics_bucketed_on_vms_batch(
+        self,
+        vm_instance_ids,
+        since=None,
+        read_cache=True,
+        checkpoint_batch=None,
+        time_bounds=None,
+    ):
+        """
+        Fetches the metrics of a batch of VMs downsampled to one row per VM and time
+        bucket of bucket_interval_sec seconds.
+        @param vm_instance_ids:
+        @param since: Only fetch the buckets from this time on
+        @param read_cache: Whether cached results can be returned
+        @param checkpoint_batch: CheckpointBatch recording the query job
+        @param time_bounds: Start and end of the time range of the batch, either
+        None for the bound of the window
+        @return:
+        """
+        # if vm_instance_ids is empty, return empty dataframe
+        if 0 == len(vm_instance_ids):
+            return pd.DataFrame()
 
-          metrics.cpu_used_percent AS metrics_cpu_used_percent,
-          metrics.disk_read_iops AS metrics_disk_read_iops,
-          metrics.disk_used_gb AS metrics_disk_used_gb,
-          metrics.disk_write_iops AS metrics_disk_write_iops,
-          metrics.instance_id AS metrics_instance_id,
-          metrics.mem_used_gb AS metrics_mem_used_gb,
-          metrics.timestamp AS metrics_timestamp
+        metrics_bucketed_sql = self.query_builder.metrics_bucketed_query(
+            since=since is not None
+        )
+        logging.debug(f"Metrics bucketed SQL: {metrics_bucketed_sql}")
+        return self._run_metrics_query(
+            metrics_bucketed_sql,
+            query_parameters=self._metrics_parameters(
+                vm_instance_ids, since=since, time_bounds=time_bounds
+            )
+            + [bucket_interval_parameter(self.bucket_interval_sec)],
+            read_cache=read_cache,
+            query_name="bucketed metrics",
+            checkpoint_batch=checkpoint_batch,
+        )
 
-        FROM
-          `{self.bq_goolge_project}.cromwell_monitoring.metrics`  metrics
+    def _time_window(self):
+        """
+        Resolves the time window to query, see the class documentation
+        @return: Start and end of the window, the end is excluded
+        """
+        if self.workflow_start_time is not None:
+            return workflow_time_window(
+                start_time=self.workflow_start_time,
+                end_time=self.workflow_end_time,
+                padding=self.time_padding,
+            )
+        return days_back_to_time_window(
+            days_back_upper_bound=self.days_back_upper_bound,
+            days_back_lower_bound=self.days_back_lower_bound,
+        )
 
-        WHERE
-          DATE(metrics.timestamp) >= DATE_SUB(CURRENT_DATE(), INTERVAL {self.days_back_upper_bound} DAY)
-          AND DATE(metrics.timestamp) <= DATE_SUB(CURRENT_DATE(), INTERVAL {self.days_back_lower_bound} DAY)
-          AND metrics.instance_id IN ({ids_string})
+    def _window_parameters(self, since=None, time_bounds=None):
+        """
+        Query parameters of the time window to query
+        @param since: Only query the window from this time on
+        @param time_bounds: Start and end of a range narrowing the window, such as
+        the time range of a metrics batch, either None for the bound of the window
+        @return:
+        """
+        start_time, end_time = self.start_time, self.end_time
+        start_bound, end_bound = time_bounds or (None, None)
+        for bound in (since, start_bound):
+            if bound is not None:
+                start_time = max(start_time, pd.Timestamp(bound).tz_convert("UTC"))
+        if end_bound is not None:
+            end_time = min(end_time, pd.Timestamp(end_bound).tz_convert("UTC"))
+        return time_window_parameters(start_time=start_time, end_time=end_time)
 
+    def _metrics_parameters(self, vm_instance_ids, since=None, time_bounds=None):
         """
-        logging.debug(f"Metrics SQL: {metrics_sql}")
-        return self.bq_client.query(metrics_sql).to_dataframe()
+        Query parameters selecting the metrics of a batch of VMs
+        @param vm_instance_ids:
+        @param since: Only select the metrics recorded from this time on
+        @param time_bounds: Start and end of the time range of the batch
+        @return:
+        """
+        query_parameters = [instance_ids_parameter(vm_instance_ids)]
+        if since is not None:
+            query_parameters.append(timestamp_parameter("metrics_since", since))
+        return query_parameters + self._window_parameters(
+            since=since, time_bounds=time_bounds
+        )
+
+    def _run_metrics_query(
+        self,
+        sql,
+        query_parameters=None,
+        read_cache=True,
+        query_name="metrics",
+        transform=None,
+        checkpoint_batch=None,
+    ):
+        """
+        Runs a query of metrics samples or buckets. When streaming, its results are
+        written to a part file of self.metrics_dataset as they are downloaded, and
+        only their key columns are returned.
+        @param sql: Query to run
+        @param query_parameters: Parameters referenced by the query
+        @param read_cache: Whether cached results can be returned, when not
+        streaming
+        @param query_name: Name of the query in self.job_stats
+        @param transform: Function applied to the results, such as adding columns
+        @param checkpoint_batch: CheckpointBatch recording the query job
+        @return: Dataframe of the results, or of their key columns when streaming
+        """
+        if self.metrics_dataset is None:
+            df = self._run_query(
+                sql,
+                query_parameters=query_parameters,
+                read_cache=read_cache,
+                query_name=query_name,
+                checkpoint_batch=checkpoint_batch,
+            )
+            return df if transform is None else transform(df)
+
+        stats = self.job_stats.add(
+            QueryJobStats(name=query_name, source=self.backend.name)
+        )
+        started = time.perf_counter()
+        query_job = None
+        try:
+            query_job = self._submit_query(
+                sql,
+                query_parameters=query_parameters,
+                stats=stats,
+                checkpoint_batch=checkpoint_batch,
+            )
+            download_started = time.perf_counter()
+            keys = self.metrics_dataset.write_part(
+                self.backend.to_record_batches(
+                    query_job, page_size=self.metrics_dataset.buffer_rows, stats=stats
+                ),
+                transform=transform,
+            )
+            # Pages are converted and written as they are downloaded
+            stats.download_sec = (
+                time.perf_counter() - download_started - (stats.wait_sec or 0)
+            )
+            stats.rows = len(keys)
+        except Exception as e:
+            stats.error = repr(e)
+            raise
+        finally:
+            if query_job is not None:
+                self.running_jobs.remove(query_job)
+            stats.total_sec = time.perf_counter() - started
+        return keys
+
+    def _run_query(
+        self,
+        sql,
+        query_parameters=None,
+        read_cache=True,
+        query_name="query",
+        checkpoint_batch=None,
+    ):
+        """
+        Runs a query in the backend and downloads its results. Results are read from
+        and written to the cache when one is set.
+        @param sql: Query to run
+        @param query_parameters: Parameters referenced by the query
+        @param read_cache: Whether cached results can be returned, results of the
+        query are cached either way
+        @param query_name: Name of the query in self.job_stats
+        @param checkpoint_batch: CheckpointBatch recording the query job
+        @return: Dataframe of the query results
+        """
+        stats = self.job_stats.add(QueryJobStats(name=query_name))
+        started = time.perf_counter()
+        query_job = None
+        try:
+            cache_key = None
+            if self.cache is not None:
+                cache_key = query_fingerprint(
+                    project=self.bq_goolge_project,
+                    workflow_ids=self.workflow_ids,
+                    start_time=self.start_time,
+                    end_time=self.end_time,
+                    sql=sql,
+                    query_parameters=query_parameters,
+                )
+                cached_df = (
+                    self.cache.get(cache_key, dtype_backend=self.dtype_backend)
+                    if read_cache
+                    else None
+                )
+                if cached_df is not None:
+                    self.logger.debug(
+                        f"Loaded query results from cache entry {cache_key}."
+                    )
+                    stats.source = "cache"
+                    stats.download_sec = time.perf_counter() - started
+                    stats.rows = len(cached_df)
+                    return cached_df
+
+            query_job = self._submit_query(
+                sql,
+                query_parameters=query_parameters,
+                stats=stats,
+                checkpoint_batch=checkpoint_batch,
+            )
+            df = self.backend.to_dataframe(
+                query_job, stats=stats, dtype_backend=self.dtype_backend
+            )
+
+            if cache_key is not None:
+                self.cache.put(cache_key, df)
+                self._cached_keys.append(cache_key)
+            return df
+        except Exception as e:
+            stats.error = repr(e)
+            raise
+        finally:
+            if query_job is not None:
+                self.running_jobs.remove(query_job)
+            stats.total_sec = time.perf_counter() - started
+
+    def _submit_query(self, sql, query_parameters, stats, checkpoint_batch=None):
+        """
+        Starts a query in the backend, labelled with the session id and the name of
+        the query, and registers its job in self.running_jobs until its results are
+        downloaded. The job of a checkpointed batch started by an interrupted
+        session is reused when its results are still available, and a new job is
+        recorded in the checkpoint.
+        @param sql: Query to run
+        @param query_parameters: Parameters referenced by the query
+        @param stats: QueryJobStats of the query
+        @param checkpoint_batch: CheckpointBatch recording the query job
+        @return: Query job
+        """
+        started = time.perf_counter()
+        query_job = None
+        previous_job = None if checkpoint_batch is None else checkpoint_batch.job
+        if previous_job is not None:
+            query_job = self.backend.get_job(**previous_job)
+            if query_job is not None:
+                self.logger.debug(f"Reusing query job {previous_job['job_id']}.")
+        if query_job is None:
+            query_job = self.backend.query(
+                sql,
+                query_parameters=query_parameters,
+                labels=job_labels(session_id=self.session_id, query_name=stats.name),
+            )
+            if checkpoint_batch is not None:
+                checkpoint_batch.start(query_job)
+        self.running_jobs.add(query_job)
+        stats.source = self.backend.name
+        stats.submit_sec = time.perf_counter() - started
+        return query_job
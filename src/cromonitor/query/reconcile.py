@@ -0,0 +1,115 @@
+"""
+This module contains functions to reconcile the metrics fetched for a workflow with
+its runtime table: find the VMs whose metrics are missing, because their batch
+failed or their metrics were not recorded yet, drop samples fetched twice, and
+report how complete the metrics of every VM are.
+"""
+
+from typing import Iterable, Optional
+
+import pandas as pd
+
+# Number of times the metrics of missing VMs are fetched again
+DEFAULT_MAX_REFETCH_ATTEMPTS = 3
+# Seconds to wait before the first refetch, doubled before each following one
+DEFAULT_REFETCH_BACKOFF_SEC = 2.0
+# Number of refetch queries running at the same time
+DEFAULT_MAX_CONCURRENT_REFETCHES = 4
+
+# complete: metrics fetched by the first query
+# refetched: metrics fetched by a refetch
+# missing: no metrics found for the VM, it may not have sent any
+# failed: the last refetch of the VM failed
+COMPLETENESS_STATUSES = ["complete", "refetched", "missing", "failed"]
+
+
+def backoff_delay_sec(attempt: int, backoff_sec: float) -> float:
+    """
+    Get the time to wait before a refetch attempt, doubling at each attempt
+    :param attempt: Number of the attempt, starting at 1
+    :param backoff_sec: Time to wait before the first attempt
+    :return:
+    """
+    return backoff_sec * 2 ** (attempt - 1)
+
+
+def missing_instance_ids(runtime: pd.DataFrame, metrics: pd.DataFrame) -> list:
+    """
+    Get the ids of the VMs of the runtime table without any metrics row
+    :param runtime: Runtime table as returned by QueryBQToMonitor
+    :param metrics: Metrics fetched so far
+    :return: Sorted instance ids
+    """
+    fetched_ids = set()
+    if "metrics_instance_id" in metrics.columns:
+        fetched_ids = set(metrics.metrics_instance_id.dropna().unique())
+    return sorted(set(runtime.runtime_instance_id.dropna().unique()) - fetched_ids)
+
+
+def deduplicate_metrics(metrics: pd.DataFrame) -> pd.DataFrame:
+    """
+    Drop the metrics rows fetched more than once, identified by their instance id
+    and, except for summaries, their timestamp
+    :param metrics: Metrics, raw samples, buckets or summaries
+    :return:
+    """
+    if metrics.empty:
+        return metrics
+    subset = [
+        column
+        for column in ["metrics_instance_id", "metrics_timestamp"]
+        if column in metrics.columns
+    ]
+    return metrics.drop_duplicates(subset=subset, keep="first").reset_index(drop=True)
+
+
+def completeness_report(
+    runtime: pd.DataFrame,
+    metrics: pd.DataFrame,
+    refetch_attempts: Optional[pd.Series] = None,
+    failed_instance_ids: Iterable = (),
+) -> pd.DataFrame:
+    """
+    Report how complete the metrics fetched for every VM of the runtime table are
+    :param runtime: Runtime table as returned by QueryBQToMonitor
+    :param metrics: Metrics fetched, raw samples, buckets or summaries
+    :param refetch_attempts: Number of refetches of each instance id
+    :param failed_instance_ids: Ids of the VMs whose last refetch failed
+    :return: Dataframe with one row per instance id: the duration the runtime table
+    reports metrics for, the number of metrics rows fetched, the duration they cover,
+    the number of refetches and a status from COMPLETENESS_STATUSES
+    """
+    report = pd.DataFrame(
+        {
+            "instance_id": runtime.runtime_instance_id.values,
+            "expected_duration_sec": runtime.metrics_duration_sec.values,
+        }
+    ).drop_duplicates("instance_id")
+
+    report["row_count"] = 0
+    report["fetched_duration_sec"] = float("nan")
+    if "metrics_instance_id" in metrics.columns:
+        rows = metrics.groupby("metrics_instance_id")
+        report["row_count"] = (
+            report.instance_id.map(rows.size()).fillna(0).astype("int64")
+        )
+        if "metrics_timestamp" in metrics.columns:
+            timestamps = rows.metrics_timestamp
+            report["fetched_duration_sec"] = report.instance_id.map(
+                (timestamps.max() - timestamps.min()).dt.total_seconds()
+            )
+
+    if refetch_attempts is None:
+        refetch_attempts = pd.Series(dtype="int64")
+    report["refetch_attempts"] = (
+        report.instance_id.map(refetch_attempts).fillna(0).astype("int64")
+    )
+
+    report["status"] = "complete"
+    report.loc[report.refetch_attempts > 0, "status"] = "refetched"
+    report.loc[report.row_count == 0, "status"] = "missing"
+    report.loc[
+        (report.row_count == 0) & report.instance_id.isin(list(failed_instance_ids)),
+        "status",
+    ] = "failed"
+    return report.reset_index(drop=True)
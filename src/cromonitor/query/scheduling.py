@@ -0,0 +1,279 @@
+"""
+This module contains the scheduling of the metrics batches of a QueryBQToMonitor
+around stragglers, batches whose query takes much longer than the others and holds
+back the whole report.
+
+Every query job started by a batch is registered in RunningJobs under the attempt
+running the batch, so the jobs of one batch, or of the whole session on a
+KeyboardInterrupt, can be cancelled in BigQuery. run_batches() waits for the
+batches with a deadline: a batch running longer than batch_timeout_sec is abandoned,
+its jobs are cancelled and its VMs reported as failed, to be fetched again. With
+hedge_after_sec, a batch still running after that time is re-issued split into
+smaller batches; whichever finishes first, the batch or all of its pieces, is kept,
+and the jobs of the other are cancelled.
+"""
+
+import concurrent.futures
+import contextlib
+import logging
+import re
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import pandas as pd
+
+from .batching import MetricsBatch
+
+# Number of batches a slow batch is split into when it is re-issued
+DEFAULT_HEDGE_SPLITS = 2
+# Seconds between two checks of the deadlines of the running batches
+POLL_INTERVAL_SEC = 0.5
+# Maximum length of the keys and values of BigQuery job labels
+MAX_LABEL_LENGTH = 63
+
+
+def job_labels(session_id: str, query_name: str) -> dict:
+    """
+    Create the labels of a query job, to find the jobs of a session in BigQuery.
+    Label values may only hold lowercase letters, digits, underscores and dashes.
+    :param session_id: Id of the QueryBQToMonitor session
+    :param query_name: Name of the query, such as raw metrics
+    :return:
+    """
+    labels = {"cromonitor-session": session_id, "cromonitor-query": query_name}
+    return {
+        key: re.sub(r"[^a-z0-9_-]", "-", str(value).lower())[:MAX_LABEL_LENGTH]
+        for key, value in labels.items()
+    }
+
+
+def split_batch(batch: MetricsBatch, splits: int) -> List[MetricsBatch]:
+    """
+    Split a batch into smaller batches of about the same size, over the same time
+    range. The instance ids are dealt in turn, so the largest VMs of a batch
+    ordered largest first end up in different pieces.
+    :param batch: Batch to split
+    :param splits: Number of batches to split it into
+    :return: Batches with at least one instance id each
+    """
+    splits = max(1, min(splits, len(batch)))
+    return [
+        MetricsBatch(
+            instance_ids=batch.instance_ids[index::splits],
+            estimated_rows=batch.estimated_rows // splits,
+            estimated_bytes=batch.estimated_bytes // splits,
+            start_time=batch.start_time,
+            end_time=batch.end_time,
+        )
+        for index in range(splits)
+    ]
+
+
+class RunningJobs:
+    """
+    Query jobs still running, by the owner they were started for, such as the
+    attempt at a batch. The owner is set for the thread starting the jobs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._jobs = {}
+
+    @contextlib.contextmanager
+    def owned_by(self, owner):
+        """
+        Register the jobs started by the current thread under an owner
+        :param owner: Owner of the jobs
+        :return:
+        """
+        previous = getattr(self._local, "owner", None)
+        self._local.owner = owner
+        try:
+            yield
+        finally:
+            self._local.owner = previous
+
+    def add(self, query_job):
+        """
+        Register a job started by the current thread
+        :param query_job: Query job
+        :return:
+        """
+        owner = getattr(self._local, "owner", None)
+        with self._lock:
+            self._jobs[id(query_job)] = (owner, query_job)
+
+    def remove(self, query_job):
+        """
+        Unregister a job whose results are downloaded
+        :param query_job: Query job
+        :return:
+        """
+        with self._lock:
+            self._jobs.pop(id(query_job), None)
+
+    def pop(self, owner=None) -> list:
+        """
+        Unregister and get the jobs of an owner, or every job
+        :param owner: Owner of the jobs, every owner if None
+        :return: Query jobs
+        """
+        with self._lock:
+            keys = [
+                key
+                for key, (job_owner, _) in self._jobs.items()
+                if owner is None or job_owner is owner
+            ]
+            return [self._jobs.pop(key)[1] for key in keys]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+
+class BatchAttempt:
+    """
+    A run of a batch in the thread pool: a planned batch or a piece of a hedged one
+    """
+
+    def __init__(self, batch: MetricsBatch):
+        self.batch: MetricsBatch = batch
+        self.future: Optional[concurrent.futures.Future] = None
+        # time.monotonic() when a thread started the attempt
+        self.started: Optional[float] = None
+        self.hedges: Optional[List["BatchAttempt"]] = None
+
+    def succeeded(self) -> bool:
+        return (
+            self.future.done()
+            and not self.future.cancelled()
+            and self.future.exception() is None
+        )
+
+    def failed(self) -> bool:
+        return self.future.done() and not self.succeeded()
+
+    def error(self) -> BaseException:
+        if self.future.cancelled():
+            return concurrent.futures.CancelledError()
+        return self.future.exception()
+
+
+def run_batches(
+    executor: concurrent.futures.Executor,
+    fetch_batch: Callable[[BatchAttempt], pd.DataFrame],
+    batches: List[MetricsBatch],
+    cancel: Callable[[BatchAttempt], None],
+    batch_timeout_sec: Optional[float] = None,
+    hedge_after_sec: Optional[float] = None,
+    hedge_splits: int = DEFAULT_HEDGE_SPLITS,
+) -> Tuple[List[pd.DataFrame], List[Tuple[MetricsBatch, BaseException]]]:
+    """
+    Fetch batches in a thread pool, abandoning the batches past their deadline and
+    re-issuing the slow ones split into smaller batches. Threads of abandoned
+    attempts are not waited for, their jobs are cancelled so they end early.
+    :param executor: Thread pool running the batches
+    :param fetch_batch: Function fetching the metrics of the batch of an attempt,
+    run in a thread of the pool
+    :param batches: Batches to fetch, submitted in this order
+    :param cancel: Function cancelling the jobs of an attempt
+    :param batch_timeout_sec: Seconds a batch may run for before it is abandoned,
+    counted from when a thread starts it, no deadline if None
+    :param hedge_after_sec: Seconds after which a running batch is re-issued split
+    into hedge_splits batches, never if None
+    :param hedge_splits: Number of batches a slow batch is split into
+    :return: Metrics of the batches that succeeded, in the order of the batches,
+    and the batches that failed with their error
+    """
+
+    def run(attempt: BatchAttempt) -> pd.DataFrame:
+        attempt.started = time.monotonic()
+        return fetch_batch(attempt)
+
+    def submit(batch: MetricsBatch) -> BatchAttempt:
+        attempt = BatchAttempt(batch)
+        attempt.future = executor.submit(run, attempt)
+        return attempt
+
+    def abandon(attempts: List[BatchAttempt]):
+        for attempt in attempts:
+            if not attempt.future.cancel() and not attempt.future.done():
+                cancel(attempt)
+
+    attempts = [submit(batch) for batch in batches]
+    results = {}
+    failures = []
+    pending = list(attempts)
+    has_deadlines = batch_timeout_sec is not None or hedge_after_sec is not None
+    while pending:
+        running = [
+            attempt.future
+            for top in pending
+            for attempt in [top] + (top.hedges or [])
+            if not attempt.future.done()
+        ]
+        concurrent.futures.wait(
+            running,
+            timeout=POLL_INTERVAL_SEC if has_deadlines else None,
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        now = time.monotonic()
+        still_pending = []
+        for attempt in pending:
+            hedges = attempt.hedges or []
+            if attempt.succeeded():
+                abandon(hedges)
+                results[id(attempt)] = attempt.future.result()
+            elif hedges and all(hedge.succeeded() for hedge in hedges):
+                logging.info(
+                    f"Pieces of the slow batch of {len(attempt.batch)} instances "
+                    f"finished first."
+                )
+                abandon([attempt])
+                results[id(attempt)] = pd.concat(
+                    [hedge.future.result() for hedge in hedges]
+                )
+            elif attempt.failed() and (
+                not hedges or any(hedge.failed() for hedge in hedges)
+            ):
+                abandon(hedges)
+                failures.append((attempt.batch, attempt.error()))
+            elif (
+                batch_timeout_sec is not None
+                and attempt.started is not None
+                and now - attempt.started > batch_timeout_sec
+            ):
+                abandon([attempt] + hedges)
+                failures.append(
+                    (
+                        attempt.batch,
+                        TimeoutError(
+                            f"Batch of {len(attempt.batch)} instances did not "
+                            f"finish within {batch_timeout_sec}s"
+                        ),
+                    )
+                )
+            else:
+                if (
+                    hedge_after_sec is not None
+                    and attempt.hedges is None
+                    and attempt.started is not None
+                    and not attempt.future.done()
+                    and len(attempt.batch) > 1
+                    and now - attempt.started > hedge_after_sec
+                ):
+                    pieces = split_batch(attempt.batch, hedge_splits)
+                    logging.info(
+                        f"Batch of {len(attempt.batch)} instances still running "
+                        f"after {hedge_after_sec}s, re-issuing it as {len(pieces)} "
+                        f"batches."
+                    )
+                    attempt.hedges = [submit(piece) for piece in pieces]
+                still_pending.append(attempt)
+        pending = still_pending
+
+    return [
+        results[id(attempt)] for attempt in attempts if id(attempt) in results
+    ], failures
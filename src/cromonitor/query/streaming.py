@@ -0,0 +1,215 @@
+"""
+This module contains the on-disk metrics of a streaming QueryBQToMonitor.
+
+Instead of holding the results of every metrics batch in memory and concatenating
+them, each batch is downloaded page by page and written to its own Parquet part file
+in a directory, with at most buffer_rows rows held in memory at a time. A part file
+is renamed into place only once its query is fully downloaded, so the parts of
+failed batches never become visible. The metrics are then read lazily from the
+parts, filtered by VM and time, and only the instance ids and timestamps of the
+samples are kept in memory, to reconcile them with the runtime table.
+"""
+
+import glob
+import os
+import uuid
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .utils import and_expressions, arrow_table_to_dataframe, to_utc_timestamp
+
+# Rows of a metrics query held in memory before they are written as a row group
+DEFAULT_STREAM_BUFFER_ROWS = 50_000
+
+# Columns of the metrics kept in memory to reconcile them with the runtime table
+METRICS_KEY_COLUMNS = ["metrics_instance_id", "metrics_timestamp"]
+
+
+class StreamedMetrics:
+    """
+    Metrics written as Parquet part files to metrics_dir, one part per query. It is
+    safe to write parts from the threads fetching the metrics batches.
+    """
+
+    def __init__(
+        self,
+        metrics_dir: str,
+        buffer_rows: int = DEFAULT_STREAM_BUFFER_ROWS,
+        dtype_backend: str = "numpy",
+    ):
+        """
+        :param metrics_dir: Directory of the part files, created if missing
+        :param buffer_rows: Maximum number of rows held in memory per query
+        :param dtype_backend: Dtypes of the dataframes read, numpy or pyarrow (see
+        utils.DTYPE_BACKENDS)
+        """
+        self.metrics_dir: str = metrics_dir
+        self.buffer_rows: int = buffer_rows
+        self.dtype_backend: str = dtype_backend
+        os.makedirs(metrics_dir, exist_ok=True)
+
+    def _to_dataframe(self, table: pa.Table) -> pd.DataFrame:
+        return arrow_table_to_dataframe(table, dtype_backend=self.dtype_backend)
+
+    def parts(self) -> List[str]:
+        """
+        Get the paths of the part files written so far
+        :return:
+        """
+        return sorted(glob.glob(os.path.join(self.metrics_dir, "part-*.parquet")))
+
+    def clear(self):
+        """
+        Remove every part file
+        :return:
+        """
+        for path in self.parts():
+            os.remove(path)
+
+    def write_part(
+        self,
+        record_batches: Iterable[pa.RecordBatch],
+        transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+    ) -> pd.DataFrame:
+        """
+        Write the results of a query to a new part file as they are downloaded.
+        Batches are buffered up to buffer_rows rows, then written as a row group.
+        :param record_batches: Record batches of the query results
+        :param transform: Function applied to the rows of each row group before
+        writing them, such as adding columns
+        :return: Key columns (METRICS_KEY_COLUMNS) of the rows written
+        """
+        path = os.path.join(self.metrics_dir, f"part-{uuid.uuid4().hex}.parquet")
+        tmp_path = f"{path}.tmp"
+        writer = None
+        buffer = []
+        buffered_rows = 0
+        keys = []
+
+        def flush():
+            nonlocal writer
+            table = pa.Table.from_batches(buffer)
+            if transform is not None:
+                table = pa.Table.from_pandas(
+                    transform(self._to_dataframe(table)), preserve_index=False
+                )
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            else:
+                # e.g. a column without values in the first row group
+                table = table.cast(writer.schema)
+            writer.write_table(table)
+            keys.append(
+                table.select(
+                    [name for name in METRICS_KEY_COLUMNS if name in table.column_names]
+                )
+            )
+            buffer.clear()
+
+        try:
+            for batch in record_batches:
+                if not batch.num_rows:
+                    continue
+                buffer.append(batch)
+                buffered_rows += batch.num_rows
+                if buffered_rows >= self.buffer_rows:
+                    flush()
+                    buffered_rows = 0
+            if buffer:
+                flush()
+        except BaseException:
+            if writer is not None:
+                writer.close()
+                os.remove(tmp_path)
+            raise
+
+        if writer is None:
+            return pd.DataFrame(columns=METRICS_KEY_COLUMNS)
+        writer.close()
+        os.replace(tmp_path, path)
+        return self._to_dataframe(pa.concat_tables(keys))
+
+    @property
+    def dataset(self) -> ds.Dataset:
+        """
+        Dataset of the part files written so far
+        """
+        return ds.dataset(self.parts(), format="parquet")
+
+    def count_rows(self) -> int:
+        """
+        Get the number of rows of every part, from the Parquet footers
+        :return:
+        """
+        return self.dataset.count_rows() if self.parts() else 0
+
+    @staticmethod
+    def _filter(
+        instance_ids: Optional[Iterable[int]] = None, start_time=None, end_time=None
+    ) -> Optional[ds.Expression]:
+        conditions = []
+        if instance_ids is not None:
+            conditions.append(
+                ds.field("metrics_instance_id").isin([int(i) for i in instance_ids])
+            )
+        if start_time is not None:
+            conditions.append(
+                ds.field("metrics_timestamp") >= to_utc_timestamp(start_time)
+            )
+        if end_time is not None:
+            conditions.append(
+                ds.field("metrics_timestamp") < to_utc_timestamp(end_time)
+            )
+
+        return and_expressions(conditions)
+
+    def read(
+        self,
+        instance_ids: Optional[Iterable[int]] = None,
+        start_time=None,
+        end_time=None,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Read the metrics matching filters, such as the VMs of a task. Samples written
+        twice, by overlapping refreshes, are read once.
+        :param instance_ids: Ids of the VMs to read, every VM if None
+        :param start_time: Only read the samples from this time on
+        :param end_time: Only read the samples before this time
+        :param columns: Columns to read, every column if None
+        :return:
+        """
+        if not self.parts():
+            return pd.DataFrame(columns=columns or METRICS_KEY_COLUMNS)
+        table = self.dataset.to_table(
+            columns=columns,
+            filter=self._filter(
+                instance_ids=instance_ids, start_time=start_time, end_time=end_time
+            ),
+        )
+        metrics = self._to_dataframe(table)
+        subset = [column for column in METRICS_KEY_COLUMNS if column in metrics]
+        if len(subset) == len(METRICS_KEY_COLUMNS):
+            metrics = metrics.drop_duplicates(subset=subset, keep="last")
+        return metrics.reset_index(drop=True)
+
+    def iter_batches(
+        self,
+        columns: Optional[List[str]] = None,
+        batch_size: int = DEFAULT_STREAM_BUFFER_ROWS,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Iterate over the metrics of every part, batch_size rows at a time
+        :param columns: Columns to read, every column if None
+        :param batch_size: Maximum number of rows of a dataframe
+        :return:
+        """
+        if not self.parts():
+            return
+        for batch in self.dataset.to_batches(columns=columns, batch_size=batch_size):
+            if batch.num_rows:
+                yield self._to_dataframe(pa.Table.from_batches([batch]))
@@ -28,6 +28,37 @@ METRICS_SCHEMA = [
     SchemaField(name="disk_write_iops", field_type="FLOAT", mode="REPEATED"),
 ]
 
+METADATA_SCHEMA = [
+    SchemaField(name="project_id", field_type="STRING", mode="REQUIRED"),
+    SchemaField(name="zone", field_type="STRING", mode="REQUIRED"),
+    SchemaField(name="instance_name", field_type="STRING", mode="REQUIRED"),
+    SchemaField(name="preemptible", field_type="BOOLEAN", mode="REQUIRED"),
+    SchemaField(name="workflow_name", field_type="STRING", mode="REQUIRED"),
+    SchemaField(name="workflow_id", field_type="STRING", mode="REQUIRED"),
+    SchemaField(name="task_call_name", field_type="STRING", mode="REQUIRED"),
+    SchemaField(name="shard", field_type="INTEGER", mode="REQUIRED"),
+    SchemaField(name="attempt", field_type="INTEGER", mode="REQUIRED"),
+    SchemaField(name="start_time", field_type="TIMESTAMP", mode="REQUIRED"),
+    SchemaField(name="end_time", field_type="TIMESTAMP", mode="NULLABLE"),
+    SchemaField(name="execution_status", field_type="STRING", mode="REQUIRED"),
+    SchemaField(name="cpu_count", field_type="INTEGER", mode="REQUIRED"),
+    SchemaField(name="mem_total_gb", field_type="FLOAT", mode="REQUIRED"),
+    SchemaField(name="disk_mounts", field_type="STRING", mode="REPEATED"),
+    SchemaField(name="disk_total_gb", field_type="INTEGER", mode="REPEATED"),
+    SchemaField(name="disk_types", field_type="STRING", mode="REPEATED"),
+    SchemaField(name="docker_image", field_type="STRING", mode="NULLABLE"),
+    SchemaField(
+        name="inputs",
+        field_type="RECORD",
+        mode="REPEATED",
+        fields=(
+            SchemaField(name="key", field_type="STRING", mode="REQUIRED"),
+            SchemaField(name="type", field_type="STRING", mode="REQUIRED"),
+            SchemaField(name="value", field_type="STRING", mode="NULLABLE"),
+        ),
+    ),
+]
+
 TERRA_GCP_BILLING_SCHEMA = [
     SchemaField(
         name="billing_account_id",
@@ -1,10 +1,20 @@
+from __future__ import annotations
+
 import copy
+import time
+from typing import Iterable, Optional
 
-from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
+import db_dtypes
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
+from cromonitor.lazy import lazy_import
 from cromonitor.logging import logging as log
 
+bigquery = lazy_import("google.cloud.bigquery")
+google_exceptions = lazy_import("google.cloud.exceptions")
+
 
 def check_bq_query_for_errors(query_job: bigquery.QueryJob) -> None:
     """
@@ -99,12 +109,22 @@ def bq_query_cost_calculation(
         query=query, bq_client=bq_client, job_config=job_config
     )
 
+    return bytes_to_query_cost(
+        bytes_processed=bytes_processed, bq_ondemand_cost=bq_ondemand_cost
+    )
+
+
+def bytes_to_query_cost(bytes_processed: int, bq_ondemand_cost: float = 6.25) -> float:
+    """
+    Calculate the cost of a query processing a number of bytes
+    :param bytes_processed: Bytes processed by the query
+    :param bq_ondemand_cost: Cost of processing a TB
+    :return:
+    """
     # On-demand pricing here: https://cloud.google.com/bigquery/pricing#on_demand_pricing
     # ~$6 per TB for on-demand pricing
     # get the cost of running the query
-    cost = bytes_processed / (1024 * 1024 * 1024 * 1024) * bq_ondemand_cost
-
-    return cost
+    return bytes_processed / (1024 * 1024 * 1024 * 1024) * bq_ondemand_cost
 
 
 # check table schema (utility function)
@@ -129,6 +149,31 @@ def check_bq_table_schema(
         )
 
 
+def to_utc_timestamp(value) -> pd.Timestamp:
+    """
+    Convert a time to a UTC timestamp
+    :param value: Time, timezone naive values are taken as UTC
+    :return:
+    """
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        return timestamp.tz_localize("UTC")
+    return timestamp.tz_convert("UTC")
+
+
+def and_expressions(conditions: Iterable[pc.Expression]) -> Optional[pc.Expression]:
+    """
+    Combine the conditions of a filter, such as the filters of reads of Parquet
+    datasets, into one expression
+    :param conditions: Arrow expressions
+    :return: Conjunction of the conditions, None if there are none
+    """
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
 def construct_bq_table_id(project_id: str, dataset_name: str, table_name: str) -> str:
     """
     Create the table id for bigquery
@@ -150,7 +195,7 @@ def check_bq_table_exists(bq_client: bigquery.Client, table_id: str) -> None:
 
     try:
         bq_client.get_table(table_id)  # Make an API request.
-    except NotFound as e:
+    except google_exceptions.NotFound as e:
         log.handle_bq_error(err=e, message="Table is not found.")
 
 
@@ -161,3 +206,295 @@ def get_project_id_from_table_id(table_id: str) -> str:
     :return:
     """
     return table_id.split(".")[0]
+
+
+def create_bqstorage_client(credentials=None):
+    """
+    Create a BigQuery Storage read client used to download query results
+    through the Storage Read API.
+    :param credentials: Credentials shared with the BigQuery client
+    :return: BigQueryReadClient or None if google-cloud-bigquery-storage is missing
+    """
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError as e:
+        log.handle_bq_warning(
+            err=e,
+            message="google-cloud-bigquery-storage is not installed, "
+            "falling back to the REST API to download query results.",
+        )
+        return None
+
+    return bigquery_storage.BigQueryReadClient(credentials=credentials)
+
+
+def arrow_types_mapper(arrow_type: pa.DataType):
+    """
+    Map Arrow types to the pandas dtypes used by RowIterator.to_dataframe, so frames
+    built from Arrow record batches match frames downloaded with the REST API.
+    :param arrow_type: Arrow type of a column
+    :return: pandas dtype or None to use the pyarrow default
+    """
+    if pa.types.is_boolean(arrow_type):
+        return pd.BooleanDtype()
+    if pa.types.is_int64(arrow_type):
+        return pd.Int64Dtype()
+    if pa.types.is_date32(arrow_type):
+        return db_dtypes.DateDtype()
+    return None
+
+
+# Backends of the dtypes of query results, as in pandas.read_parquet:
+# numpy: NumPy and pandas nullable dtypes, with lists and strings as Python objects
+# pyarrow: pd.ArrowDtype columns, with repeated labels dictionary encoded as
+# categoricals
+DTYPE_BACKENDS = ["numpy", "pyarrow"]
+
+# Labels repeated on many rows, dictionary encoded by the pyarrow dtype backend.
+# Columns are named after them with the prefix of their table (runtime_, meta_).
+DICTIONARY_ENCODED_LABELS = {
+    "project_id",
+    "zone",
+    "workflow_id",
+    "workflow_name",
+    "task_call_name",
+    "cpu_platform",
+    "execution_status",
+    "docker_image",
+}
+
+
+def pyarrow_types_mapper(arrow_type: pa.DataType):
+    """
+    Map Arrow types to pd.ArrowDtype, so columns keep their Arrow buffers instead of
+    being converted to Python objects. Dictionary encoded columns are mapped to
+    pandas categoricals, which hold the same codes and dictionary.
+    :param arrow_type: Arrow type of a column
+    :return: pandas dtype or None to use the pyarrow default
+    """
+    if pa.types.is_dictionary(arrow_type):
+        return None
+    return pd.ArrowDtype(arrow_type)
+
+
+def dictionary_encode_labels(arrow_table: pa.Table) -> pa.Table:
+    """
+    Dictionary encode the string columns of a table holding labels, such as
+    workflow ids and task names, which repeat the same few values on many rows.
+    Other strings, such as times of the metadata table, are left as strings.
+    :param arrow_table: Arrow table
+    :return:
+    """
+    for index, field in enumerate(arrow_table.schema):
+        is_string = pa.types.is_string(field.type) or pa.types.is_large_string(
+            field.type
+        )
+        if is_string and field.name.split("_", 1)[-1] in DICTIONARY_ENCODED_LABELS:
+            arrow_table = arrow_table.set_column(
+                index, field.name, arrow_table.column(index).dictionary_encode()
+            )
+    return arrow_table
+
+
+def arrow_table_to_dataframe(
+    arrow_table: pa.Table, dtype_backend: str = "numpy", self_destruct: bool = False
+) -> pd.DataFrame:
+    """
+    Convert an Arrow table to a dataframe with the dtypes of a backend
+    :param arrow_table: Arrow table
+    :param dtype_backend: numpy or pyarrow, see DTYPE_BACKENDS
+    :param self_destruct: Whether to release the buffers of the table while it is
+    converted, the table can not be used afterwards
+    :return:
+    """
+    if dtype_backend not in DTYPE_BACKENDS:
+        raise ValueError(
+            f"Unknown dtype_backend {dtype_backend}, expected one of {DTYPE_BACKENDS}"
+        )
+    if dtype_backend == "pyarrow":
+        # pandas can not parse the names of some Arrow dtypes, such as lists, that
+        # it records in the metadata of tables built from dataframes
+        arrow_table = dictionary_encode_labels(
+            arrow_table.replace_schema_metadata(None)
+        )
+        types_mapper = pyarrow_types_mapper
+    else:
+        types_mapper = arrow_types_mapper
+    return arrow_table.to_pandas(
+        types_mapper=types_mapper, split_blocks=True, self_destruct=self_destruct
+    )
+
+
+def convert_dtype_backend(dataframe: pd.DataFrame, dtype_backend: str) -> pd.DataFrame:
+    """
+    Convert a dataframe built outside of the Arrow conversion, such as an empty
+    frame or the results of a local backend, to the dtypes of a backend
+    :param dataframe: Dataframe
+    :param dtype_backend: numpy or pyarrow, see DTYPE_BACKENDS
+    :return:
+    """
+    if dtype_backend == "numpy":
+        return dataframe
+    return arrow_table_to_dataframe(
+        pa.Table.from_pandas(dataframe, preserve_index=False),
+        dtype_backend=dtype_backend,
+    )
+
+
+def nullable_int_dtype(dtype_backend: str):
+    """
+    Get the nullable integer dtype of a backend
+    :param dtype_backend: numpy or pyarrow, see DTYPE_BACKENDS
+    :return:
+    """
+    return pd.ArrowDtype(pa.int64()) if dtype_backend == "pyarrow" else "Int64"
+
+
+BIGQUERY_TO_ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INTEGER": pa.int64(),
+    "INT64": pa.int64(),
+    "FLOAT": pa.float64(),
+    "FLOAT64": pa.float64(),
+    "NUMERIC": pa.decimal128(38, 9),
+    "BOOLEAN": pa.bool_(),
+    "BOOL": pa.bool_(),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+    "DATETIME": pa.timestamp("us"),
+    "DATE": pa.date32(),
+    "TIME": pa.time64("us"),
+    "BYTES": pa.binary(),
+    "JSON": pa.string(),
+}
+
+
+def schema_field_to_arrow_type(field: bigquery.SchemaField) -> pa.DataType:
+    """
+    Get the Arrow type of a BigQuery schema field
+    :param field: BigQuery schema field
+    :return:
+    """
+    if field.field_type in ("RECORD", "STRUCT"):
+        arrow_type = pa.struct(
+            [
+                pa.field(member.name, schema_field_to_arrow_type(member))
+                for member in field.fields
+            ]
+        )
+    else:
+        arrow_type = BIGQUERY_TO_ARROW_TYPES[field.field_type]
+    if field.mode == "REPEATED":
+        arrow_type = pa.list_(arrow_type)
+    return arrow_type
+
+
+def bq_schema_to_arrow_schema(schema: Iterable[bigquery.SchemaField]) -> pa.Schema:
+    """
+    Get the Arrow schema of the rows of a BigQuery schema
+    :param schema: BigQuery schema fields
+    :return:
+    """
+    return pa.schema(
+        [pa.field(field.name, schema_field_to_arrow_type(field)) for field in schema]
+    )
+
+
+def arrow_batches_to_dataframe(
+    record_batches: Iterable[pa.RecordBatch],
+    schema: Optional[pa.Schema] = None,
+    dtype_backend: str = "numpy",
+) -> Optional[pd.DataFrame]:
+    """
+    Assemble Arrow record batches into a single dataframe. The batches are
+    converted column by column without creating Python objects per row, and
+    their buffers are released while the dataframe is being built.
+    :param record_batches: Arrow record batches
+    :param schema: Schema of the batches, required when there may be no batches
+    :param dtype_backend: numpy or pyarrow, see DTYPE_BACKENDS
+    :return: Dataframe or None if there are no batches and no schema
+    """
+    record_batches = [batch for batch in record_batches if batch.num_rows]
+    if not record_batches and schema is None:
+        return None
+
+    arrow_table = pa.Table.from_batches(record_batches, schema=schema)
+    return arrow_table_to_dataframe(
+        arrow_table, dtype_backend=dtype_backend, self_destruct=True
+    )
+
+
+def query_job_to_dataframe(
+    query_job: bigquery.QueryJob,
+    bqstorage_client=None,
+    stats=None,
+    dtype_backend: str = "numpy",
+) -> pd.DataFrame:
+    """
+    Download the results of a query job into a dataframe.
+    Results are paged through the REST API as Arrow, or when a BigQuery Storage
+    read client is given, streamed as Arrow record batches through the Storage Read
+    API, then converted with the dtypes of RowIterator.to_dataframe.
+    :param query_job: Query job to download the results of
+    :param bqstorage_client: BigQueryReadClient or a client with the same interface
+    :param stats: QueryJobStats recording the statistics of the job and the time
+    spent waiting for it, downloading and converting its results
+    :param dtype_backend: numpy or pyarrow, see DTYPE_BACKENDS
+    :return: Dataframe of the query results
+    """
+    started = time.perf_counter()
+    rows = query_job.result()
+    if stats is not None:
+        stats.wait_sec = time.perf_counter() - started
+        stats.update_from_job(query_job)
+
+    started = time.perf_counter()
+    if bqstorage_client is None:
+        arrow_table = rows.to_arrow(create_bqstorage_client=False)
+        record_batches, schema = arrow_table.to_batches(), arrow_table.schema
+    else:
+        record_batches = list(rows.to_arrow_iterable(bqstorage_client=bqstorage_client))
+        schema = None
+    download_sec = time.perf_counter() - started
+
+    started = time.perf_counter()
+    dataframe = arrow_batches_to_dataframe(
+        record_batches, schema=schema, dtype_backend=dtype_backend
+    )
+    if dataframe is None:
+        # No rows. The iterator has already been started and can not be read
+        # again, so the empty frame is built from the schema of the results.
+        dataframe = arrow_batches_to_dataframe(
+            [],
+            schema=bq_schema_to_arrow_schema(rows.schema),
+            dtype_backend=dtype_backend,
+        )
+    if stats is not None:
+        stats.download_sec = download_sec
+        stats.conversion_sec = time.perf_counter() - started
+        stats.rows = len(dataframe)
+    return dataframe
+
+
+def query_job_to_record_batches(
+    query_job: bigquery.QueryJob,
+    bqstorage_client=None,
+    page_size: int = None,
+    stats=None,
+) -> Iterable[pa.RecordBatch]:
+    """
+    Iterate over the results of a query job as Arrow record batches, one page at a
+    time, without holding every page in memory.
+    :param query_job: Query job to download the results of
+    :param bqstorage_client: BigQueryReadClient to stream the results through the
+    Storage Read API, the REST API is paged otherwise
+    :param page_size: Number of rows of the REST API pages
+    :param stats: QueryJobStats recording the statistics of the job and the time
+    spent waiting for it
+    :return: Record batches of the results
+    """
+    started = time.perf_counter()
+    rows = query_job.result(page_size=page_size)
+    if stats is not None:
+        stats.wait_sec = time.perf_counter() - started
+        stats.update_from_job(query_job)
+    return rows.to_arrow_iterable(bqstorage_client=bqstorage_client)
@@ -0,0 +1,247 @@
+"""
+This file contains a normalized, in memory form of the metrics and metadata_runtime
+tables of workflows.
+
+create_metrics_runtime_table merges the task name, shard, workflow id and durations
+of each VM onto every metrics sample, so the names are copied once per sample and
+plotting a shard filters the whole table with string comparisons. A
+MonitoringDataset keeps the attributes of each VM once, in a small instances
+table, and the metrics sorted by VM and time, keyed by the position of their VM in
+that table (its instance code). The instances are sorted by task and shard, so the
+VMs of a task, or of a shard of a task, have consecutive codes and their samples
+are a single slice of the metrics.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Column of the metrics holding the instance code of their VM
+INSTANCE_CODE_COLUMN = "instance_code"
+
+# Columns of the instances copied onto the metrics by metrics_runtime(), as in
+# create_metrics_runtime_table
+METRICS_RUNTIME_COLUMNS = [
+    "runtime_workflow_id",
+    "runtime_task_call_name",
+    "runtime_shard",
+    "runtime_instance_id",
+    "metrics_duration_sec",
+    "meta_duration_sec",
+]
+
+# Order of the instances, the VMs of a task and of a shard being consecutive
+INSTANCE_SORT_COLUMNS = [
+    "runtime_task_call_name",
+    "runtime_shard",
+    "runtime_workflow_id",
+    "runtime_instance_id",
+]
+
+
+def _ranges(keys) -> Dict:
+    """
+    Get the range of positions of each key of a sorted sequence
+    """
+    ranges = {}
+    for position, key in enumerate(keys):
+        start, _ = ranges.get(key, (position, None))
+        ranges[key] = (start, position + 1)
+    return ranges
+
+
+class MonitoringDataset:
+    """
+    Metrics of VMs keyed by an integer instance code, with the attributes of the
+    VMs in the instances table (the rows of metadata_runtime, one per VM). The
+    samples of instance code i are the rows offsets[i]:offsets[i + 1] of metrics,
+    sorted by time. Metrics of VMs missing from metadata_runtime are dropped, as
+    in create_metrics_runtime_table.
+    """
+
+    def __init__(self, metrics: pd.DataFrame, metadata_runtime: pd.DataFrame):
+        """
+        :param metrics: Metrics samples, summaries or buckets, as returned by
+        QueryBQToMonitor
+        :param metadata_runtime: Metadata and runtime table of the workflows
+        """
+        instances = metadata_runtime.loc[
+            metadata_runtime.runtime_instance_id.notna()
+        ].drop_duplicates("runtime_instance_id")
+        instances = instances.sort_values(
+            INSTANCE_SORT_COLUMNS, kind="stable", na_position="last"
+        ).reset_index(drop=True)
+        for column in ["runtime_workflow_id", "runtime_task_call_name"]:
+            instances[column] = instances[column].astype("category")
+        self.instances: pd.DataFrame = instances
+
+        if "metrics_instance_id" not in metrics.columns:
+            # No metrics were fetched, such as when the workflows have no VMs
+            metrics = metrics.assign(
+                metrics_instance_id=pd.array([None] * len(metrics), dtype="Int64")
+            )
+        instance_ids = metrics.metrics_instance_id
+        codes = np.full(len(metrics), -1, dtype=np.int64)
+        has_id = instance_ids.notna().to_numpy()
+        codes[has_id] = pd.Index(
+            instances.runtime_instance_id.astype("int64")
+        ).get_indexer(instance_ids[has_id].astype("int64"))
+
+        # Position of metrics_instance_id, restored by metrics_runtime()
+        self._instance_id_position: int = metrics.columns.get_loc("metrics_instance_id")
+        metrics = metrics.drop(columns="metrics_instance_id")
+        metrics.insert(0, INSTANCE_CODE_COLUMN, codes.astype(np.int32))
+        metrics = metrics.loc[codes >= 0]
+        sort_columns = [INSTANCE_CODE_COLUMN] + [
+            column
+            for column in ["metrics_timestamp", "summary_start_timestamp"]
+            if column in metrics.columns
+        ]
+        self.metrics: pd.DataFrame = metrics.sort_values(
+            sort_columns, kind="stable"
+        ).reset_index(drop=True)
+
+        # Start of the samples of each instance code, followed by len(metrics)
+        self.offsets: np.ndarray = np.searchsorted(
+            self.metrics[INSTANCE_CODE_COLUMN].to_numpy(),
+            np.arange(len(instances) + 1),
+        ).astype(np.int64)
+
+        # Ranges of instance codes of each task and of each (task, shard)
+        task_names = instances.runtime_task_call_name.astype(object)
+        self._task_ranges: Dict[str, Tuple[int, int]] = _ranges(task_names)
+        self._task_shard_ranges: Dict[Tuple[str, int], Tuple[int, int]] = _ranges(
+            zip(task_names, instances.runtime_shard.astype(object))
+        )
+
+    def __len__(self):
+        return len(self.metrics)
+
+    def memory_usage(self) -> int:
+        """
+        Get the number of bytes held by the metrics and instances tables
+        :return:
+        """
+        return int(
+            self.metrics.memory_usage(deep=True).sum()
+            + self.instances.memory_usage(deep=True).sum()
+            + self.offsets.nbytes
+        )
+
+    def task_names(self) -> List[str]:
+        """
+        Get the task call names, in the order of the instances
+        :return:
+        """
+        return list(self._task_ranges)
+
+    def shards(self, task_name: str) -> list:
+        """
+        Get the shards of a task, sorted
+        :param task_name: Task call name
+        :return:
+        """
+        return (
+            self.instances.runtime_shard.iloc[slice(*self._code_range(task_name))]
+            .unique()
+            .tolist()
+        )
+
+    def _code_range(self, task_name: str, shard: Optional[int] = None):
+        key = task_name if shard is None else (task_name, shard)
+        ranges = self._task_ranges if shard is None else self._task_shard_ranges
+        if key not in ranges:
+            raise KeyError(
+                f"Task {task_name} not found"
+                if shard is None
+                else f"Shard {shard} of task {task_name} not found"
+            )
+        return ranges[key]
+
+    def instance_codes(self, task_name: str, shard: Optional[int] = None) -> range:
+        """
+        Get the instance codes of the VMs of a task, or of a shard of a task
+        :param task_name: Task call name
+        :param shard: Shard of the task, every shard if None
+        :return:
+        """
+        return range(*self._code_range(task_name, shard))
+
+    def metrics_rows(self, task_name: str, shard: Optional[int] = None) -> slice:
+        """
+        Get the rows of the metrics of a task, or of a shard of a task
+        :param task_name: Task call name
+        :param shard: Shard of the task, every shard if None
+        :return: Slice of the rows of self.metrics
+        """
+        start, stop = self._code_range(task_name, shard)
+        return slice(int(self.offsets[start]), int(self.offsets[stop]))
+
+    def task_metrics(self, task_name: str, shard: Optional[int] = None) -> pd.DataFrame:
+        """
+        Get the metrics of a task, or of a shard of a task, keyed by instance code
+        :param task_name: Task call name
+        :param shard: Shard of the task, every shard if None
+        :return:
+        """
+        return self.metrics.iloc[self.metrics_rows(task_name, shard)]
+
+    def task_metadata_runtime(
+        self, task_name: str, shard: Optional[int] = None
+    ) -> pd.DataFrame:
+        """
+        Get the metadata_runtime rows of the VMs of a task, or of a shard of a task
+        :param task_name: Task call name
+        :param shard: Shard of the task, every shard if None
+        :return:
+        """
+        return self.instances.iloc[slice(*self._code_range(task_name, shard))]
+
+    def metrics_runtime(
+        self, task_name: Optional[str] = None, shard: Optional[int] = None
+    ) -> pd.DataFrame:
+        """
+        Get metrics merged with the runtime metadata of their VM, with the columns
+        of create_metrics_runtime_table, only for a task or a shard of a task
+        :param task_name: Task call name, every task if None
+        :param shard: Shard of the task, every shard if None
+        :return:
+        """
+        metrics = (
+            self.metrics
+            if task_name is None
+            else self.metrics.iloc[self.metrics_rows(task_name, shard)]
+        )
+        codes = metrics[INSTANCE_CODE_COLUMN].to_numpy()
+        runtime = self.instances[METRICS_RUNTIME_COLUMNS].take(codes)
+        runtime.index = metrics.index
+        metrics = metrics.drop(columns=INSTANCE_CODE_COLUMN)
+        metrics.insert(
+            self._instance_id_position,
+            "metrics_instance_id",
+            runtime.runtime_instance_id,
+        )
+        return pd.concat([metrics, runtime], axis=1)
+
+    def task_summary(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Get the duration and the number of shards of each task with metrics, like
+        table.utils.get_task_summary, the longest task first
+        :return: Task call name -> (duration in seconds, shard count)
+        """
+        instances = self.instances.loc[np.diff(self.offsets) > 0]
+        summary = (
+            instances.groupby("runtime_task_call_name", observed=True, sort=False)
+            .agg(
+                duration=("metrics_duration_sec", "max"),
+                shards=("runtime_shard", "nunique"),
+            )
+            .sort_values("duration", ascending=False, kind="stable")
+        )
+        return {
+            task: (duration, shards)
+            for task, duration, shards in zip(
+                summary.index, summary.duration, summary.shards
+            )
+        }
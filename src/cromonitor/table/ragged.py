@@ -0,0 +1,268 @@
+"""
+This file contains a columnar representation of the repeated metrics fields
+(cpu_used_percent, disk_used_gb, disk_read_iops and disk_write_iops), which hold
+one value per core or per disk in every metrics sample.
+
+Dataframes hold these fields as object columns with one array per row, so reducing
+them row by row runs Python code for every sample. A RaggedArray stores all the
+values of a column in a single float64 array, with the offset of each row, and
+reduces every row at once with numpy. Columns of Arrow lists (pd.ArrowDtype) are
+already stored this way, and their values and offsets are used without building
+an array per row.
+"""
+
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Per sample reductions of the repeated metrics fields, added to raw metrics by
+# add_sample_reductions: column name -> (repeated field, reduction)
+SAMPLE_REDUCTIONS = {
+    "metrics_cpu_mean_percent": ("metrics_cpu_used_percent", "mean"),
+    "metrics_disk_first_gb": ("metrics_disk_used_gb", "first"),
+    "metrics_disk_max_gb": ("metrics_disk_used_gb", "max"),
+    "metrics_disk_read_iops_max": ("metrics_disk_read_iops", "max"),
+    "metrics_disk_write_iops_max": ("metrics_disk_write_iops", "max"),
+}
+
+
+def _row_values(row) -> np.ndarray:
+    """
+    Get the values of a row as a float array, missing rows having no values
+    :param row: Array, list, scalar or None
+    :return:
+    """
+    if row is None or (np.ndim(row) == 0 and pd.isna(row)):
+        return np.empty(0)
+    return np.atleast_1d(np.asarray(row, dtype=float))
+
+
+def _arrow_list_array(rows) -> Optional[pa.Array]:
+    """
+    Get the Arrow list array of a column of pd.ArrowDtype lists
+    :param rows: Column or any sequence of rows
+    :return: None if rows is not such a column
+    """
+    dtype = getattr(rows, "dtype", None)
+    if not isinstance(dtype, pd.ArrowDtype):
+        return None
+    arrow_type = dtype.pyarrow_dtype
+    if not (pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type)):
+        return None
+    return pa.chunked_array(rows.array.__arrow_array__()).combine_chunks()
+
+
+class RaggedArray:
+    """
+    Rows of a variable number of float values, stored as the flat values of every
+    row and the offsets where each row starts. Row i holds
+    values[offsets[i]:offsets[i + 1]]. Reductions ignore NaN values and return NaN
+    for rows without values.
+    """
+
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        """
+        :param values: Values of every row, one after the other
+        :param offsets: Start of each row in values, followed by len(values)
+        """
+        self.values: np.ndarray = np.asarray(values, dtype=float)
+        self.offsets: np.ndarray = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_sequences(cls, rows: Iterable) -> "RaggedArray":
+        """
+        Build a RaggedArray from a sequence of rows, such as a repeated metrics
+        column. Scalar rows hold a single value and missing rows hold no value.
+        :param rows: Arrays, lists or scalars
+        :return:
+        """
+        list_array = _arrow_list_array(rows)
+        if list_array is not None:
+            return cls.from_arrow(list_array)
+
+        row_values = [_row_values(row) for row in rows]
+        lengths = np.fromiter(
+            (len(values) for values in row_values),
+            dtype=np.int64,
+            count=len(row_values),
+        )
+        offsets = np.zeros(len(row_values) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.concatenate(row_values) if row_values else np.empty(0)
+        return cls(values=values, offsets=offsets)
+
+    @classmethod
+    def from_arrow(cls, list_array: pa.Array) -> "RaggedArray":
+        """
+        Build a RaggedArray from an Arrow list array, without creating Python
+        objects. Null rows hold no value and null values are NaN.
+        :param list_array: Arrow list array of numbers
+        :return:
+        """
+        lengths = pc.fill_null(pc.list_value_length(list_array), 0)
+        offsets = np.zeros(len(list_array) + 1, dtype=np.int64)
+        np.cumsum(lengths.to_numpy(), out=offsets[1:])
+        values = (
+            pc.list_flatten(list_array)
+            .cast(pa.float64())
+            .to_numpy(zero_copy_only=False)
+        )
+        return cls(values=values, offsets=offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        Number of values of each row
+        """
+        return np.diff(self.offsets)
+
+    def row(self, index: int) -> np.ndarray:
+        """
+        Get the values of a row, without copying them
+        :param index: Position of the row
+        :return:
+        """
+        return self.values[self.offsets[index] : self.offsets[index + 1]]
+
+    def take(self, positions) -> "RaggedArray":
+        """
+        Get the rows at some positions
+        :param positions: Positions of the rows, or boolean mask
+        :return:
+        """
+        positions = np.arange(len(self))[positions]
+        lengths = self.lengths[positions]
+        offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position of every value of the selected rows in self.values
+        value_positions = np.repeat(
+            self.offsets[positions] - offsets[:-1], lengths
+        ) + np.arange(offsets[-1])
+        return RaggedArray(values=self.values[value_positions], offsets=offsets)
+
+    def _reduce(self, ufunc: np.ufunc, values: np.ndarray) -> np.ndarray:
+        """
+        Reduce the values of every row with a ufunc, NaN for rows without values
+        """
+        result = np.full(len(self), np.nan)
+        has_values = self.lengths > 0
+        if has_values.any():
+            # Rows without values do not move the offsets, so each non empty row
+            # is reduced up to the start of the next one
+            result[has_values] = ufunc.reduceat(values, self.offsets[:-1][has_values])
+        return result
+
+    def sum(self) -> np.ndarray:
+        """
+        Sum of the values of each row, ignoring NaN
+        """
+        return self._reduce(np.add, np.nan_to_num(self.values, nan=0.0))
+
+    def count(self) -> np.ndarray:
+        """
+        Number of values of each row that are not NaN
+        """
+        counts = self._reduce(np.add, (~np.isnan(self.values)).astype(float))
+        return np.nan_to_num(counts, nan=0.0).astype(np.int64)
+
+    def mean(self) -> np.ndarray:
+        """
+        Mean of the values of each row, ignoring NaN
+        """
+        counts = self.count()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, self.sum() / counts, np.nan)
+
+    def max(self) -> np.ndarray:
+        """
+        Max of the values of each row, ignoring NaN
+        """
+        return self._reduce(np.fmax, self.values)
+
+    def min(self) -> np.ndarray:
+        """
+        Min of the values of each row, ignoring NaN
+        """
+        return self._reduce(np.fmin, self.values)
+
+    def element(self, position: int) -> np.ndarray:
+        """
+        Get the value at a position of each row, such as the usage of a core or
+        of a disk over time
+        :param position: Position in the rows
+        :return: Values, NaN for rows too short
+        """
+        result = np.full(len(self), np.nan)
+        has_element = self.lengths > position
+        result[has_element] = self.values[self.offsets[:-1][has_element] + position]
+        return result
+
+    def first(self) -> np.ndarray:
+        """
+        First value of each row, such as the usage of the first disk
+        """
+        return self.element(0)
+
+    def to_padded(self, fill_value: float = np.nan) -> np.ndarray:
+        """
+        Get the rows as a 2D array, with one column per position (core or disk)
+        :param fill_value: Value of the positions missing from shorter rows
+        :return:
+        """
+        width = int(self.lengths.max()) if len(self) else 0
+        padded = np.full((len(self), width), fill_value)
+        rows = np.repeat(np.arange(len(self)), self.lengths)
+        columns = np.arange(len(self.values)) - np.repeat(
+            self.offsets[:-1], self.lengths
+        )
+        padded[rows, columns] = self.values
+        return padded
+
+
+def reduce_repeated_column(column: pd.Series, reduction: str) -> pd.Series:
+    """
+    Reduce each row of a repeated metrics column to a single value
+    :param column: Column holding an array per row
+    :param reduction: mean, max, min, sum or first
+    :return: Values aligned with the column
+    """
+    values = getattr(RaggedArray.from_sequences(column), reduction)()
+    return pd.Series(values, index=column.index, name=column.name)
+
+
+def add_sample_reductions(metrics: pd.DataFrame) -> pd.DataFrame:
+    """
+    Add the per sample reductions of SAMPLE_REDUCTIONS to raw metrics, so that the
+    summaries and plots do not reduce the repeated fields again
+    :param metrics: Raw metrics samples
+    :return: Metrics with the reduction columns of the repeated fields they hold
+    """
+    reductions = {}
+    arrays = {}
+    for column, (field, reduction) in SAMPLE_REDUCTIONS.items():
+        if field not in metrics.columns:
+            continue
+        if field not in arrays:
+            arrays[field] = RaggedArray.from_sequences(metrics[field])
+        reductions[column] = getattr(arrays[field], reduction)()
+    return metrics.assign(**reductions)
+
+
+def sample_reduction(metrics: pd.DataFrame, column: str) -> pd.Series:
+    """
+    Get a per sample reduction of SAMPLE_REDUCTIONS, computed from the repeated
+    field when the metrics do not hold it yet
+    :param metrics: Raw metrics samples
+    :param column: Column of SAMPLE_REDUCTIONS
+    :return:
+    """
+    if column in metrics.columns:
+        return metrics[column].astype(float)
+    field, reduction = SAMPLE_REDUCTIONS[column]
+    return reduce_repeated_column(metrics[field], reduction)
@@ -0,0 +1,289 @@
+"""
+This file contains a local store of the monitoring tables of workflows, as a
+Parquet dataset.
+
+The metrics are partitioned by workflow id and task call name, with the samples of
+each partition sorted by shard and timestamp, and the metadata_runtime table is
+stored next to them. Loading the metrics of a task only opens the files of its
+partition, and the filters on shards and time and the selection of columns are
+pushed down to the Parquet reader, so plotting a task of a large workflow reads
+only its samples instead of deserializing the pickle of the whole workflow.
+"""
+
+import os
+import shutil
+import urllib.parse
+from typing import Iterable, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from ..query.utils import and_expressions, to_utc_timestamp
+from .utils import create_metrics_runtime_table
+
+# Columns the metrics are partitioned by, in the order of the directories
+PARTITION_COLUMNS = ["runtime_workflow_id", "runtime_task_call_name"]
+# Runtime columns stored with each metrics sample, to filter on them
+METRICS_RUNTIME_COLUMNS = PARTITION_COLUMNS + ["runtime_shard"]
+# Samples per Parquet row group, small enough for the filters on shards and time to
+# skip most of the row groups of a task
+DEFAULT_ROWS_PER_GROUP = 64 * 1024
+
+
+class MonitoringStore:
+    """
+    Parquet dataset of the metrics and metadata_runtime tables of workflows, in
+    store_dir:
+    - metadata_runtime.parquet
+    - metrics/runtime_workflow_id=<id>/runtime_task_call_name=<name>/*.parquet
+    Writing the tables of a workflow replaces the tables stored for it.
+    """
+
+    def __init__(self, store_dir: str, rows_per_group: int = DEFAULT_ROWS_PER_GROUP):
+        """
+        :param store_dir: Directory of the dataset, created on the first write
+        :param rows_per_group: Maximum number of samples per Parquet row group
+        """
+        self.store_dir: str = store_dir
+        self.rows_per_group: int = rows_per_group
+
+    @property
+    def metrics_dir(self) -> str:
+        return os.path.join(self.store_dir, "metrics")
+
+    @property
+    def metadata_runtime_path(self) -> str:
+        return os.path.join(self.store_dir, "metadata_runtime.parquet")
+
+    def exists(self) -> bool:
+        """
+        Check whether tables were written to the store
+        :return:
+        """
+        return os.path.exists(self.metadata_runtime_path) and os.path.isdir(
+            self.metrics_dir
+        )
+
+    def clear(self):
+        """
+        Remove every table of the store
+        :return:
+        """
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+
+    def _workflow_dir(self, workflow_id: str) -> str:
+        # Partition values are URI encoded in the directory names
+        return os.path.join(
+            self.metrics_dir,
+            f"{PARTITION_COLUMNS[0]}={urllib.parse.quote(str(workflow_id), safe='')}",
+        )
+
+    @property
+    def _partitioning(self) -> ds.Partitioning:
+        return ds.partitioning(
+            pa.schema([(column, pa.string()) for column in PARTITION_COLUMNS]),
+            flavor="hive",
+        )
+
+    def write(self, metrics: pd.DataFrame, metadata_runtime: pd.DataFrame):
+        """
+        Write the metrics and metadata_runtime tables of workflows, replacing the
+        tables stored for them
+        :param metrics: Metrics samples or buckets, as returned by QueryBQToMonitor
+        :param metadata_runtime: Metadata and runtime table of the workflows
+        :return:
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        # Tag each sample with the task and shard of its VM, to partition on them
+        runtime_of_instance = metadata_runtime[
+            ["runtime_instance_id"] + METRICS_RUNTIME_COLUMNS
+        ].drop_duplicates("runtime_instance_id")
+        metrics = metrics.drop(
+            columns=[column for column in METRICS_RUNTIME_COLUMNS if column in metrics]
+        ).merge(
+            runtime_of_instance,
+            how="inner",
+            left_on="metrics_instance_id",
+            right_on="runtime_instance_id",
+        )
+        metrics = metrics.drop(columns="runtime_instance_id")
+        sort_columns = [
+            column
+            for column in ["runtime_shard", "metrics_timestamp"]
+            if column in metrics.columns
+        ]
+        metrics = metrics.sort_values(sort_columns).reset_index(drop=True)
+        metrics[PARTITION_COLUMNS] = metrics[PARTITION_COLUMNS].astype(str)
+
+        for workflow_id in metadata_runtime.runtime_workflow_id.dropna().unique():
+            shutil.rmtree(self._workflow_dir(workflow_id), ignore_errors=True)
+        ds.write_dataset(
+            pa.Table.from_pandas(metrics, preserve_index=False),
+            self.metrics_dir,
+            format="parquet",
+            partitioning=self._partitioning,
+            existing_data_behavior="overwrite_or_ignore",
+            min_rows_per_group=min(self.rows_per_group, 1024),
+            max_rows_per_group=self.rows_per_group,
+        )
+
+        # The metadata_runtime table is small, rewrite it with the rows of other
+        # workflows kept
+        if os.path.exists(self.metadata_runtime_path):
+            stored = pd.read_parquet(self.metadata_runtime_path)
+            stored = stored[
+                ~stored.runtime_workflow_id.isin(metadata_runtime.runtime_workflow_id)
+            ]
+            metadata_runtime = pd.concat([stored, metadata_runtime], ignore_index=True)
+        tmp_path = f"{self.metadata_runtime_path}.tmp"
+        metadata_runtime.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.metadata_runtime_path)
+
+    @staticmethod
+    def _filter(
+        workflow_ids: Optional[Iterable[str]] = None,
+        task_names: Optional[Iterable[str]] = None,
+        shards: Optional[Iterable[int]] = None,
+        start_time=None,
+        end_time=None,
+    ) -> Optional[ds.Expression]:
+        """
+        Build the filter expression of a read, None to read everything
+        """
+        conditions = []
+        if workflow_ids is not None:
+            conditions.append(
+                ds.field("runtime_workflow_id").isin([str(w) for w in workflow_ids])
+            )
+        if task_names is not None:
+            conditions.append(
+                ds.field("runtime_task_call_name").isin([str(t) for t in task_names])
+            )
+        if shards is not None:
+            conditions.append(ds.field("runtime_shard").isin(list(shards)))
+        if start_time is not None:
+            conditions.append(
+                ds.field("metrics_timestamp") >= to_utc_timestamp(start_time)
+            )
+        if end_time is not None:
+            conditions.append(
+                ds.field("metrics_timestamp") < to_utc_timestamp(end_time)
+            )
+
+        return and_expressions(conditions)
+
+    def read_metrics(
+        self,
+        workflow_ids: Optional[Iterable[str]] = None,
+        task_names: Optional[Iterable[str]] = None,
+        shards: Optional[Iterable[int]] = None,
+        start_time=None,
+        end_time=None,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Read the metrics samples matching filters. Only the partitions of the
+        workflows and tasks are opened, and the other filters skip the row groups
+        outside of them.
+        :param workflow_ids: Workflow ids to read, every workflow if None
+        :param task_names: Task call names to read, every task if None
+        :param shards: Shards to read, every shard if None
+        :param start_time: Only read the samples from this time on
+        :param end_time: Only read the samples before this time
+        :param columns: Columns to read, every metrics column if None. The
+        columns of METRICS_RUNTIME_COLUMNS can be read too.
+        :return:
+        """
+        dataset = ds.dataset(
+            self.metrics_dir, format="parquet", partitioning=self._partitioning
+        )
+        if columns is None:
+            columns = [
+                column
+                for column in dataset.schema.names
+                if column not in METRICS_RUNTIME_COLUMNS
+            ]
+        table = dataset.to_table(
+            columns=columns,
+            filter=self._filter(
+                workflow_ids=workflow_ids,
+                task_names=task_names,
+                shards=shards,
+                start_time=start_time,
+                end_time=end_time,
+            ),
+        )
+        return table.to_pandas()
+
+    def read_metadata_runtime(
+        self,
+        workflow_ids: Optional[Iterable[str]] = None,
+        task_names: Optional[Iterable[str]] = None,
+        shards: Optional[Iterable[int]] = None,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Read the metadata_runtime rows matching filters
+        :param workflow_ids: Workflow ids to read, every workflow if None
+        :param task_names: Task call names to read, every task if None
+        :param shards: Shards to read, every shard if None
+        :param columns: Columns to read, every column if None
+        :return:
+        """
+        table = ds.dataset(self.metadata_runtime_path, format="parquet").to_table(
+            columns=columns,
+            filter=self._filter(
+                workflow_ids=workflow_ids, task_names=task_names, shards=shards
+            ),
+        )
+        return table.to_pandas()
+
+    def task_names(self, workflow_ids: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Get the task call names of the stored workflows
+        :param workflow_ids: Workflow ids, every workflow if None
+        :return:
+        """
+        metadata_runtime = self.read_metadata_runtime(
+            workflow_ids=workflow_ids, columns=["runtime_task_call_name"]
+        )
+        return metadata_runtime.runtime_task_call_name.dropna().unique().tolist()
+
+    def read_metrics_runtime(
+        self,
+        workflow_ids: Optional[Iterable[str]] = None,
+        task_names: Optional[Iterable[str]] = None,
+        shards: Optional[Iterable[int]] = None,
+        start_time=None,
+        end_time=None,
+        columns: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Read the metrics matching filters merged with their runtime metadata, like
+        create_metrics_runtime_table, to plot them
+        :param workflow_ids: Workflow ids to read, every workflow if None
+        :param task_names: Task call names to read, every task if None
+        :param shards: Shards to read, every shard if None
+        :param start_time: Only read the samples from this time on
+        :param end_time: Only read the samples before this time
+        :param columns: Metrics columns to read, every column if None
+        :return:
+        """
+        if columns is not None and "metrics_instance_id" not in columns:
+            columns = ["metrics_instance_id"] + list(columns)
+        metrics = self.read_metrics(
+            workflow_ids=workflow_ids,
+            task_names=task_names,
+            shards=shards,
+            start_time=start_time,
+            end_time=end_time,
+            columns=columns,
+        )
+        metadata_runtime = self.read_metadata_runtime(
+            workflow_ids=workflow_ids, task_names=task_names, shards=shards
+        )
+        return create_metrics_runtime_table(
+            metrics=metrics, metadata_runtime=metadata_runtime
+        )
@@ -1,7 +1,10 @@
 from pathlib import Path
 
 import pandas as pd
+import pyarrow as pa
 import pytest
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
 
 # "The conftest.py file serves as a means of providing fixtures for an entire directory.
 # Fixtures defined in a conftest.py can be used by any test in that package without
@@ -46,3 +49,228 @@ def mock_data(
             self.metrics_runtime = pd.read_pickle(mock_metrics_runtime_table)
 
     return MockData()
+
+
+def arrow_type_to_bq_field_type(arrow_type):
+    if pa.types.is_list(arrow_type):
+        return arrow_type_to_bq_field_type(arrow_type.value_type)
+    if pa.types.is_integer(arrow_type):
+        return "INTEGER"
+    if pa.types.is_floating(arrow_type):
+        return "FLOAT"
+    if pa.types.is_boolean(arrow_type):
+        return "BOOLEAN"
+    if pa.types.is_timestamp(arrow_type):
+        return "TIMESTAMP" if arrow_type.tz else "DATETIME"
+    return "STRING"
+
+
+class FakeRowIterator:
+    """
+    Rows of a query, that can be read only once like the RowIterator of the client
+    """
+
+    def __init__(self, dataframe):
+        self.dataframe = dataframe
+        self.started = False
+
+    @property
+    def schema(self):
+        arrow_schema = pa.Schema.from_pandas(self.dataframe, preserve_index=False)
+        return [
+            bigquery.SchemaField(
+                field.name,
+                arrow_type_to_bq_field_type(field.type),
+                mode="REPEATED" if pa.types.is_list(field.type) else "NULLABLE",
+            )
+            for field in arrow_schema
+        ]
+
+    def _start(self):
+        if self.started:
+            raise ValueError("Iterator has already started")
+        self.started = True
+
+    def to_arrow(self, create_bqstorage_client=True):
+        self._start()
+        return pa.Table.from_pandas(self.dataframe, preserve_index=False)
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        self._start()
+        return pa.Table.from_pandas(self.dataframe, preserve_index=False).to_batches()
+
+    def to_dataframe(self, create_bqstorage_client=True):
+        self._start()
+        return self.dataframe
+
+
+class FakeQueryJob:
+    total_bytes_processed = 100
+    total_bytes_billed = 10 * 1024**2
+    slot_millis = 50
+    cache_hit = False
+    started = pd.Timestamp("2024-01-01 00:00:00", tz="UTC")
+    ended = pd.Timestamp("2024-01-01 00:00:02", tz="UTC")
+    state = "DONE"
+    error_result = None
+    location = "US"
+
+    def __init__(self, dataframe):
+        self.dataframe = dataframe
+        self.job_id = f"job-{id(self)}"
+        self.destination = f"my-project._anonymous.{self.job_id}"
+
+    def result(self, page_size=None):
+        return FakeRowIterator(self.dataframe)
+
+    def to_dataframe(self, create_bqstorage_client=True):
+        return self.dataframe
+
+
+class FakeDryRunJob:
+    def __init__(self, total_bytes_processed):
+        self.total_bytes_processed = total_bytes_processed
+
+
+class FakeBigQueryClient:
+    """
+    Answers the monitoring queries from in memory runtime, metadata and metrics
+    tables, filtering them on the query parameters.
+    """
+
+    def __init__(self, runtime, metadata, metrics):
+        self.runtime = runtime
+        self.metadata = metadata
+        self.metrics = metrics
+        self.queries = []
+        # Jobs of the queries run, and the ids of the jobs whose results expired
+        self.jobs = {}
+        self.expired_job_ids = set()
+        self.cancelled_job_ids = []
+        # Bytes processed by each query, returned by dry runs
+        self.bytes_processed = {
+            "runtime": 10,
+            "metadata": 10,
+            "raw": 1000,
+            "bucketed": 600,
+            "summary": 300,
+        }
+
+    def dry_run_bytes(self, query):
+        if "cromwell_monitoring.runtime" in query:
+            return self.bytes_processed["runtime"]
+        if "cromwell_monitoring.metadata" in query:
+            return self.bytes_processed["metadata"]
+        if "summary_sample_count" in query:
+            return self.bytes_processed["summary"]
+        if "metrics_sample_count" in query:
+            return self.bytes_processed["bucketed"]
+        return self.bytes_processed["raw"]
+
+    def get_job(self, job_id, location=None):
+        if job_id not in self.jobs:
+            raise NotFound(f"Job {job_id}")
+        return self.jobs[job_id]
+
+    def cancel_job(self, job_id, location=None):
+        self.cancelled_job_ids.append(job_id)
+
+    def get_table(self, table):
+        job_id = table.split(".")[-1]
+        if job_id in self.expired_job_ids:
+            raise NotFound(f"Table {table}")
+        return table
+
+    def query(self, query, job_config=None):
+        if job_config.dry_run:
+            return FakeDryRunJob(self.dry_run_bytes(query))
+        query_job = self._query(query, job_config)
+        self.jobs[query_job.job_id] = query_job
+        return query_job
+
+    def _query(self, query, job_config):
+        parameters = {
+            parameter.name: getattr(parameter, "values", None)
+            or getattr(parameter, "value", None)
+            for parameter in job_config.query_parameters
+        }
+        self.queries.append((query, parameters))
+
+        if "cromwell_monitoring.runtime" in query:
+            runtime = self.runtime[
+                self.runtime.runtime_workflow_id.isin(parameters["workflow_ids"])
+            ]
+            if "runtime_since" in parameters:
+                runtime = runtime[
+                    runtime.runtime_start_time >= parameters["runtime_since"]
+                ]
+            return FakeQueryJob(runtime)
+        if "cromwell_monitoring.metadata" in query:
+            return FakeQueryJob(
+                self.metadata[
+                    self.metadata.meta_workflow_id.isin(parameters["workflow_ids"])
+                ]
+            )
+        metrics = self.metrics[
+            self.metrics.metrics_instance_id.isin(parameters["instance_ids"])
+        ]
+        if "metrics_since" in parameters:
+            metrics = metrics[metrics.metrics_timestamp >= parameters["metrics_since"]]
+        return FakeQueryJob(metrics)
+
+
+@pytest.fixture
+def fake_bq_client():
+    runtime = pd.DataFrame(
+        {
+            "runtime_instance_id": pd.array([11, 12, 21], dtype="Int64"),
+            "runtime_instance_name": ["vm-11", "vm-12", "vm-21"],
+            "runtime_workflow_id": ["wf1", "wf1", "wf2"],
+            "runtime_task_call_name": ["task1", "task1", "task2"],
+            "runtime_shard": pd.array([0, 1, -1], dtype="Int64"),
+            "runtime_cpu_count": pd.array([1, 1, 2], dtype="Int64"),
+            "runtime_start_time": pd.to_datetime(
+                ["2024-01-01 00:00", "2024-01-01 00:00", "2024-01-01 01:00"], utc=True
+            ),
+            "metrics_duration_sec": pd.array([2, 1, 1], dtype="Int64"),
+            "metrics_end_time": pd.to_datetime(
+                ["2024-01-01 00:00:02", "2024-01-01 00:00:01", "2024-01-01 01:00:01"],
+                utc=True,
+            ),
+            "metrics_start_time": pd.to_datetime(
+                ["2024-01-01 00:00", "2024-01-01 00:00", "2024-01-01 01:00"], utc=True
+            ),
+        }
+    )
+    metadata = pd.DataFrame(
+        {
+            "meta_instance_name": ["vm-11", "vm-12", "vm-21"],
+            "meta_workflow_id": ["wf1", "wf1", "wf2"],
+            "meta_duration_sec": pd.array([3, 2, 2], dtype="Int64"),
+            "meta_execution_status": ["Done", "Done", "Running"],
+            "meta_end_time": pd.to_datetime(
+                ["2024-01-01 00:03", "2024-01-01 00:02", None], utc=True
+            ),
+        }
+    )
+    metrics = pd.DataFrame(
+        {
+            "metrics_instance_id": pd.array(
+                [11, 11, 11, 12, 12, 21, 21], dtype="Int64"
+            ),
+            "metrics_timestamp": pd.to_datetime(
+                [
+                    "2024-01-01 00:00:00",
+                    "2024-01-01 00:00:01",
+                    "2024-01-01 00:00:02",
+                    "2024-01-01 00:00:00",
+                    "2024-01-01 00:00:01",
+                    "2024-01-01 01:00:00",
+                    "2024-01-01 01:00:01",
+                ],
+                utc=True,
+            ),
+            "metrics_mem_used_gb": [1.0, 2.0, 3.0, 1.0, 1.0, 4.0, 5.0],
+        }
+    )
+    return FakeBigQueryClient(runtime=runtime, metadata=metadata, metrics=metrics)
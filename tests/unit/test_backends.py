@@ -0,0 +1,361 @@
+import json
+from datetime import date, datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+from google.cloud.bigquery import SchemaField
+
+from cromonitor.query import backends, dialects
+from cromonitor.query.cost import CostQuery
+from cromonitor.query.monitoring_sql import (
+    MonitoringQueryBuilder,
+    days_back_to_time_window,
+    time_window_parameters,
+    workflow_ids_parameter,
+)
+from cromonitor.query.queryBQ import QueryBQToMonitor
+
+WORKFLOW_ID = "5f52afbb-28a5-4a1f-8cc6-60d3af22a625"
+
+
+@pytest.fixture
+def duckdb_backend(mock_data):
+    pytest.importorskip("duckdb")
+    backend = backends.DuckDBBackend(billing_table_id="my-project.billing.export")
+
+    # Copy the mock query results back into tables with the BigQuery columns
+    runtime = mock_data.metadata_runtime.filter(like="runtime_")
+    backend.load_table(
+        "cromwell_monitoring.runtime",
+        runtime.rename(columns=lambda column: column[len("runtime_") :]),
+    )
+    backend.load_table(
+        "cromwell_monitoring.metrics",
+        mock_data.metrics.rename(columns=lambda column: column[len("metrics_") :]),
+    )
+    return backend
+
+
+@pytest.fixture
+def create_local_monitor(duckdb_backend):
+    def _create_local_monitor(**kwargs):
+        return QueryBQToMonitor(
+            workflow_ids=[WORKFLOW_ID],
+            days_back_upper_bound=(date.today() - date(2023, 11, 29)).days,
+            days_back_lower_bound=0,
+            bq_goolge_project="my-project",
+            backend=duckdb_backend,
+            **kwargs,
+        )
+
+    return _create_local_monitor
+
+
+def profile_operators(backend, sql, parameters, profile_path):
+    """
+    Run a query in a DuckDB backend and list the operators of its plan, with the
+    number of rows they output
+    """
+    cursor = backend.connection.cursor()
+    cursor.execute("SET enable_profiling = 'json'")
+    cursor.execute(f"SET profiling_output = '{profile_path}'")
+    cursor.execute(sql, parameters).fetchall()
+
+    operators = []
+    nodes = [json.loads(profile_path.read_text())]
+    while nodes:
+        node = nodes.pop()
+        operators.append(node)
+        nodes.extend(node.get("children", []))
+    return operators
+
+
+class TestBackends:
+    def test_incomplete_backend_or_dialect_can_not_be_created(self):
+        class NoDryRunBackend(backends.QueryBackend):
+            def query(self, sql, query_parameters=None, labels=None):
+                return None
+
+            def to_dataframe(self, query_job, stats=None, dtype_backend="numpy"):
+                return pd.DataFrame()
+
+        class NoTableDialect(dialects.SqlDialect):
+            def parameter(self, name):
+                return f"${name}"
+
+        with pytest.raises(TypeError):
+            NoDryRunBackend()
+        with pytest.raises(TypeError):
+            NoTableDialect()
+
+    def test_schema_field_to_duckdb_type(self):
+        labels = SchemaField(
+            name="labels",
+            field_type="RECORD",
+            mode="REPEATED",
+            fields=(
+                SchemaField(name="key", field_type="STRING"),
+                SchemaField(name="value", field_type="STRING"),
+            ),
+        )
+
+        assert (
+            backends.schema_field_to_duckdb_type(
+                SchemaField(name="disk_used_gb", field_type="FLOAT", mode="REPEATED")
+            )
+            == "DOUBLE[]"
+        )
+        assert (
+            backends.schema_field_to_duckdb_type(labels)
+            == 'STRUCT("key" VARCHAR, "value" VARCHAR)[]'
+        )
+
+    def test_load_table(self, duckdb_backend, mock_data, tmp_path):
+        metrics = mock_data.metrics.rename(
+            columns=lambda column: column[len("metrics_") :]
+        )
+        metrics.to_parquet(tmp_path / "part-0.parquet")
+
+        loaded_rows = duckdb_backend.load_table(
+            "my-project.cromwell_monitoring.metrics", str(tmp_path / "*.parquet")
+        )
+
+        assert loaded_rows == len(metrics)
+        assert duckdb_backend.run_query(
+            "SELECT COUNT(*) AS n FROM cromwell_monitoring.metrics"
+        ).n[0] == 2 * len(metrics)
+
+    def test_local_monitoring_query(self, create_local_monitor, mock_data):
+        monitor = create_local_monitor()
+
+        monitor.query()
+
+        assert len(monitor.runtime) == 1
+        assert monitor.runtime.metrics_duration_sec[0] == 171
+        assert len(monitor.metrics) == len(mock_data.metrics)
+        assert monitor.metrics.metrics_cpu_used_percent.map(len).tolist() == (
+            mock_data.metrics.metrics_cpu_used_percent.map(len).tolist()
+        )
+        assert monitor.metadata_runtime.shape[0] == 1
+
+    @pytest.mark.parametrize("boot_minutes", [11, 20])
+    def test_local_query_of_late_first_sample(self, mock_data, boot_minutes):
+        pytest.importorskip("duckdb")
+        backend = backends.DuckDBBackend(billing_table_id="my-project.billing.export")
+        # The VM boots for longer than time_padding before its first sample
+        first_sample = mock_data.metrics.metrics_timestamp.min()
+        runtime = mock_data.metadata_runtime.filter(like="runtime_").assign(
+            runtime_start_time=first_sample - timedelta(minutes=boot_minutes)
+        )
+        backend.load_table(
+            "cromwell_monitoring.runtime",
+            runtime.rename(columns=lambda column: column[len("runtime_") :]),
+        )
+        backend.load_table(
+            "cromwell_monitoring.metrics",
+            mock_data.metrics.rename(columns=lambda column: column[len("metrics_") :]),
+        )
+        monitor = QueryBQToMonitor(
+            workflow_ids=[WORKFLOW_ID],
+            days_back_upper_bound=(date.today() - date(2023, 11, 29)).days,
+            days_back_lower_bound=0,
+            bq_goolge_project="my-project",
+            backend=backend,
+            max_refetch_attempts=0,
+        )
+
+        monitor.query()
+
+        assert len(monitor.metrics) == len(mock_data.metrics)
+        assert (monitor.metrics_completeness.status == "complete").all()
+
+    def test_local_streaming_query(self, create_local_monitor, mock_data, tmp_path):
+        in_memory_monitor = create_local_monitor()
+        in_memory_monitor.query()
+        monitor = create_local_monitor(
+            metrics_dir=str(tmp_path / "metrics"), stream_buffer_rows=50
+        )
+
+        monitor.query()
+
+        # Only the keys of the samples are held in memory
+        assert list(monitor.metrics.columns) == [
+            "metrics_instance_id",
+            "metrics_timestamp",
+        ]
+        assert len(monitor.metrics) == len(mock_data.metrics)
+        assert (monitor.metrics_completeness.status == "complete").all()
+        metrics = monitor.metrics_dataset.read()
+        pd.testing.assert_frame_equal(
+            metrics.sort_values("metrics_timestamp").reset_index(drop=True),
+            in_memory_monitor.metrics.sort_values("metrics_timestamp").reset_index(
+                drop=True
+            )[metrics.columns],
+            # Streamed integers have the nullable dtype of BigQuery results
+            check_dtype=False,
+        )
+        assert "metrics_cpu_mean_percent" in metrics.columns
+        streamed_job = (
+            monitor.job_stats.to_dataframe().set_index("name").loc["raw metrics"]
+        )
+        assert streamed_job.rows == len(mock_data.metrics)
+        assert streamed_job.source == "duckdb"
+
+        # A new query replaces the parts of the previous one
+        monitor.query()
+        assert monitor.metrics_dataset.count_rows() == len(mock_data.metrics)
+
+    def test_local_metrics_modes(self, create_local_monitor, mock_data):
+        summary_monitor = create_local_monitor(metrics_mode="summary")
+        summary_monitor.query()
+        bucketed_monitor = create_local_monitor(metrics_mode="bucketed")
+        bucketed_monitor.query()
+
+        summary = summary_monitor.metrics.iloc[0]
+        assert summary.summary_sample_count == len(mock_data.metrics)
+        assert summary.summary_mem_max_gb == mock_data.metrics.metrics_mem_used_gb.max()
+        assert bucketed_monitor.metrics.metrics_sample_count.sum() == len(
+            mock_data.metrics
+        )
+        assert (bucketed_monitor.metrics.metrics_timestamp.dt.second == 0).all()
+
+    def test_local_bucketed_refresh_keeps_complete_buckets(self, mock_data):
+        pytest.importorskip("duckdb")
+        backend = backends.DuckDBBackend(billing_table_id="my-project.billing.export")
+        runtime = mock_data.metadata_runtime.filter(like="runtime_").rename(
+            columns=lambda column: column[len("runtime_") :]
+        )
+        metrics = mock_data.metrics.rename(
+            columns=lambda column: column[len("metrics_") :]
+        )
+        split = pd.Timestamp("2023-11-30 19:54:30", tz="UTC")
+        backend.load_table("cromwell_monitoring.runtime", runtime)
+        backend.load_table(
+            "cromwell_monitoring.metrics", metrics[metrics.timestamp < split]
+        )
+        monitor = QueryBQToMonitor(
+            workflow_ids=[WORKFLOW_ID],
+            days_back_upper_bound=(date.today() - date(2023, 11, 29)).days,
+            days_back_lower_bound=0,
+            bq_goolge_project="my-project",
+            backend=backend,
+            metrics_mode="bucketed",
+            bucket_interval_sec=60,
+        )
+        monitor.query()
+
+        # A new VM starts within the first, complete, bucket of the running VM
+        backend.load_table(
+            "cromwell_monitoring.runtime",
+            runtime.assign(
+                instance_id=runtime.instance_id + 1,
+                instance_name="new-vm",
+                start_time=pd.Timestamp("2023-11-30 19:53:47", tz="UTC"),
+            ),
+        )
+        backend.load_table(
+            "cromwell_monitoring.metrics", metrics[metrics.timestamp >= split]
+        )
+        monitor.refresh()
+
+        assert monitor.metrics.metrics_sample_count.sum() == len(mock_data.metrics)
+        assert monitor.metrics.metrics_timestamp.is_unique
+
+    def test_local_cost_query(self, duckdb_backend):
+        duckdb_backend.load_table(
+            "my-project.billing.export",
+            pd.DataFrame(
+                {
+                    "project": [{"id": "my-project"}] * 2,
+                    "service": [{"description": "Compute Engine"}] * 2,
+                    "sku": [{"description": "N1 Core"}] * 2,
+                    "labels": [
+                        [
+                            {"key": "cromwell-workflow-id", "value": "cromwell-wf1"},
+                            {"key": "wdl-task-name", "value": "task1"},
+                        ],
+                        [{"key": "cromwell-workflow-id", "value": "cromwell-wf2"}],
+                    ],
+                    "system_labels": [[], []],
+                    "cost": [1.5, 2.0],
+                    "usage_start_time": [datetime(2024, 1, 2, tzinfo=timezone.utc)] * 2,
+                    "usage_end_time": [datetime(2024, 1, 2, tzinfo=timezone.utc)] * 2,
+                }
+            ),
+        )
+        cost_query = CostQuery(
+            workflow_id="wf1",
+            bq_cost_table="my-project.billing.export",
+            start_time=datetime(2024, 1, 1),
+            end_time=datetime(2024, 1, 3),
+            backend=duckdb_backend,
+        )
+
+        cost_query.query_cost()
+
+        assert cost_query.results() == [
+            {
+                "google_project_id": "my-project",
+                "submission_id": None,
+                "workflow_id": "wf1",
+                "task_name": "task1",
+                "subworkflow_name": None,
+                "task_alias": None,
+                "cost_service": "Compute Engine",
+                "cost_description": "N1 Core",
+                "cost": 1.5,
+                "machine_spec": None,
+                "machine_cores": None,
+                "machine_memory": None,
+                "usage_start_time": pd.Timestamp("2024-01-02", tz="UTC"),
+                "usage_end_time": pd.Timestamp("2024-01-02", tz="UTC"),
+            }
+        ]
+        assert cost_query.get_cost_to_query() == 0
+        job_stats = cost_query.job_stats.to_dataframe().iloc[0]
+        assert job_stats["name"] == "cost"
+        assert job_stats.source == "duckdb"
+        assert job_stats.rows == 1
+        assert job_stats.total_sec >= job_stats.submit_sec
+
+    def test_runtime_query_groups_only_workflow_metrics(
+        self, duckdb_backend, mock_data, tmp_path
+    ):
+        # Metrics of other VMs of the project, in the same time window
+        fleet_metrics = pd.concat(
+            [
+                mock_data.metrics.assign(metrics_instance_id=instance_id)
+                for instance_id in range(1, 21)
+            ]
+        )
+        duckdb_backend.load_table(
+            "cromwell_monitoring.metrics",
+            fleet_metrics.rename(columns=lambda column: column[len("metrics_") :]),
+        )
+        start_time, end_time = days_back_to_time_window(
+            (date.today() - date(2023, 11, 29)).days, 0
+        )
+        parameters = {
+            parameter.name: getattr(parameter, "values", None) or parameter.value
+            for parameter in [workflow_ids_parameter([WORKFLOW_ID])]
+            + time_window_parameters(start_time, end_time)
+        }
+        sql = MonitoringQueryBuilder(
+            "my-project", dialect=duckdb_backend.dialect
+        ).runtime_query()
+
+        operators = profile_operators(
+            duckdb_backend, sql, parameters, tmp_path / "profile.json"
+        )
+
+        group_by_inputs = [
+            child["operator_cardinality"]
+            for operator in operators
+            if operator.get("operator_name", "").endswith("GROUP_BY")
+            for child in operator["children"]
+        ]
+        # Only the samples of the VM of the workflow are grouped
+        assert group_by_inputs == [len(mock_data.metrics)]
+        assert len(
+            duckdb_backend.run_query("SELECT * FROM cromwell_monitoring.metrics")
+        ) == (len(mock_data.metrics) + len(fleet_metrics))
@@ -0,0 +1,171 @@
+from datetime import timedelta
+
+import pandas as pd
+import pytest
+
+from cromonitor.query import batching
+
+
+class TestBatching:
+    @pytest.fixture
+    def runtime(self):
+        return pd.DataFrame(
+            {
+                "runtime_instance_id": [1, 2, 3, 4, 5, 6],
+                "runtime_cpu_count": [1, 1, 2, 4, 1, 1],
+                "runtime_disk_mounts": [["/cromwell_root"]] * 6,
+                "metrics_duration_sec": pd.array(
+                    [3600, 60, 600, 7200, 10, None], dtype="Int64"
+                ),
+            }
+        )
+
+    def test_estimate_instance_metrics_size(self, runtime):
+        sizes = batching.estimate_instance_metrics_size(runtime)
+
+        assert sizes.instance_id.tolist() == [1, 2, 3, 4, 5, 6]
+        assert sizes.estimated_rows.tolist() == [3601, 61, 601, 7201, 11, 0]
+        # A 4 cpus VM records larger rows than a 1 cpu VM
+        assert (sizes.estimated_bytes[3] / sizes.estimated_rows[3]) > (
+            sizes.estimated_bytes[0] / sizes.estimated_rows[0]
+        )
+
+    def test_plan_metrics_batches_small_workflow_uses_one_batch(self, runtime):
+        batches = batching.plan_metrics_batches(runtime, num_threads=8)
+
+        assert len(batches) == 1
+        assert sorted(batches[0].instance_ids) == [1, 2, 3, 4, 5, 6]
+
+    def test_plan_metrics_batches_balances_batches(self, runtime):
+        batches = batching.plan_metrics_batches(
+            runtime, num_threads=2, target_batch_bytes=100_000
+        )
+        sizes = batching.estimate_instance_metrics_size(runtime)
+
+        # Every instance is fetched exactly once
+        fetched = [i for batch in batches for i in batch.instance_ids]
+        assert sorted(fetched) == [1, 2, 3, 4, 5, 6]
+        # Batches are ordered largest first
+        estimated = [batch.estimated_bytes for batch in batches]
+        assert estimated == sorted(estimated, reverse=True)
+        assert sum(estimated) == sizes.estimated_bytes.sum()
+        # The largest instance gets a batch of its own
+        assert batches[0].instance_ids == [4]
+
+    def test_plan_metrics_batches_respects_limits(self, runtime):
+        batches = batching.plan_metrics_batches(
+            runtime, num_threads=8, target_batch_bytes=1, max_batches=3
+        )
+        assert len(batches) == 3
+
+        batches = batching.plan_metrics_batches(runtime, max_ids_per_batch=2)
+        assert all(len(batch) <= 2 for batch in batches)
+        assert sum(len(batch) for batch in batches) == 6
+
+    def test_plan_metrics_batches_empty_runtime(self, runtime):
+        assert batching.plan_metrics_batches(runtime.iloc[0:0]) == []
+
+    @pytest.fixture
+    def timed_runtime(self, runtime):
+        return runtime.assign(
+            runtime_start_time=pd.to_datetime(
+                [
+                    "2024-01-01 00:00",
+                    "2024-01-03 00:00",
+                    "2024-01-01 01:00",
+                    "2024-01-03 02:00",
+                    None,
+                    "2024-01-01 02:00",
+                ],
+                utc=True,
+            ),
+            # VM 1 booted for 30 minutes before its first sample, VM 6 has no
+            # samples yet
+            metrics_start_time=pd.to_datetime(
+                [
+                    "2024-01-01 00:30:00",
+                    "2024-01-03 00:00:00",
+                    "2024-01-01 01:00:00",
+                    "2024-01-03 02:00:00",
+                    "2024-01-02 00:00:00",
+                    None,
+                ],
+                utc=True,
+            ),
+            metrics_end_time=pd.to_datetime(
+                [
+                    "2024-01-01 01:30:00",
+                    "2024-01-03 00:01:00",
+                    "2024-01-01 01:10:00",
+                    "2024-01-03 04:00:00",
+                    "2024-01-02 00:00:10",
+                    None,
+                ],
+                utc=True,
+            ),
+        )
+
+    def test_estimate_instance_time_ranges(self, timed_runtime):
+        ranges = batching.estimate_instance_time_ranges(
+            timed_runtime,
+            padding=timedelta(minutes=10),
+            now=pd.Timestamp("2024-01-10", tz="UTC"),
+        )
+
+        # Padded around the samples, not from the start of the VM
+        assert ranges.start_time[0] == pd.Timestamp("2024-01-01 00:20", tz="UTC")
+        assert ranges.end_time[0] == pd.Timestamp("2024-01-01 01:40", tz="UTC")
+        assert ranges.start_time[4] == pd.Timestamp("2024-01-01 23:50", tz="UTC")
+        # VM 6 without samples starts with the VM, and may still record
+        assert ranges.start_time[5] == pd.Timestamp("2024-01-01 01:50", tz="UTC")
+        assert ranges.end_time.isna().tolist() == [False] * 5 + [True]
+
+    def test_recording_instances_have_no_end(self, timed_runtime):
+        ranges = batching.estimate_instance_time_ranges(
+            timed_runtime,
+            padding=timedelta(minutes=10),
+            now=pd.Timestamp("2024-01-03 04:05", tz="UTC"),
+        )
+
+        assert ranges.end_time.isna().tolist() == [False] * 3 + [True, False, True]
+
+    def test_plan_metrics_batches_by_start_time(self, timed_runtime):
+        batches = batching.plan_metrics_batches(
+            timed_runtime,
+            num_threads=2,
+            target_batch_bytes=100_000,
+            time_padding=timedelta(minutes=10),
+            now=pd.Timestamp("2024-01-10", tz="UTC"),
+        )
+
+        fetched = [i for batch in batches for i in batch.instance_ids]
+        assert sorted(fetched) == [1, 2, 3, 4, 5, 6]
+        estimated = [batch.estimated_bytes for batch in batches]
+        assert estimated == sorted(estimated, reverse=True)
+        # Batches hold VMs consecutive by start time, over the time of their samples
+        by_ids = {tuple(batch.instance_ids): batch for batch in batches}
+        assert list(by_ids) == [(4,), (1,), (3, 6, 5, 2)]
+        assert by_ids[(1,)].start_time == pd.Timestamp("2024-01-01 00:20", tz="UTC")
+        assert by_ids[(1,)].end_time == pd.Timestamp("2024-01-01 01:40", tz="UTC")
+        assert by_ids[(3, 6, 5, 2)].start_time == pd.Timestamp(
+            "2024-01-01 00:50", tz="UTC"
+        )
+        # VM 6 may still record, so its batch ends with the queried window
+        assert by_ids[(3, 6, 5, 2)].end_time is None
+
+    def test_plan_metrics_batches_without_sample_times(self, runtime):
+        batches = batching.plan_metrics_batches(
+            runtime, time_padding=timedelta(minutes=10)
+        )
+
+        assert [(batch.start_time, batch.end_time) for batch in batches] == [
+            (None, None)
+        ]
+
+    def test_plan_metrics_batches_by_start_time_empty_runtime(self, timed_runtime):
+        assert (
+            batching.plan_metrics_batches(
+                timed_runtime.iloc[0:0], time_padding=timedelta(minutes=10)
+            )
+            == []
+        )
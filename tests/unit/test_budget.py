@@ -0,0 +1,48 @@
+import pytest
+
+from cromonitor.query import budget
+
+
+class TestBudget:
+    def test_metrics_strategies(self):
+        assert [strategy.name for strategy in budget.metrics_strategies("raw")] == [
+            "raw",
+            "raw, single query",
+            "bucketed",
+            "bucketed, single query",
+            "summary",
+        ]
+        assert budget.metrics_strategies("summary") == [
+            budget.MetricsStrategy("summary")
+        ]
+
+    def test_query_plan(self):
+        plan = budget.QueryPlan(
+            strategy=budget.MetricsStrategy("raw"),
+            queries=[
+                budget.PlannedQuery("runtime", 100),
+                budget.PlannedQuery("raw metrics", 1000, count=4),
+            ],
+            budget_bytes=4000,
+        )
+
+        assert plan.total_bytes == 4100
+        assert not plan.fits_budget()
+        assert plan.to_dataframe().total_bytes.tolist() == [100, 4000]
+        assert "raw metrics" in str(plan)
+
+    def test_choose_plan(self):
+        def plan(metrics_mode, metrics_bytes, budget_bytes):
+            return budget.QueryPlan(
+                strategy=budget.MetricsStrategy(metrics_mode),
+                queries=[budget.PlannedQuery("metrics", metrics_bytes)],
+                budget_bytes=budget_bytes,
+            )
+
+        plans = [plan("raw", 1000, 500), plan("summary", 400, 500)]
+
+        assert budget.choose_plan(plans) is plans[1]
+        with pytest.raises(budget.QueryBudgetExceededError) as e:
+            budget.choose_plan([plan("raw", 1000, 100), plan("summary", 400, 100)])
+        assert e.value.plan.strategy.metrics_mode == "summary"
+        assert isinstance(e.value, RuntimeError)
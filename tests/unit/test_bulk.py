@@ -0,0 +1,86 @@
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cromonitor.query import bulk
+
+WINDOW = {"days_back_upper_bound": 3, "days_back_lower_bound": 0}
+
+
+@pytest.fixture
+def fake_bigquery(fake_bq_client):
+    with patch(
+        "cromonitor.query.queryBQ.get_bigquery_client", return_value=fake_bq_client
+    ):
+        yield fake_bq_client
+
+
+@pytest.fixture
+def query_workflows(fake_bigquery):
+    def _query_workflows(workflows):
+        return bulk.query_workflows(
+            workflows=workflows, bq_goolge_project="my-project", **WINDOW
+        )
+
+    return _query_workflows
+
+
+class TestBulk:
+    def test_query_workflows_scans_tables_once(self, query_workflows, fake_bigquery):
+        collection = query_workflows(["wf1", "wf2"])
+
+        runtime_queries = [
+            parameters
+            for sql, parameters in fake_bigquery.queries
+            if "cromwell_monitoring.runtime" in sql
+        ]
+        assert len(runtime_queries) == 1
+        assert sorted(runtime_queries[0]["workflow_ids"]) == ["wf1", "wf2"]
+        assert list(collection) == ["wf1", "wf2"]
+        assert collection.instance_counts().to_dict() == {"wf1": 2, "wf2": 1}
+
+    def test_workflow_slices(self, query_workflows):
+        collection = query_workflows(["wf1", "wf2"])
+
+        wf1 = collection["wf1"]
+        wf2 = collection["wf2"]
+
+        assert wf1.runtime.runtime_instance_id.tolist() == [11, 12]
+        assert sorted(wf1.metrics.metrics_instance_id.tolist()) == [11, 11, 11, 12, 12]
+        assert wf1.metadata.meta_instance_name.tolist() == ["vm-11", "vm-12"]
+        assert wf2.metadata_runtime.runtime_instance_name.tolist() == ["vm-21"]
+        assert wf2.metrics.metrics_instance_id.tolist() == [21, 21]
+        # Workflows share the memory of the collection tables
+        assert np.shares_memory(
+            wf1.metrics.metrics_mem_used_gb.to_numpy(),
+            collection.metrics.metrics_mem_used_gb.to_numpy(),
+        )
+        with pytest.raises(KeyError):
+            collection["wf3"]
+
+    def test_subworkflows_are_grouped_with_their_workflow(self, query_workflows):
+        collection = query_workflows({"parent": ["wf1", "wf2"]})
+
+        assert list(collection) == ["parent"]
+        assert collection["parent"].workflow_ids == ["parent", "wf1", "wf2"]
+        assert len(collection["parent"].runtime) == 3
+
+    def test_query_submission(self, fake_bigquery):
+        submission_workflows = pd.DataFrame({"workflowId": ["wf1", "wf2"]})
+
+        with patch(
+            "cromonitor.query.bulk.get_submission_workflow_ids",
+            return_value=submission_workflows,
+        ):
+            collection = bulk.query_submission(
+                workspace_namespace="namespace",
+                workspace_name="workspace",
+                submission_id="submission",
+                bq_goolge_project="my-project",
+                **WINDOW,
+            )
+
+        assert list(collection) == ["wf1", "wf2"]
+        assert collection["wf2"].runtime.runtime_instance_id.tolist() == [21]
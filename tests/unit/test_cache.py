@@ -0,0 +1,140 @@
+from datetime import datetime
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cromonitor.query import cache
+from cromonitor.query.monitoring_sql import (
+    instance_ids_parameter,
+    workflow_ids_parameter,
+)
+
+
+class TestQueryFingerprint:
+    def test_query_fingerprint(self):
+        def fingerprint(**kwargs):
+            arguments = {
+                "project": "my-project",
+                "workflow_ids": ["wf1", "wf2"],
+                "start_time": datetime(2024, 1, 1),
+                "end_time": datetime(2024, 1, 3),
+                "sql": "SELECT 1",
+                "query_parameters": [instance_ids_parameter([1, 2])],
+            }
+            arguments.update(kwargs)
+            return cache.query_fingerprint(**arguments)
+
+        key = fingerprint()
+
+        assert key == fingerprint(workflow_ids=["wf2", "wf1"])
+        assert key == fingerprint(query_parameters=[instance_ids_parameter([2, 1])])
+        assert key != fingerprint(project="other-project")
+        assert key != fingerprint(workflow_ids=["wf1"])
+        assert key != fingerprint(end_time=datetime(2024, 1, 4))
+        assert key != fingerprint(sql="SELECT 2")
+        assert key != fingerprint(query_parameters=[instance_ids_parameter([1, 3])])
+        assert key != fingerprint(query_parameters=[workflow_ids_parameter(["1"])])
+
+    def test_workflows_finished(self):
+        metadata = pd.DataFrame(
+            {
+                "meta_execution_status": ["Done", "RetryableFailure"],
+                "meta_end_time": pd.to_datetime(["2024-01-01", "2024-01-02"]),
+            }
+        )
+
+        assert cache.workflows_finished(metadata)
+        assert not cache.workflows_finished(
+            metadata.assign(meta_execution_status=["Done", "Running"])
+        )
+        assert not cache.workflows_finished(
+            metadata.assign(meta_end_time=[pd.Timestamp("2024-01-01"), pd.NaT])
+        )
+        assert not cache.workflows_finished(metadata.iloc[0:0])
+
+
+class TestQueryResultCache:
+    @pytest.fixture
+    def metrics(self):
+        return pd.DataFrame(
+            {
+                "metrics_instance_id": pd.array([1, 1, 2], dtype="Int64"),
+                "metrics_timestamp": pd.to_datetime(
+                    [
+                        "2024-01-01 00:00:00",
+                        "2024-01-01 00:00:01",
+                        "2024-01-01 00:00:00",
+                    ],
+                    utc=True,
+                ),
+                "metrics_cpu_used_percent": [
+                    np.array([10.0, 20.0]),
+                    np.array([30.0, 40.0]),
+                    np.array([50.0]),
+                ],
+                "metrics_mem_used_gb": [1.0, 2.0, 3.0],
+            }
+        )
+
+    def test_put_and_get(self, tmp_path, metrics):
+        result_cache = cache.QueryResultCache(cache_dir=str(tmp_path))
+
+        assert result_cache.get("key") is None
+        result_cache.put("key", metrics)
+        cached = result_cache.get("key")
+
+        pd.testing.assert_frame_equal(
+            cached.drop(columns="metrics_cpu_used_percent"),
+            metrics.drop(columns="metrics_cpu_used_percent"),
+        )
+        assert [list(values) for values in cached.metrics_cpu_used_percent] == [
+            [10.0, 20.0],
+            [30.0, 40.0],
+            [50.0],
+        ]
+        # Entries are shared between cache instances using the same directory
+        assert cache.QueryResultCache(cache_dir=str(tmp_path)).get("key") is not None
+
+    def test_running_entries_expire(self, tmp_path, metrics):
+        result_cache = cache.QueryResultCache(
+            cache_dir=str(tmp_path), running_ttl_sec=60
+        )
+        result_cache.put("running", metrics)
+        result_cache.put("finished", metrics)
+        result_cache.mark_finished(["finished"])
+
+        with patch("cromonitor.query.cache.time.time", return_value=1e12):
+            assert result_cache.get("running") is None
+            assert result_cache.get("finished") is not None
+
+        assert result_cache.get("running") is None
+
+    def test_least_recently_used_entries_are_evicted(self, tmp_path, metrics):
+        result_cache = cache.QueryResultCache(
+            cache_dir=str(tmp_path), running_ttl_sec=float("inf")
+        )
+        result_cache.put("first", metrics)
+        entry_size = result_cache.size_bytes()
+        result_cache.max_size_bytes = 2 * entry_size
+
+        with patch("cromonitor.query.cache.time.time", return_value=1e12):
+            result_cache.put("second", metrics)
+        with patch("cromonitor.query.cache.time.time", return_value=2e12):
+            # Using the first entry makes the second one the least recently used
+            result_cache.get("first")
+            result_cache.put("third", metrics)
+
+        assert result_cache.get("first") is not None
+        assert result_cache.get("second") is None
+        assert result_cache.get("third") is not None
+        assert result_cache.size_bytes() <= result_cache.max_size_bytes
+
+    def test_unreadable_entry_is_dropped(self, tmp_path, metrics):
+        result_cache = cache.QueryResultCache(cache_dir=str(tmp_path))
+        result_cache.put("key", metrics)
+        (tmp_path / "key.parquet").write_bytes(b"not parquet")
+
+        assert result_cache.get("key") is None
+        assert not (tmp_path / "key.json").exists()
@@ -0,0 +1,80 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from cromonitor.query import checkpoint
+
+
+class FakeJob:
+    job_id = "job-1"
+    location = "EU"
+
+
+@pytest.fixture
+def metrics():
+    return pd.DataFrame(
+        {
+            "metrics_instance_id": pd.array([11, 11, 12], dtype="Int64"),
+            "metrics_timestamp": pd.to_datetime([0, 1, 0], unit="s", utc=True),
+            "metrics_cpu_used_percent": [[10.0], [20.0, 30.0], [40.0]],
+        }
+    )
+
+
+class TestMetricsCheckpoint:
+    def test_batch_key(self):
+        assert checkpoint.batch_key([12, 11]) == checkpoint.batch_key([11, 12])
+        assert checkpoint.batch_key([11]) != checkpoint.batch_key([11, 12])
+
+    def test_finished_batches_are_loaded(self, tmp_path, metrics):
+        metrics_checkpoint = checkpoint.MetricsCheckpoint(str(tmp_path), "session")
+        metrics_checkpoint.batch([12, 11]).finish(metrics)
+        metrics_checkpoint.batch([13]).finish(pd.DataFrame())
+
+        reopened = checkpoint.MetricsCheckpoint(str(tmp_path), "session")
+
+        assert reopened.finished_instance_ids() == {11, 12, 13}
+        assert reopened.started_batches() == []
+        loaded = reopened.load_metrics()
+        assert loaded.metrics_instance_id.tolist() == [11, 11, 12]
+        assert loaded.metrics_cpu_used_percent.apply(list).tolist() == [
+            [10.0],
+            [20.0, 30.0],
+            [40.0],
+        ]
+        assert reopened.load_metrics(dtype_backend="pyarrow").dtypes[
+            "metrics_instance_id"
+        ] == pd.ArrowDtype(pa.int64())
+
+    def test_started_batches_keep_their_job(self, tmp_path, metrics):
+        metrics_checkpoint = checkpoint.MetricsCheckpoint(str(tmp_path), "session")
+        batch = metrics_checkpoint.batch([11, 12])
+        batch.start(FakeJob())
+
+        reopened = checkpoint.MetricsCheckpoint(str(tmp_path), "session")
+
+        assert reopened.started_batches() == [[11, 12]]
+        assert reopened.finished_instance_ids() == set()
+        assert reopened.batch([12, 11]).job == {"job_id": "job-1", "location": "EU"}
+
+        reopened.batch([11, 12]).finish(metrics)
+        assert reopened.started_batches() == []
+        assert reopened.batch([11, 12]).job["job_id"] == "job-1"
+
+    def test_jobs_without_id_are_not_recorded(self, tmp_path):
+        metrics_checkpoint = checkpoint.MetricsCheckpoint(str(tmp_path), "session")
+
+        metrics_checkpoint.batch([11]).start(object())
+
+        assert metrics_checkpoint.started_batches() == []
+
+    def test_checkpoint_of_other_query_is_discarded(self, tmp_path, metrics):
+        checkpoint.MetricsCheckpoint(str(tmp_path), "session").batch([11]).finish(
+            metrics
+        )
+
+        other = checkpoint.MetricsCheckpoint(str(tmp_path), "other session")
+
+        assert other.finished_instance_ids() == set()
+        assert other.load_metrics().empty
+        assert [path.name for path in tmp_path.iterdir()] == [checkpoint.MANIFEST_FILE]
@@ -0,0 +1,84 @@
+import logging
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from cromonitor.logging import logging as log
+from cromonitor.query import clients
+
+
+@pytest.fixture(autouse=True)
+def empty_registry():
+    clients.clear_clients()
+    yield
+    clients.clear_clients()
+
+
+@pytest.fixture
+def fake_google():
+    with patch(
+        "cromonitor.query.clients.google_auth.default",
+        return_value=(MagicMock(), "default-project"),
+    ) as default:
+        with patch(
+            "cromonitor.query.clients.bigquery.Client",
+            side_effect=lambda project, credentials, _http: MagicMock(
+                project=project, _http=_http
+            ),
+        ) as client:
+            yield default, client
+
+
+def _pool_size(session):
+    return session.get_adapter("https://bigquery.googleapis.com")._pool_maxsize
+
+
+class TestClients:
+    def test_credentials_fetched_once(self, fake_google):
+        default, client = fake_google
+
+        first = clients.get_bigquery_client()
+        second = clients.get_bigquery_client()
+        other = clients.get_bigquery_client(project="billing-project")
+
+        assert default.call_count == 1
+        assert client.call_count == 2
+        assert first is second
+        assert first.project == "default-project"
+        assert other.project == "billing-project"
+
+    def test_pool_grows_on_demand(self, fake_google):
+        bq_client = clients.get_bigquery_client(pool_size=4)
+        assert _pool_size(bq_client._http) == 4
+
+        assert clients.get_bigquery_client(pool_size=16) is bq_client
+        assert _pool_size(bq_client._http) == 16
+
+        clients.get_bigquery_client(pool_size=2)
+        assert _pool_size(bq_client._http) == 16
+
+    def test_clear_clients(self, fake_google):
+        default, _ = fake_google
+        bq_client = clients.get_bigquery_client()
+
+        clients.clear_clients()
+
+        assert clients.get_bigquery_client() is not bq_client
+        assert default.call_count == 2
+
+
+class TestConfigureLogger:
+    def test_handler_added_once(self):
+        root = logging.getLogger()
+        handlers = list(root.handlers)
+        level = root.level
+        try:
+            log.configure_logger(debug=True)
+            log.configure_logger()
+
+            added = [h for h in root.handlers if h.get_name() == log.HANDLER_NAME]
+            assert len(added) == 1
+            assert root.level == logging.INFO
+        finally:
+            root.handlers = handlers
+            root.setLevel(level)
@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cromonitor.plotting import data_processing
+
+
+class TestDataProcessing:
+    @pytest.fixture
+    def metrics_runtime(self):
+        return pd.DataFrame(
+            {
+                "metrics_instance_id": [1, 1, 1, 2, 2, 3],
+                "metrics_cpu_used_percent": [
+                    [10.0, 30.0],
+                    [50.0, 70.0],
+                    [90.0, np.nan],
+                    [100.0],
+                    [0.0],
+                    [40.0],
+                ],
+                "metrics_mem_used_gb": [1.0, 2.0, 1.5, 4.0, 3.0, 8.0],
+                "metrics_disk_used_gb": [
+                    [1.0, 9.0],
+                    [2.0, 9.0],
+                    [3.0, 9.0],
+                    [5.0],
+                    [6.0],
+                    [7.0],
+                ],
+                "metrics_disk_read_iops": [[0.0]] * 6,
+                "metrics_disk_write_iops": [[1.0]] * 6,
+                "runtime_task_call_name": ["task1"] * 5 + ["task2"],
+                "runtime_shard": [0, 0, 0, 1, 1, 0],
+                "metrics_duration_sec": [2, 2, 2, 1, 1, 0],
+            }
+        )
+
+    @pytest.fixture
+    def metrics_summary_runtime(self, metrics_runtime):
+        # Same aggregation as the summary query in QueryBQToMonitor
+        samples = metrics_runtime.assign(
+            cpu_mean_percent=metrics_runtime.metrics_cpu_used_percent.apply(np.nanmean),
+            first_disk_used_gb=metrics_runtime.metrics_disk_used_gb.str[0],
+        )
+        summary = (
+            samples.groupby("metrics_instance_id")
+            .agg(
+                summary_sample_count=("cpu_mean_percent", "size"),
+                summary_cpu_mean_percent=("cpu_mean_percent", "mean"),
+                summary_cpu_max_percent=("cpu_mean_percent", "max"),
+                summary_mem_max_gb=("metrics_mem_used_gb", "max"),
+                summary_disk_max_gb=("first_disk_used_gb", "max"),
+            )
+            .reset_index()
+        )
+        runtime = metrics_runtime.drop_duplicates("metrics_instance_id")[
+            [
+                "metrics_instance_id",
+                "runtime_task_call_name",
+                "runtime_shard",
+                "metrics_duration_sec",
+            ]
+        ]
+        return summary.merge(runtime, on="metrics_instance_id")
+
+    def test_is_metrics_summary(self, metrics_runtime, metrics_summary_runtime):
+        assert not data_processing.is_metrics_summary(metrics_runtime)
+        assert data_processing.is_metrics_summary(metrics_summary_runtime)
+
+    def test_calculate_shard_metrics_from_summary(
+        self, metrics_runtime, metrics_summary_runtime
+    ):
+        expected = data_processing.calculate_shard_metrics(
+            summary_shards=[0, 1],
+            metrics_runtime=metrics_runtime,
+            task_name_input="task1",
+            mean_of_string=data_processing.mean_of_string,
+        )
+
+        result = data_processing.calculate_shard_metrics_from_summary(
+            metrics_summary_runtime=metrics_summary_runtime, task_name_input="task1"
+        )
+
+        assert len(result) == len(expected)
+        for result_dict, expected_dict in zip(result, expected):
+            assert result_dict.keys() == expected_dict.keys()
+            for shard in expected_dict:
+                assert result_dict[shard] == pytest.approx(expected_dict[shard])
+
+    def test_calculate_shard_metrics_vectorized(self, metrics_runtime):
+        expected = data_processing.calculate_shard_metrics(
+            summary_shards=[0, 1],
+            metrics_runtime=metrics_runtime,
+            task_name_input="task1",
+            mean_of_string=data_processing.mean_of_string,
+        )
+
+        result = data_processing.calculate_shard_metrics(
+            summary_shards=[0, 1],
+            metrics_runtime=metrics_runtime,
+            task_name_input="task1",
+        )
+
+        assert len(result) == len(expected)
+        for result_dict, expected_dict in zip(result, expected):
+            assert result_dict == pytest.approx(expected_dict)
+
+    @pytest.fixture
+    def metrics_bucketed_runtime(self):
+        buckets = {
+            "metrics_instance_id": [1, 1, 2],
+            "metrics_timestamp": pd.to_datetime(
+                ["2024-01-01 00:00", "2024-01-01 00:01", "2024-01-01 00:00"], utc=True
+            ),
+            "metrics_sample_count": [60, 30, 10],
+        }
+        for resource, values in {
+            "cpu_used_percent": [(0, 10, 20), (40, 40, 40), (50, 60, 70)],
+            "mem_used_gb": [(1, 2, 3), (3, 3, 4), (5, 6, 7)],
+            "disk_used_gb": [(1, 1, 1), (2, 2, 2), (3, 3, 3)],
+            "disk_read_iops": [(0, 1, 2), (0, 1, 2), (0, 1, 2)],
+            "disk_write_iops": [(0, 1, 2), (0, 1, 2), (0, 1, 2)],
+        }.items():
+            for position, statistic in enumerate(["min", "mean", "max"]):
+                buckets[f"metrics_{resource}_{statistic}"] = [
+                    float(value[position]) for value in values
+                ]
+        buckets["runtime_task_call_name"] = ["task1", "task1", "task1"]
+        buckets["runtime_shard"] = [0, 0, 1]
+        buckets["metrics_duration_sec"] = [90, 90, 10]
+        return pd.DataFrame(buckets)
+
+    def test_get_resource_usage_arrays_raw(self, metrics_runtime):
+        usage, bands = data_processing.get_resource_usage_arrays(
+            metrics_runtime.iloc[3:5]
+        )
+
+        assert bands == {}
+        assert list(usage["cpu"]) == [100.0, 0.0]
+        assert list(usage["mem"]) == [4.0, 3.0]
+        assert list(usage["disk"]) == [5.0, 6.0]
+
+    def test_get_resource_usage_arrays_bucketed(self, metrics_bucketed_runtime):
+        usage, bands = data_processing.get_resource_usage_arrays(
+            metrics_bucketed_runtime.iloc[0:2]
+        )
+
+        assert list(usage["cpu"]) == [10.0, 40.0]
+        assert list(bands["cpu"][0]) == [0.0, 40.0]
+        assert list(bands["cpu"][1]) == [20.0, 40.0]
+        assert set(usage) == set(bands) == set(data_processing.RESOURCE_USAGE_COLUMNS)
+
+    def test_bucketed_metrics_to_summary(self, metrics_bucketed_runtime):
+        summary = data_processing.bucketed_metrics_to_summary(
+            metrics_bucketed_runtime
+        ).set_index("metrics_instance_id")
+
+        assert data_processing.is_metrics_summary(summary)
+        assert summary.loc[1, "summary_sample_count"] == 90
+        # Mean of the buckets weighted by their number of samples
+        assert summary.loc[1, "summary_cpu_mean_percent"] == pytest.approx(20.0)
+        assert summary.loc[1, "summary_cpu_max_percent"] == 40.0
+        assert summary.loc[1, "summary_mem_max_gb"] == 4.0
+        assert summary.loc[2, "runtime_shard"] == 1
+        assert summary.loc[2, "metrics_duration_sec"] == 10
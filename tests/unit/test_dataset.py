@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cromonitor.plotting import plotting
+from cromonitor.table import utils as tableUtils
+from cromonitor.table.dataset import INSTANCE_CODE_COLUMN, MonitoringDataset
+
+
+@pytest.fixture
+def metadata_runtime():
+    return pd.DataFrame(
+        {
+            "runtime_workflow_id": ["wf1", "wf1", "wf1", "wf2", "wf1"],
+            "runtime_task_call_name": ["align", "align", "sort", "align", "idle"],
+            "runtime_shard": pd.array([1, 0, -1, 0, -1], dtype="Int64"),
+            "runtime_instance_id": pd.array([12, 11, 13, 21, 14], dtype="Int64"),
+            "metrics_duration_sec": pd.array([30, 20, 50, 10, 5], dtype="Int64"),
+            "meta_duration_sec": [None, None, None, None, None],
+        }
+    )
+
+
+@pytest.fixture
+def metrics():
+    instance_ids = [13, 11, 12, 11, 21, 99, 12, 13]
+    return pd.DataFrame(
+        {
+            "metrics_timestamp": pd.to_datetime(
+                [5, 2, 3, 1, 4, 1, 1, 4], unit="s", utc=True
+            ),
+            "metrics_instance_id": pd.array(instance_ids, dtype="Int64"),
+            "metrics_mem_used_gb": np.arange(8, dtype=float),
+            "metrics_cpu_used_percent": [np.array([float(i)]) for i in range(8)],
+        }
+    )
+
+
+def _merged(metrics, metadata_runtime, **filters):
+    merged = tableUtils.create_metrics_runtime_table(
+        metrics=metrics, metadata_runtime=metadata_runtime
+    )
+    for column, value in filters.items():
+        merged = merged.loc[merged[column] == value]
+    return merged.sort_values(["runtime_instance_id", "metrics_timestamp"])
+
+
+class TestMonitoringDataset:
+    def test_task_and_shard_indexes(self, metrics, metadata_runtime):
+        dataset = MonitoringDataset(metrics=metrics, metadata_runtime=metadata_runtime)
+
+        assert dataset.task_names() == ["align", "idle", "sort"]
+        assert dataset.shards("align") == [0, 1]
+        # Shard 0 of align ran in two workflows
+        assert list(dataset.instance_codes("align", 0)) == [0, 1]
+        assert dataset.instances.runtime_instance_id.tolist() == [11, 21, 12, 14, 13]
+        assert dataset.metrics_rows("align") == slice(0, 5)
+        assert dataset.metrics_rows("idle") == slice(5, 5)
+        # The sample of the VM missing from metadata_runtime is dropped
+        assert len(dataset) == 7
+
+    def test_metrics_sorted_by_instance_and_time(self, metrics, metadata_runtime):
+        dataset = MonitoringDataset(metrics=metrics, metadata_runtime=metadata_runtime)
+
+        shard = dataset.task_metrics("align", 1)
+
+        assert (shard[INSTANCE_CODE_COLUMN] == 2).all()
+        assert shard.metrics_mem_used_gb.tolist() == [6.0, 2.0]
+        np.testing.assert_array_equal(dataset.offsets, [0, 2, 3, 5, 5, 7])
+
+    @pytest.mark.parametrize(
+        "task_name, shard", [(None, None), ("align", None), ("align", 0)]
+    )
+    def test_metrics_runtime_matches_merge(
+        self, metrics, metadata_runtime, task_name, shard
+    ):
+        dataset = MonitoringDataset(metrics=metrics, metadata_runtime=metadata_runtime)
+        filters = {}
+        if task_name is not None:
+            filters["runtime_task_call_name"] = task_name
+        if shard is not None:
+            filters["runtime_shard"] = shard
+
+        result = dataset.metrics_runtime(task_name, shard)
+
+        expected = _merged(metrics, metadata_runtime, **filters)
+        result = result.sort_values(["runtime_instance_id", "metrics_timestamp"])
+        pd.testing.assert_frame_equal(
+            result.reset_index(drop=True).astype({"runtime_task_call_name": object}),
+            expected.reset_index(drop=True),
+            check_dtype=False,
+            check_categorical=False,
+        )
+
+    def test_task_metadata_runtime(self, metrics, metadata_runtime):
+        dataset = MonitoringDataset(metrics=metrics, metadata_runtime=metadata_runtime)
+
+        rows = dataset.task_metadata_runtime("align", 0)
+
+        assert rows.runtime_instance_id.tolist() == [11, 21]
+
+    def test_unknown_task_or_shard(self, metrics, metadata_runtime):
+        dataset = MonitoringDataset(metrics=metrics, metadata_runtime=metadata_runtime)
+
+        with pytest.raises(KeyError):
+            dataset.metrics_rows("missing")
+        with pytest.raises(KeyError):
+            dataset.task_metrics("align", 7)
+
+    def test_task_summary_matches_get_task_summary(self, metrics, metadata_runtime):
+        dataset = MonitoringDataset(metrics=metrics, metadata_runtime=metadata_runtime)
+        merged = _merged(metrics, metadata_runtime).sort_values(
+            "metrics_duration_sec", ascending=False
+        )
+
+        expected = tableUtils.get_task_summary(
+            task_names=merged.runtime_task_call_name.unique(), df=merged
+        )
+
+        assert dataset.task_summary() == expected
+        assert list(dataset.task_summary()) == list(expected)
+
+    def test_smaller_than_merged_table(self, metadata_runtime):
+        n_samples = 20_000
+        metrics = pd.DataFrame(
+            {
+                "metrics_timestamp": pd.to_datetime(
+                    np.arange(n_samples), unit="s", utc=True
+                ),
+                "metrics_instance_id": pd.array(
+                    np.resize([11, 12, 13, 21], n_samples), dtype="Int64"
+                ),
+                "metrics_mem_used_gb": np.ones(n_samples),
+            }
+        )
+        merged = tableUtils.create_metrics_runtime_table(
+            metrics=metrics, metadata_runtime=metadata_runtime
+        )
+
+        dataset = MonitoringDataset(metrics=metrics, metadata_runtime=metadata_runtime)
+
+        assert dataset.memory_usage() * 3 < merged.memory_usage(deep=True).sum()
+
+    def test_dataset_without_metrics(self, metadata_runtime):
+        dataset = MonitoringDataset(
+            metrics=pd.DataFrame(), metadata_runtime=metadata_runtime.iloc[:0]
+        )
+
+        assert len(dataset) == 0
+        assert dataset.task_names() == []
+        assert dataset.offsets.tolist() == [0]
+        assert dataset.metrics_runtime().empty
+
+    def test_sorted_task_summary_of_monitor(self, mock_data):
+        class Monitor:
+            metrics = mock_data.metrics
+            metadata_runtime = mock_data.metadata_runtime
+            monitoring_dataset = MonitoringDataset(
+                metrics=mock_data.metrics, metadata_runtime=mock_data.metadata_runtime
+            )
+
+        from_dataset = plotting.get_sorted_task_summary(Monitor())
+        from_merged = plotting.get_sorted_task_summary(mock_data)
+
+        pd.testing.assert_frame_equal(from_dataset[0], from_merged[0])
+        assert from_dataset[1] == from_merged[1]
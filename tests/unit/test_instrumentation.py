@@ -0,0 +1,70 @@
+import json
+
+import pandas as pd
+
+from cromonitor.query.instrumentation import (
+    JOB_STATS_COLUMNS,
+    JobStatsReport,
+    QueryJobStats,
+)
+
+
+def job_stats(name, total_sec, **kwargs):
+    stats = QueryJobStats(name=name, source="bigquery")
+    stats.total_sec = total_sec
+    for attribute, value in kwargs.items():
+        setattr(stats, attribute, value)
+    return stats
+
+
+class TestJobStatsReport:
+    def test_to_dataframe(self):
+        report = JobStatsReport()
+        report.add(job_stats("runtime", 1.0, wait_sec=0.5, rows=2))
+        running = report.add(job_stats("raw metrics", None))
+        # Statistics are updated once the query is done
+        running.total_sec = 3.0
+
+        df = report.to_dataframe()
+
+        assert list(df.columns) == JOB_STATS_COLUMNS
+        assert df.name.tolist() == ["runtime", "raw metrics"]
+        assert df.total_sec.tolist() == [1.0, 3.0]
+        assert pd.isna(df.wait_sec[1])
+        assert len(report) == 2
+
+    def test_empty_report(self):
+        report = JobStatsReport()
+
+        assert report.to_dataframe().empty
+        assert json.loads(report.to_json()) == []
+        assert str(report) == "No queries run"
+
+    def test_to_json(self):
+        report = JobStatsReport(
+            [job_stats("runtime", 1.0, job_id="job-1", cache_hit=True)]
+        )
+
+        records = json.loads(report.to_json(indent=2))
+
+        assert records[0]["job_id"] == "job-1"
+        assert records[0]["cache_hit"] is True
+        assert records[0]["error"] is None
+        assert records[0]["started_at"].startswith(str(report.jobs[0].started_at.year))
+
+    def test_summary(self):
+        report = JobStatsReport(
+            [
+                job_stats("raw metrics", 2.0, download_sec=1.0, bytes_processed=10),
+                job_stats("raw metrics", 4.0, download_sec=3.0, bytes_processed=20),
+                job_stats("runtime", 1.0),
+            ]
+        )
+
+        summary = report.summary()
+
+        assert summary.loc["raw metrics", "count"] == 2
+        assert summary.loc["raw metrics", "download_sec"] == 4.0
+        assert summary.loc["raw metrics", "bytes_processed"] == 30
+        assert pd.isna(summary.loc["runtime", "download_sec"])
+        assert str(report).startswith("3 queries taking 7.0s in total: ")
@@ -0,0 +1,112 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from cromonitor.lazy import LazyModule, lazy_import
+
+# Modules of the package and the heavy dependencies they must not import until
+# they are used
+LIGHT_IMPORTS = {
+    "cromonitor.query.queryBQ": [
+        "google.cloud.bigquery",
+        "google.auth",
+        "google.api_core",
+        "matplotlib",
+        "plotly",
+    ],
+    "cromonitor.query.cost": ["google.cloud.bigquery", "google.auth", "plotly"],
+    "cromonitor.plotting.plotting": [
+        "matplotlib",
+        "seaborn",
+        "plotly",
+        "google.cloud.bigquery",
+    ],
+    "cromonitor.plotting.cost_plots": ["plotly", "matplotlib"],
+}
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "src")
+
+
+def _import_in_new_process(module: str) -> dict:
+    """
+    Import a module in a new interpreter, and get the modules it imported and the
+    time it took from -X importtime
+    """
+    code = (
+        "import json, sys\n"
+        f"import {module}\n"
+        "print(json.dumps(sorted(sys.modules)))\n"
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.abspath(SRC_DIR)] + env.get("PYTHONPATH", "").split(os.pathsep)
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True,
+    )
+    import_us = None
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            import_us = int(fields[1])
+    return {"modules": json.loads(result.stdout), "import_us": import_us}
+
+
+class TestLazyModule:
+    def test_imported_on_first_use(self, tmp_path, monkeypatch):
+        # A throwaway module, so no module of the package is imported twice
+        name = "cromonitor_lazy_test_module"
+        (tmp_path / f"{name}.py").write_text("VALUE = object()\n")
+        monkeypatch.syspath_prepend(str(tmp_path))
+        monkeypatch.delitem(sys.modules, name, raising=False)
+
+        module = LazyModule(name)
+        assert name not in sys.modules
+        assert "not loaded" in repr(module)
+
+        assert module.VALUE is sys.modules[name].VALUE
+
+    def test_attributes_set_on_module(self):
+        module = LazyModule("json")
+
+        module.lazy_test_value = 1
+        assert json.lazy_test_value == 1
+        del module.lazy_test_value
+        assert not hasattr(json, "lazy_test_value")
+
+    def test_lazy_import_of_imported_module(self):
+        assert lazy_import("json") is json
+
+    def test_missing_module_raises_on_use(self):
+        module = lazy_import("cromonitor.no_such_module")
+
+        with pytest.raises(ModuleNotFoundError):
+            module.anything
+
+
+class TestImportTime:
+    @pytest.mark.parametrize("module", sorted(LIGHT_IMPORTS))
+    def test_heavy_dependencies_not_imported(self, module):
+        imported = _import_in_new_process(module)
+
+        assert imported["import_us"] is not None
+        loaded = [
+            heavy
+            for heavy in LIGHT_IMPORTS[module]
+            if any(
+                name == heavy or name.startswith(f"{heavy}.")
+                for name in imported["modules"]
+            )
+        ]
+        assert loaded == [], (
+            f"Importing {module} took {imported['import_us'] / 1e6:.2f}s and "
+            f"imported {loaded}"
+        )
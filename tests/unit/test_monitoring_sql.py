@@ -0,0 +1,115 @@
+from datetime import date, datetime, timedelta, timezone
+from unittest.mock import patch
+
+import numpy as np
+import pandas as pd
+
+from cromonitor.query import monitoring_sql
+
+
+class TestMonitoringSql:
+    def test_days_back_to_date(self):
+        today = datetime.now(timezone.utc).date()
+
+        assert monitoring_sql.days_back_to_date(0) == today
+        assert monitoring_sql.days_back_to_date(3) == today - timedelta(days=3)
+
+    def test_days_back_to_time_window(self):
+        with patch(
+            "cromonitor.query.monitoring_sql.days_back_to_date",
+            side_effect=lambda days_back: date(2024, 1, 10) - timedelta(days_back),
+        ):
+            start_time, end_time = monitoring_sql.days_back_to_time_window(3, 0)
+
+        assert start_time == pd.Timestamp("2024-01-07", tz="UTC")
+        # The last day is included up to midnight
+        assert end_time == pd.Timestamp("2024-01-11", tz="UTC")
+
+    def test_workflow_time_window(self):
+        start_time, end_time = monitoring_sql.workflow_time_window(
+            datetime(2024, 1, 1, 12, 30),
+            datetime(2024, 1, 1, 14, 0, tzinfo=timezone.utc),
+            padding=timedelta(minutes=5),
+        )
+
+        assert start_time == pd.Timestamp("2024-01-01 12:25", tz="UTC")
+        assert end_time == pd.Timestamp("2024-01-01 14:05", tz="UTC")
+
+    def test_running_workflow_time_window(self):
+        _, end_time = monitoring_sql.workflow_time_window(
+            datetime(2024, 1, 1, tzinfo=timezone.utc), None
+        )
+
+        assert end_time > pd.Timestamp.now(tz="UTC")
+        unpadded_end_time = end_time - monitoring_sql.DEFAULT_TIME_PADDING
+        assert unpadded_end_time == unpadded_end_time.floor("h")
+
+    def test_query_parameters(self):
+        workflow_ids = monitoring_sql.workflow_ids_parameter(["wf1", "wf2"])
+        instance_ids = monitoring_sql.instance_ids_parameter(
+            np.array([1, 2], dtype="int64")
+        )
+        start_time, end_time = monitoring_sql.time_window_parameters(
+            datetime(2024, 1, 1), datetime(2024, 1, 3, tzinfo=timezone.utc)
+        )
+
+        assert (workflow_ids.name, workflow_ids.array_type) == (
+            "workflow_ids",
+            "STRING",
+        )
+        assert workflow_ids.values == ["wf1", "wf2"]
+        assert (instance_ids.name, instance_ids.array_type) == ("instance_ids", "INT64")
+        assert instance_ids.values == [1, 2]
+        assert all(isinstance(value, int) for value in instance_ids.values)
+        assert (start_time.name, start_time.type_, start_time.value) == (
+            "start_time",
+            "TIMESTAMP",
+            datetime(2024, 1, 1, tzinfo=timezone.utc),
+        )
+        assert end_time.name == "end_time"
+
+    def test_queries_reference_parameters(self):
+        builder = monitoring_sql.MonitoringQueryBuilder(bq_project="my-project")
+
+        for sql in [builder.runtime_query(), builder.metadata_query()]:
+            assert "IN UNNEST(@workflow_ids)" in sql
+            assert "@start_time" in sql and "@end_time" in sql
+            assert "CURRENT_DATE" not in sql
+            # The partitioning column is compared as is, so partitions are pruned
+            assert "DATE(" not in sql
+
+        for sql in [
+            builder.metrics_query(),
+            builder.metrics_summary_query(),
+            builder.metrics_bucketed_query(),
+        ]:
+            assert "`my-project.cromwell_monitoring.metrics`" in sql
+            assert "IN UNNEST(@instance_ids)" in sql
+            assert "CURRENT_DATE" not in sql
+
+        assert "@bucket_interval_sec" in builder.metrics_bucketed_query()
+
+    def test_query_text_is_stable(self):
+        # The SQL only depends on the project, so repeated reports hit the cache
+        assert (
+            monitoring_sql.MonitoringQueryBuilder("my-project").metrics_query()
+            == monitoring_sql.MonitoringQueryBuilder("my-project").metrics_query()
+        )
+        assert (
+            monitoring_sql.MonitoringQueryBuilder("my-project").runtime_query()
+            != monitoring_sql.MonitoringQueryBuilder("other-project").runtime_query()
+        )
+
+    def test_since_queries(self):
+        builder = monitoring_sql.MonitoringQueryBuilder(bq_project="my-project")
+        since = monitoring_sql.timestamp_parameter(
+            "metrics_since", datetime(2024, 1, 1, 12)
+        )
+
+        assert "@runtime_since" in builder.runtime_query(since=True)
+        assert "@runtime_since" not in builder.runtime_query()
+        for query in [builder.metrics_query, builder.metrics_bucketed_query]:
+            assert "@metrics_since" in query(since=True)
+            assert "@metrics_since" not in query()
+        assert (since.name, since.type_) == ("metrics_since", "TIMESTAMP")
+        assert since.value == datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
@@ -3,6 +3,8 @@ import pytest
 from matplotlib import pyplot as plt
 
 from cromonitor.plotting import plotting
+from cromonitor.query.utils import convert_dtype_backend
+from cromonitor.table.dataset import MonitoringDataset
 
 
 class TestPlotting:
@@ -53,6 +55,44 @@ class TestPlotting:
         pd.testing.assert_frame_equal(task_summary_df, expected_df)
         assert duration_sum == {"write_to_stdout": 171}
 
+    @pytest.mark.parametrize("with_dataset", [False, True])
+    def test_plot_resource_usage_with_pyarrow_dtypes(self, mock_data, with_dataset):
+        class Monitor:
+            metrics = convert_dtype_backend(mock_data.metrics, "pyarrow")
+            metadata_runtime = convert_dtype_backend(
+                mock_data.metadata_runtime, "pyarrow"
+            )
+            metrics_runtime = convert_dtype_backend(
+                mock_data.metrics_runtime, "pyarrow"
+            )
+
+        if with_dataset:
+            Monitor.monitoring_dataset = MonitoringDataset(
+                metrics=Monitor.metrics, metadata_runtime=Monitor.metadata_runtime
+            )
+
+        fig = plotting.plot_resource_usage(
+            df_monitoring=Monitor(),
+            parent_workflow_id="5f52afbb-28a5-4a1f-8cc6-60d3af22a625",
+            task_names=["write_to_stdout"],
+            plt_height=800,
+            plt_width=1000,
+        )
+
+        assert isinstance(fig, plt.Figure)
+        plt.close(fig)
+
+    def test_create_runtime_dict_with_pyarrow_dtypes(self, mock_data):
+        expected = plotting.create_runtime_dict(mock_data.metadata_runtime)
+
+        result = plotting.create_runtime_dict(
+            convert_dtype_backend(mock_data.metadata_runtime, "pyarrow")
+        )
+
+        assert result["available_mem_gb"] == expected["available_mem_gb"]
+        assert result["available_disk_gb"] == expected["available_disk_gb"]
+        assert result["requested_disk_gb"] is None
+
     @pytest.fixture
     def subplot(self):
         fig, ax = plt.subplots()
@@ -97,3 +137,19 @@ class TestPlotting:
             available_resource=4.0,
         )
         assert isinstance(result, plt.Axes)
+
+    def test_subplot_resource_usage_with_band(
+        self, subplot, df_monitoring_task_shard, resource_used_array, runtime_dic
+    ):
+        result = plotting.subplot_resource_usage(
+            subplot=subplot,
+            df_monitoring_task_shard=df_monitoring_task_shard,
+            resource_used_array=resource_used_array,
+            runtime_dic=runtime_dic,
+            task_shard_duration=100,
+            resource_label="CPU",
+            y_label="CPU % Used",
+            resource_band=([0, 10, 20, 30, 40], [20, 30, 40, 50, 60]),
+        )
+        assert isinstance(result, plt.Axes)
+        assert len(result.collections) == 1
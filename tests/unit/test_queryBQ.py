@@ -0,0 +1,691 @@
+import functools
+import json
+import threading
+from unittest.mock import patch
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from cromonitor.query.budget import QueryBudgetExceededError
+from cromonitor.query.queryBQ import QueryBQToMonitor
+
+
+@pytest.fixture
+def create_monitor(fake_bq_client):
+    def _create_monitor(**kwargs):
+        kwargs.setdefault("bq_client", fake_bq_client)
+        return QueryBQToMonitor(
+            workflow_ids=kwargs.pop("workflow_ids", ["wf1"]),
+            days_back_upper_bound=kwargs.pop("days_back_upper_bound", 3),
+            days_back_lower_bound=kwargs.pop("days_back_lower_bound", 0),
+            bq_goolge_project="my-project",
+            **kwargs,
+        )
+
+    return _create_monitor
+
+
+class TestQueryBQToMonitor:
+    def test_query(self, create_monitor, fake_bq_client):
+        monitor = create_monitor()
+
+        monitor.query()
+
+        assert monitor.runtime.runtime_instance_id.tolist() == [11, 12]
+        assert monitor.metadata_runtime.shape[0] == 2
+        assert sorted(monitor.metrics.metrics_instance_id.tolist()) == [
+            11,
+            11,
+            11,
+            12,
+            12,
+        ]
+
+    def test_monitoring_dataset(self, create_monitor):
+        monitor = create_monitor()
+        monitor.query()
+
+        dataset = monitor.monitoring_dataset
+
+        assert len(dataset) == 5
+        assert monitor.monitoring_dataset is dataset
+        monitor.metrics = monitor.metrics.iloc[:2]
+        assert len(monitor.monitoring_dataset) == 2
+
+    def test_query_with_pyarrow_dtypes(self, create_monitor, tmp_path):
+        monitor = create_monitor(dtype_backend="pyarrow", cache_dir=str(tmp_path))
+        monitor.query()
+        cached = create_monitor(dtype_backend="pyarrow", cache_dir=str(tmp_path))
+        cached.query()
+
+        for result in [monitor, cached]:
+            assert result.metrics.metrics_instance_id.dtype == pd.ArrowDtype(pa.int64())
+            assert result.metrics.metrics_mem_used_gb.dtype == pd.ArrowDtype(
+                pa.float64()
+            )
+            assert isinstance(
+                result.metadata_runtime.runtime_task_call_name.dtype,
+                pd.CategoricalDtype,
+            )
+            assert len(result.monitoring_dataset) == 5
+
+    def test_unknown_dtype_backend(self, create_monitor):
+        with pytest.raises(ValueError, match="dtype_backend"):
+            create_monitor(dtype_backend="cudf")
+
+    def test_query_records_job_stats(self, create_monitor):
+        monitor = create_monitor()
+
+        monitor.query()
+
+        job_stats = monitor.job_stats.to_dataframe()
+        assert job_stats.name.value_counts().to_dict() == {
+            "runtime": 1,
+            "metadata": 1,
+            "raw metrics": 1,
+        }
+        assert (job_stats.source == "bigquery").all()
+        assert job_stats.job_id.notna().all()
+        assert (job_stats.bytes_billed == 10 * 1024**2).all()
+        assert (job_stats.server_elapsed_sec == 2).all()
+        assert job_stats.set_index("name").rows["raw metrics"] == 5
+        for step in ["submit_sec", "wait_sec", "download_sec", "conversion_sec"]:
+            assert (job_stats[step] >= 0).all()
+        assert (
+            job_stats.total_sec >= job_stats.wait_sec + job_stats.download_sec
+        ).all()
+        assert json.loads(monitor.job_stats.to_json())[0]["name"] in set(job_stats.name)
+
+    def test_query_passes_ids_as_parameters(self, create_monitor, fake_bq_client):
+        create_monitor(workflow_ids=["wf1", "wf2"]).query()
+        first_run = [sql for sql, _ in fake_bq_client.queries]
+
+        fake_bq_client.queries.clear()
+        create_monitor(workflow_ids=["wf2"]).query()
+        second_run = [sql for sql, _ in fake_bq_client.queries]
+
+        for sql in first_run:
+            assert "wf1" not in sql and "wf2" not in sql
+            assert "11" not in sql
+        # Different workflows run the exact same SQL text
+        assert set(first_run) == set(second_run)
+        runtime_parameters = fake_bq_client.queries[0][1]
+        assert runtime_parameters["workflow_ids"] == ["wf2"]
+
+    def test_query_workflow_time_window(self, create_monitor, fake_bq_client):
+        monitor = create_monitor(
+            days_back_upper_bound=None,
+            days_back_lower_bound=None,
+            start_time=pd.Timestamp("2024-01-01 00:00:00", tz="UTC"),
+            end_time=pd.Timestamp("2024-01-01 02:00:00", tz="UTC"),
+        )
+
+        monitor.query()
+
+        for _, parameters in fake_bq_client.queries:
+            assert parameters["start_time"] == pd.Timestamp(
+                "2023-12-31 23:50:00", tz="UTC"
+            )
+            if "instance_ids" not in parameters:
+                assert parameters["end_time"] == pd.Timestamp(
+                    "2024-01-01 02:10:00", tz="UTC"
+                )
+        assert monitor.runtime.runtime_instance_id.tolist() == [11, 12]
+
+    def test_metrics_batches_query_their_time_range(
+        self, create_monitor, fake_bq_client
+    ):
+        monitor = create_monitor(
+            workflow_ids=["wf1", "wf2"],
+            days_back_upper_bound=None,
+            days_back_lower_bound=None,
+            start_time=pd.Timestamp("2024-01-01 00:00:00", tz="UTC"),
+            end_time=pd.Timestamp("2024-01-01 02:00:00", tz="UTC"),
+            num_threads=2,
+            target_batch_bytes=1,
+        )
+
+        monitor.query()
+
+        time_ranges = {
+            tuple(sorted(parameters["instance_ids"])): (
+                parameters["start_time"],
+                parameters["end_time"],
+            )
+            for _, parameters in fake_bq_client.queries
+            if "instance_ids" in parameters
+        }
+        # Every VM gets a batch, queried from 10 minutes before its first sample to
+        # 10 minutes after its last sample
+        assert time_ranges == {
+            (11,): (
+                pd.Timestamp("2023-12-31 23:50:00", tz="UTC"),
+                pd.Timestamp("2024-01-01 00:10:02", tz="UTC"),
+            ),
+            (12,): (
+                pd.Timestamp("2023-12-31 23:50:00", tz="UTC"),
+                pd.Timestamp("2024-01-01 00:10:01", tz="UTC"),
+            ),
+            (21,): (
+                pd.Timestamp("2024-01-01 00:50:00", tz="UTC"),
+                pd.Timestamp("2024-01-01 01:10:01", tz="UTC"),
+            ),
+        }
+        assert len(monitor.metrics) == 7
+
+    def test_time_window_is_required(self, create_monitor):
+        with pytest.raises(ValueError):
+            create_monitor(days_back_upper_bound=None)
+        with pytest.raises(ValueError):
+            create_monitor(start_time=pd.Timestamp("2024-01-01", tz="UTC"))
+
+    def test_failed_metrics_batch_is_fetched_again(
+        self, create_monitor, fake_bq_client
+    ):
+        fake_query = fake_bq_client.query
+        failures = []
+
+        def query(query, job_config=None):
+            if "cromwell_monitoring.metrics" in query and "runtime" not in query:
+                if not failures:
+                    failures.append(query)
+                    raise ConnectionError("Connection reset")
+            return fake_query(query, job_config=job_config)
+
+        fake_bq_client.query = query
+        monitor = create_monitor(num_threads=1)
+
+        with patch("cromonitor.query.queryBQ.time.sleep") as sleep:
+            monitor.query()
+
+        sleep.assert_called_once_with(monitor.refetch_backoff_sec)
+        assert sorted(monitor.metrics.metrics_instance_id.tolist()) == [
+            11,
+            11,
+            11,
+            12,
+            12,
+        ]
+        assert monitor.metrics_completeness.status.tolist() == [
+            "refetched",
+            "refetched",
+        ]
+
+    @pytest.mark.parametrize("streamed", [False, True])
+    def test_query_resumes_from_checkpoint(
+        self, create_monitor, fake_bq_client, tmp_path, streamed
+    ):
+        fake_query = fake_bq_client.query
+
+        def query(query, job_config=None):
+            parameters = {
+                p.name: getattr(p, "values", None) for p in job_config.query_parameters
+            }
+            if parameters.get("instance_ids") == [12] and not job_config.dry_run:
+                raise ConnectionError("Connection reset")
+            return fake_query(query, job_config=job_config)
+
+        fake_bq_client.query = query
+        checkpoint_dir = str(tmp_path / "checkpoint")
+        if streamed:
+            create_monitor = functools.partial(
+                create_monitor, metrics_dir=str(tmp_path / "metrics")
+            )
+        monitor = create_monitor(
+            checkpoint_dir=checkpoint_dir, target_batch_bytes=1, max_refetch_attempts=0
+        )
+        monitor.query()
+        assert monitor.metrics_completeness.status.tolist() == ["complete", "failed"]
+        assert monitor.checkpoint.finished_instance_ids() == {11}
+
+        fake_bq_client.query = fake_query
+        queries_count = len(fake_bq_client.queries)
+        resumed = create_monitor(checkpoint_dir=checkpoint_dir, target_batch_bytes=1)
+        resumed.query()
+
+        metrics_queries = [
+            parameters["instance_ids"]
+            for _, parameters in fake_bq_client.queries[queries_count:]
+            if "instance_ids" in parameters
+        ]
+        assert metrics_queries == [[12]]
+        assert sorted(resumed.metrics.metrics_instance_id.tolist()) == [
+            11,
+            11,
+            11,
+            12,
+            12,
+        ]
+        assert resumed.metrics_completeness.status.tolist() == [
+            "complete",
+            "complete",
+        ]
+        if streamed:
+            assert resumed.metrics_dataset.count_rows() == 5
+        # Cleared once every VM is fetched
+        assert resumed.checkpoint.finished_instance_ids() == set()
+
+    @pytest.mark.parametrize("expired", [False, True])
+    def test_started_batch_reuses_its_job(
+        self, create_monitor, fake_bq_client, tmp_path, expired
+    ):
+        fake_query = fake_bq_client.query
+
+        class InterruptedJob:
+            def __init__(self, query_job):
+                self.job_id = query_job.job_id
+                self.location = query_job.location
+
+            def result(self, page_size=None):
+                raise ConnectionError("Connection reset")
+
+        def query(query, job_config=None):
+            query_job = fake_query(query, job_config=job_config)
+            if "instance_ids" in {p.name for p in job_config.query_parameters}:
+                return InterruptedJob(query_job)
+            return query_job
+
+        fake_bq_client.query = query
+        checkpoint_dir = str(tmp_path / "checkpoint")
+        create_monitor(checkpoint_dir=checkpoint_dir, max_refetch_attempts=0).query()
+        job_ids = set(fake_bq_client.jobs)
+        if expired:
+            fake_bq_client.expired_job_ids.update(job_ids)
+
+        fake_bq_client.query = fake_query
+        queries_count = len(fake_bq_client.queries)
+        resumed = create_monitor(checkpoint_dir=checkpoint_dir)
+        resumed.query()
+
+        metrics_queries = [
+            parameters
+            for _, parameters in fake_bq_client.queries[queries_count:]
+            if "instance_ids" in parameters
+        ]
+        assert len(metrics_queries) == (1 if expired else 0)
+        assert resumed.metrics.shape[0] == 5
+
+    def test_query_jobs_are_labelled(self, create_monitor, fake_bq_client):
+        fake_query = fake_bq_client.query
+        labels = []
+
+        def query(query, job_config=None):
+            if not job_config.dry_run:
+                labels.append(job_config.labels)
+            return fake_query(query, job_config=job_config)
+
+        fake_bq_client.query = query
+        monitor = create_monitor()
+
+        monitor.query()
+
+        assert {label["cromonitor-session"] for label in labels} == {monitor.session_id}
+        assert sorted(label["cromonitor-query"] for label in labels) == [
+            "metadata",
+            "raw-metrics",
+            "runtime",
+        ]
+        assert len(monitor.running_jobs) == 0
+
+    def test_slow_batch_is_cancelled_and_fetched_again(
+        self, create_monitor, fake_bq_client
+    ):
+        fake_query = fake_bq_client.query
+        slow_jobs = []
+
+        class SlowJob:
+            def __init__(self, query_job):
+                self.job_id = query_job.job_id
+                self.location = query_job.location
+
+            def result(self, page_size=None):
+                for _ in range(500):
+                    if self.job_id in fake_bq_client.cancelled_job_ids:
+                        raise RuntimeError("Job cancelled")
+                    threading.Event().wait(0.01)
+                raise AssertionError("Job not cancelled")
+
+        def query(query, job_config=None):
+            query_job = fake_query(query, job_config=job_config)
+            if job_config.labels.get("cromonitor-query") == "raw-metrics":
+                if not slow_jobs:
+                    slow_jobs.append(SlowJob(query_job))
+                    return slow_jobs[0]
+            return query_job
+
+        fake_bq_client.query = query
+        monitor = create_monitor(batch_timeout_sec=0.1)
+
+        with patch("cromonitor.query.queryBQ.time.sleep"):
+            monitor.query()
+
+        assert fake_bq_client.cancelled_job_ids == [slow_jobs[0].job_id]
+        assert monitor.metrics.shape[0] == 5
+        assert monitor.metrics_completeness.status.tolist() == [
+            "refetched",
+            "refetched",
+        ]
+
+    def test_interrupted_query_cancels_running_jobs(
+        self, create_monitor, fake_bq_client
+    ):
+        fake_query = fake_bq_client.query
+        metadata_started = threading.Event()
+
+        class MetadataJob:
+            def __init__(self, query_job):
+                self.job_id = query_job.job_id
+                self.location = query_job.location
+
+            def result(self, page_size=None):
+                metadata_started.set()
+                for _ in range(500):
+                    if self.job_id in fake_bq_client.cancelled_job_ids:
+                        raise RuntimeError("Job cancelled")
+                    threading.Event().wait(0.01)
+                raise AssertionError("Job not cancelled")
+
+        class InterruptedJob:
+            def result(self, page_size=None):
+                metadata_started.wait(timeout=5)
+                raise KeyboardInterrupt
+
+        def query(query, job_config=None):
+            query_job = fake_query(query, job_config=job_config)
+            name = job_config.labels.get("cromonitor-query")
+            if name == "metadata":
+                return MetadataJob(query_job)
+            if name == "runtime":
+                return InterruptedJob()
+            return query_job
+
+        fake_bq_client.query = query
+        monitor = create_monitor()
+
+        with pytest.raises(KeyboardInterrupt):
+            monitor.query()
+
+        assert len(fake_bq_client.cancelled_job_ids) == 1
+        assert len(monitor.running_jobs) == 0
+
+    def test_missing_instances_are_reported(self, create_monitor, fake_bq_client):
+        fake_bq_client.metrics = fake_bq_client.metrics[
+            fake_bq_client.metrics.metrics_instance_id != 12
+        ]
+        monitor = create_monitor(max_refetch_attempts=2, refetch_backoff_sec=1)
+
+        with patch("cromonitor.query.queryBQ.time.sleep") as sleep:
+            monitor.query()
+
+        # The batch of VM 12 succeeded without rows, it is not waited for
+        sleep.assert_not_called()
+        report = monitor.metrics_completeness.set_index("instance_id")
+        assert report.status.to_dict() == {11: "complete", 12: "missing"}
+        assert report.refetch_attempts.to_dict() == {11: 0, 12: 2}
+
+    def test_refetch_backs_off_while_batches_fail(self, create_monitor, fake_bq_client):
+        fake_query = fake_bq_client.query
+
+        def query(query, job_config=None):
+            if job_config.labels.get("cromonitor-query") == "raw-metrics":
+                raise ConnectionError("Connection reset")
+            return fake_query(query, job_config=job_config)
+
+        fake_bq_client.query = query
+        monitor = create_monitor(max_refetch_attempts=3, refetch_backoff_sec=1)
+
+        with patch("cromonitor.query.queryBQ.time.sleep") as sleep:
+            monitor.query()
+
+        assert [call.args[0] for call in sleep.call_args_list] == [1, 2, 4]
+        assert monitor.metrics_completeness.status.tolist() == ["failed", "failed"]
+
+    def test_query_within_budget(self, create_monitor):
+        monitor = create_monitor(workflow_ids=["wf1"], query_budget_bytes=10_000)
+
+        monitor.query()
+
+        # Planned again once the VMs are known, they fit in a single batch
+        assert monitor.query_plan.strategy.name == "raw"
+        assert monitor.query_plan.to_dataframe().set_index("query")[
+            "count"
+        ].to_dict() == {"runtime": 1, "metadata": 1, "raw metrics": 1}
+        assert monitor.query_plan.total_bytes == 1020
+
+    def test_budget_counts_batches_over_their_time_range(
+        self, create_monitor, fake_bq_client
+    ):
+        fake_query = fake_bq_client.query
+
+        def query(query, job_config=None):
+            query_job = fake_query(query, job_config=job_config)
+            parameters = {
+                parameter.name: getattr(parameter, "value", None)
+                for parameter in job_config.query_parameters
+            }
+            if job_config.dry_run and "instance_ids" in parameters:
+                # Metrics queries scan 10 bytes per minute of their window
+                window = parameters["end_time"] - parameters["start_time"]
+                query_job.total_bytes_processed = int(window.total_seconds() / 6)
+            return query_job
+
+        fake_bq_client.query = query
+        monitor = create_monitor(
+            workflow_ids=["wf1", "wf2"],
+            days_back_upper_bound=None,
+            days_back_lower_bound=None,
+            start_time=pd.Timestamp("2024-01-01 00:00:00", tz="UTC"),
+            end_time=pd.Timestamp("2024-01-01 02:00:00", tz="UTC"),
+            target_batch_bytes=1,
+            query_budget_bytes=1500,
+        )
+
+        monitor.query()
+
+        # Three batches of about 20 minutes fit, three queries of the 140 minutes
+        # of the window would not
+        metrics_plan = monitor.query_plan.queries[-1]
+        assert monitor.query_plan.strategy.name == "raw"
+        assert metrics_plan.count == 3
+        assert metrics_plan.total_bytes == 600
+        assert monitor.query_plan.fits_budget()
+
+    def test_second_plan_starts_from_requested_strategy(
+        self, create_monitor, fake_bq_client
+    ):
+        fake_query = fake_bq_client.query
+
+        def query(query, job_config=None):
+            query_job = fake_query(query, job_config=job_config)
+            parameters = {
+                parameter.name: getattr(parameter, "value", None)
+                for parameter in job_config.query_parameters
+            }
+            if job_config.dry_run and "instance_ids" in parameters:
+                # Raw metrics scan 10 bytes per minute, buckets half as much
+                window = parameters["end_time"] - parameters["start_time"]
+                bytes_per_minute = 5 if "metrics_sample_count" in query else 10
+                query_job.total_bytes_processed = int(
+                    window.total_seconds() / 60 * bytes_per_minute
+                )
+            return query_job
+
+        fake_bq_client.query = query
+        monitor = create_monitor(
+            workflow_ids=["wf1", "wf2"],
+            days_back_upper_bound=None,
+            days_back_lower_bound=None,
+            start_time=pd.Timestamp("2024-01-01 00:00:00", tz="UTC"),
+            end_time=pd.Timestamp("2024-01-01 02:00:00", tz="UTC"),
+            target_batch_bytes=1,
+            query_budget_bytes=1000,
+        )
+
+        monitor.query()
+
+        # Only buckets fit over the whole window, raw metrics fit once the batches
+        # are known
+        assert monitor.query_plan.strategy.name == "raw"
+        assert monitor.metrics_mode == "raw"
+
+    def test_plan_picks_cheaper_strategy(self, create_monitor, fake_bq_client):
+        monitor = create_monitor(query_budget_bytes=5000, num_threads=8)
+
+        plan = monitor.plan()
+
+        # Before the VMs are known, batches are assumed to be one per thread
+        assert plan.strategy.name == "raw, single query"
+        assert monitor.target_batch_bytes == float("inf")
+        assert fake_bq_client.queries == []
+
+    def test_query_picks_cheaper_strategy(self, create_monitor, fake_bq_client):
+        monitor = create_monitor(query_budget_bytes=500)
+
+        monitor.query()
+
+        assert monitor.query_plan.strategy.name == "summary"
+        assert monitor.metrics_mode == "summary"
+        assert monitor.query_plan.total_bytes <= 500
+        summary_queries = [
+            sql for sql, _ in fake_bq_client.queries if "summary_" in sql
+        ]
+        assert len(summary_queries) == 1
+
+    def test_query_over_budget_fails_before_querying(
+        self, create_monitor, fake_bq_client
+    ):
+        with pytest.raises(QueryBudgetExceededError):
+            create_monitor(query_budget_bytes=100).query()
+        with pytest.raises(QueryBudgetExceededError):
+            create_monitor(
+                query_budget_bytes=5000, allow_cheaper_strategies=False
+            ).query()
+
+        assert fake_bq_client.queries == []
+
+    def test_query_reads_results_from_cache(
+        self, create_monitor, fake_bq_client, tmp_path
+    ):
+        first_monitor = create_monitor(cache_dir=str(tmp_path))
+        first_monitor.query()
+        queries_count = len(fake_bq_client.queries)
+
+        second_monitor = create_monitor(cache_dir=str(tmp_path))
+        second_monitor.query()
+
+        # Every stage of the second report is read from the cache
+        assert len(fake_bq_client.queries) == queries_count
+        pd.testing.assert_frame_equal(
+            second_monitor.metrics.reset_index(drop=True),
+            first_monitor.metrics.reset_index(drop=True),
+        )
+        assert second_monitor.runtime.shape == first_monitor.runtime.shape
+        assert set(second_monitor.job_stats.to_dataframe().source) == {"cache"}
+
+    def test_running_workflows_are_not_kept_in_cache(
+        self, create_monitor, fake_bq_client, tmp_path
+    ):
+        create_monitor(workflow_ids=["wf2"], cache_dir=str(tmp_path)).query()
+        queries_count = len(fake_bq_client.queries)
+
+        create_monitor(
+            workflow_ids=["wf2"], cache_dir=str(tmp_path), cache_running_ttl_sec=0
+        ).query()
+
+        assert len(fake_bq_client.queries) == 2 * queries_count
+
+    def test_refresh(self, create_monitor, fake_bq_client):
+        monitor = create_monitor(workflow_ids=["wf2"])
+        monitor.query()
+        assert monitor.metrics_watermarks.to_dict() == {
+            21: pd.Timestamp("2024-01-01 01:00:01", tz="UTC")
+        }
+
+        # VM 21 keeps running and VM 22 is started
+        fake_bq_client.runtime = pd.concat(
+            [
+                fake_bq_client.runtime,
+                fake_bq_client.runtime.iloc[[2]].assign(
+                    runtime_instance_id=pd.array([22], dtype="Int64"),
+                    runtime_instance_name="vm-22",
+                    runtime_start_time=pd.Timestamp("2024-01-01 01:00:02", tz="UTC"),
+                ),
+            ],
+            ignore_index=True,
+        )
+        fake_bq_client.metrics = pd.concat(
+            [
+                fake_bq_client.metrics,
+                pd.DataFrame(
+                    {
+                        "metrics_instance_id": pd.array([21, 22], dtype="Int64"),
+                        "metrics_timestamp": pd.to_datetime(
+                            ["2024-01-01 01:00:02", "2024-01-01 01:00:03"], utc=True
+                        ),
+                        "metrics_mem_used_gb": [6.0, 7.0],
+                    }
+                ),
+            ],
+            ignore_index=True,
+        )
+        fake_bq_client.queries.clear()
+
+        monitor.refresh()
+
+        metrics_queries = [
+            parameters
+            for _, parameters in fake_bq_client.queries
+            if "instance_ids" in parameters
+        ]
+        assert all("metrics_since" in parameters for parameters in metrics_queries)
+        # VMs still running may record past the end of their batch
+        assert all(
+            parameters["end_time"] == monitor.end_time for parameters in metrics_queries
+        )
+        assert monitor.runtime.runtime_instance_id.tolist() == [21, 22]
+        assert monitor.metrics.metrics_mem_used_gb.tolist() == [4.0, 5.0, 6.0, 7.0]
+        assert monitor.runtime.metrics_duration_sec.tolist() == [2, 1]
+        assert monitor.metadata_runtime.shape[0] == 2
+        assert monitor.metrics_watermarks.to_dict() == {
+            21: pd.Timestamp("2024-01-01 01:00:02", tz="UTC"),
+            22: pd.Timestamp("2024-01-01 01:00:03", tz="UTC"),
+        }
+
+    def test_refresh_skips_finished_instances(self, create_monitor, fake_bq_client):
+        monitor = create_monitor(workflow_ids=["wf1"])
+        monitor.query()
+        fake_bq_client.queries.clear()
+
+        monitor.refresh()
+
+        # Both VMs of wf1 finished before their last sample, only the runtime and
+        # metadata tables are queried again
+        assert len(fake_bq_client.queries) == 2
+        assert len(monitor.metrics) == 5
+
+    def test_refresh_summary_mode(self, create_monitor):
+        with pytest.raises(ValueError):
+            create_monitor(metrics_mode="summary").refresh()
+
+    def test_query_fetches_metadata_concurrently(self, create_monitor, fake_bq_client):
+        metrics_queried = threading.Event()
+        metadata_waited = []
+        fake_query = fake_bq_client.query
+
+        def query(query, job_config=None):
+            if "cromwell_monitoring.metadata" in query:
+                # Blocks the metadata query until the metrics are queried, which
+                # only happens if it does not hold back the runtime and metrics
+                metadata_waited.append(metrics_queried.wait(timeout=10))
+            elif "cromwell_monitoring.metrics" in query and "runtime" not in query:
+                metrics_queried.set()
+            return fake_query(query, job_config=job_config)
+
+        fake_bq_client.query = query
+        monitor = create_monitor()
+
+        monitor.query()
+
+        assert metadata_waited == [True]
+        assert monitor.metadata_runtime.shape[0] == 2
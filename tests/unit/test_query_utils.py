@@ -0,0 +1,246 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+from google.cloud import bigquery
+
+from cromonitor.query import utils
+from cromonitor.query.instrumentation import QueryJobStats
+
+
+class FakeRowIterator:
+    def __init__(self, record_batches, schema=None):
+        self.record_batches = record_batches
+        self.schema = schema or []
+        self.started = False
+        self.bqstorage_client = None
+        self.create_bqstorage_client = None
+
+    def _start(self):
+        if self.started:
+            raise ValueError("Iterator has already started")
+        self.started = True
+
+    def to_arrow(self, create_bqstorage_client=True):
+        self._start()
+        self.create_bqstorage_client = create_bqstorage_client
+        return pa.Table.from_batches(self.record_batches)
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        self._start()
+        self.bqstorage_client = bqstorage_client
+        yield from self.record_batches
+
+    def to_dataframe(self, create_bqstorage_client=True):
+        self._start()
+        return pd.DataFrame({"metrics_instance_id": pd.array([], dtype="Int64")})
+
+
+class FakeQueryJob:
+    def __init__(self, record_batches, schema=None):
+        self.rows = FakeRowIterator(record_batches, schema=schema)
+
+    job_id = "job-1"
+    total_bytes_processed = 1024
+    total_bytes_billed = 10 * 1024**2
+    slot_millis = 300
+    cache_hit = False
+    started = pd.Timestamp("2024-01-01 00:00:00", tz="UTC")
+    ended = pd.Timestamp("2024-01-01 00:00:01.5", tz="UTC")
+
+    def result(self):
+        return self.rows
+
+
+class FakeBQStorageClient:
+    pass
+
+
+class TestQueryUtils:
+    @pytest.fixture
+    def record_batches(self):
+        schema = pa.schema(
+            [
+                ("metrics_instance_id", pa.int64()),
+                ("metrics_cpu_used_percent", pa.list_(pa.float64())),
+                ("metrics_timestamp", pa.timestamp("us", tz="UTC")),
+                ("runtime_preemptible", pa.bool_()),
+            ]
+        )
+        return [
+            pa.record_batch(
+                [
+                    pa.array([1, 1]),
+                    pa.array([[10.0, 20.0], [30.0]]),
+                    pa.array([0, 1_000_000], type=pa.timestamp("us", tz="UTC")),
+                    pa.array([True, False]),
+                ],
+                schema=schema,
+            ),
+            pa.record_batch(
+                [
+                    pa.array([2]),
+                    pa.array([[50.0]]),
+                    pa.array([2_000_000], type=pa.timestamp("us", tz="UTC")),
+                    pa.array([None], type=pa.bool_()),
+                ],
+                schema=schema,
+            ),
+        ]
+
+    def test_query_job_to_dataframe_uses_rest_api_by_default(self, record_batches):
+        query_job = FakeQueryJob(record_batches)
+
+        df = utils.query_job_to_dataframe(query_job)
+
+        assert query_job.rows.create_bqstorage_client is False
+        assert df.shape == (3, 4)
+        assert df.metrics_instance_id.dtype == "Int64"
+        assert df.runtime_preemptible.dtype == "boolean"
+
+    def test_query_job_to_dataframe_records_stats(self, record_batches):
+        query_job = FakeQueryJob(record_batches)
+        stats = QueryJobStats(name="raw metrics")
+
+        utils.query_job_to_dataframe(query_job, stats=stats)
+
+        assert stats.job_id == "job-1"
+        assert stats.bytes_processed == 1024
+        assert stats.bytes_billed == 10 * 1024**2
+        assert stats.slot_ms == 300
+        assert stats.cache_hit is False
+        assert stats.server_elapsed_sec == 1.5
+        assert stats.rows == 3
+        for step in ["wait_sec", "download_sec", "conversion_sec"]:
+            assert getattr(stats, step) >= 0
+
+    def test_query_job_to_dataframe_streams_arrow_batches(self, record_batches):
+        query_job = FakeQueryJob(record_batches)
+        bqstorage_client = FakeBQStorageClient()
+
+        df = utils.query_job_to_dataframe(query_job, bqstorage_client=bqstorage_client)
+
+        assert query_job.rows.bqstorage_client is bqstorage_client
+        assert df.shape == (3, 4)
+        assert df.metrics_instance_id.dtype == "Int64"
+        assert str(df.metrics_timestamp.dtype) == "datetime64[us, UTC]"
+        assert df.runtime_preemptible.dtype == "boolean"
+        assert df.metrics_cpu_used_percent.apply(list).tolist() == [
+            [10.0, 20.0],
+            [30.0],
+            [50.0],
+        ]
+
+    @pytest.mark.parametrize("dtype_backend", ["numpy", "pyarrow"])
+    def test_query_job_to_dataframe_without_rows(self, dtype_backend):
+        query_job = FakeQueryJob(
+            [],
+            schema=[
+                bigquery.SchemaField("metrics_instance_id", "INTEGER"),
+                bigquery.SchemaField("metrics_cpu_used_percent", "FLOAT", "REPEATED"),
+                bigquery.SchemaField("metrics_timestamp", "TIMESTAMP"),
+            ],
+        )
+
+        df = utils.query_job_to_dataframe(
+            query_job,
+            bqstorage_client=FakeBQStorageClient(),
+            dtype_backend=dtype_backend,
+        )
+
+        assert df.empty
+        assert list(df.columns) == [
+            "metrics_instance_id",
+            "metrics_cpu_used_percent",
+            "metrics_timestamp",
+        ]
+        assert df.metrics_instance_id.dtype == utils.nullable_int_dtype(dtype_backend)
+
+    def test_bq_schema_to_arrow_schema(self):
+        schema = [
+            bigquery.SchemaField("workflow_id", "STRING"),
+            bigquery.SchemaField("metrics_timestamp", "TIMESTAMP"),
+            bigquery.SchemaField(
+                "labels",
+                "RECORD",
+                "REPEATED",
+                fields=[
+                    bigquery.SchemaField("key", "STRING"),
+                    bigquery.SchemaField("value", "STRING"),
+                ],
+            ),
+        ]
+
+        assert utils.bq_schema_to_arrow_schema(schema) == pa.schema(
+            [
+                ("workflow_id", pa.string()),
+                ("metrics_timestamp", pa.timestamp("us", tz="UTC")),
+                (
+                    "labels",
+                    pa.list_(pa.struct([("key", pa.string()), ("value", pa.string())])),
+                ),
+            ]
+        )
+
+    def test_query_job_to_dataframe_with_pyarrow_dtypes(self, record_batches):
+        query_job = FakeQueryJob(record_batches)
+
+        df = utils.query_job_to_dataframe(
+            query_job,
+            bqstorage_client=FakeBQStorageClient(),
+            dtype_backend="pyarrow",
+        )
+
+        assert df.metrics_instance_id.dtype == pd.ArrowDtype(pa.int64())
+        assert df.metrics_cpu_used_percent.dtype == pd.ArrowDtype(
+            pa.list_(pa.float64())
+        )
+        assert df.runtime_preemptible.isna().tolist() == [False, False, True]
+
+    def test_arrow_table_to_dataframe_encodes_labels(self):
+        arrow_table = pa.table(
+            {
+                "runtime_task_call_name": ["align", "align", None],
+                "runtime_instance_name": ["vm-1", "vm-2", "vm-3"],
+                "meta_end_time": ["2024-01-01", None, None],
+            }
+        )
+
+        df = utils.arrow_table_to_dataframe(arrow_table, dtype_backend="pyarrow")
+
+        assert isinstance(df.runtime_task_call_name.dtype, pd.CategoricalDtype)
+        assert df.runtime_task_call_name.cat.categories.tolist() == ["align"]
+        assert df.runtime_instance_name.dtype == pd.ArrowDtype(pa.string())
+        assert df.meta_end_time.dtype == pd.ArrowDtype(pa.string())
+
+    def test_convert_dtype_backend(self):
+        df = pd.DataFrame(
+            {
+                "metrics_instance_id": pd.array([1, None], dtype="Int64"),
+                "metrics_cpu_used_percent": [[10.0], [20.0, 30.0]],
+            }
+        )
+
+        assert utils.convert_dtype_backend(df, "numpy") is df
+        converted = utils.convert_dtype_backend(df, "pyarrow")
+        assert converted.metrics_instance_id.dtype == pd.ArrowDtype(pa.int64())
+        assert converted.metrics_cpu_used_percent.tolist() == [[10.0], [20.0, 30.0]]
+
+    def test_unknown_dtype_backend(self):
+        with pytest.raises(ValueError, match="dtype_backend"):
+            utils.arrow_table_to_dataframe(pa.table({"a": [1]}), dtype_backend="c")
+
+    def test_to_utc_timestamp(self):
+        assert utils.to_utc_timestamp("2024-01-01 00:00") == pd.Timestamp(
+            "2024-01-01 00:00", tz="UTC"
+        )
+        assert utils.to_utc_timestamp(
+            pd.Timestamp("2024-01-01 01:00", tz="Europe/Paris")
+        ) == pd.Timestamp("2024-01-01 00:00", tz="UTC")
+
+    def test_and_expressions(self):
+        table = pa.table({"x": [1, 2, 3]})
+        expression = utils.and_expressions([pc.field("x") > 1, pc.field("x") < 3])
+
+        assert table.filter(expression).column("x").to_pylist() == [2]
+        assert utils.and_expressions([]) is None
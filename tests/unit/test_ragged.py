@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from cromonitor.table import ragged
+
+
+class TestRaggedArray:
+    @pytest.fixture
+    def rows(self):
+        return pd.Series(
+            [
+                np.array([10.0, 30.0]),
+                [90.0, np.nan],
+                None,
+                np.nan,
+                [],
+                5.0,
+                np.array([1.0, 2.0, 3.0]),
+            ],
+            index=[10, 11, 12, 13, 14, 15, 16],
+        )
+
+    def test_from_sequences(self, rows):
+        array = ragged.RaggedArray.from_sequences(rows)
+
+        assert len(array) == len(rows)
+        assert array.lengths.tolist() == [2, 2, 0, 0, 0, 1, 3]
+        assert array.offsets.tolist() == [0, 2, 4, 4, 4, 4, 5, 8]
+        assert array.values.dtype == np.float64
+        assert array.row(6).tolist() == [1.0, 2.0, 3.0]
+
+    def test_from_arrow(self):
+        list_array = pa.array([[10.0, 30.0], [90.0, None], None, [], [1, 2, 3]])
+
+        array = ragged.RaggedArray.from_arrow(list_array)
+
+        assert array.offsets.tolist() == [0, 2, 4, 4, 4, 7]
+        assert array.values.dtype == np.float64
+        np.testing.assert_array_equal(array.row(1), [90.0, np.nan])
+
+    def test_from_sequences_of_arrow_dtype(self, rows):
+        arrow_rows = pd.Series(
+            [[10.0, 30.0], [90.0, None], None, None, [], [5.0], [1.0, 2.0, 3.0]],
+            index=rows.index,
+            dtype=pd.ArrowDtype(pa.list_(pa.float64())),
+        )
+
+        array = ragged.RaggedArray.from_sequences(arrow_rows)
+        expected = ragged.RaggedArray.from_sequences(rows)
+
+        np.testing.assert_array_equal(array.offsets, expected.offsets)
+        np.testing.assert_array_equal(array.values, expected.values)
+
+    def test_from_sequences_empty(self):
+        array = ragged.RaggedArray.from_sequences([])
+
+        assert len(array) == 0
+        assert array.mean().tolist() == []
+        assert array.to_padded().shape == (0, 0)
+
+    def test_reductions(self, rows):
+        array = ragged.RaggedArray.from_sequences(rows)
+        nan = np.nan
+
+        np.testing.assert_array_equal(
+            array.mean(), [20.0, 90.0, nan, nan, nan, 5.0, 2.0]
+        )
+        np.testing.assert_array_equal(
+            array.max(), [30.0, 90.0, nan, nan, nan, 5.0, 3.0]
+        )
+        np.testing.assert_array_equal(
+            array.min(), [10.0, 90.0, nan, nan, nan, 5.0, 1.0]
+        )
+        np.testing.assert_array_equal(
+            array.first(), [10.0, 90.0, nan, nan, nan, 5.0, 1.0]
+        )
+        assert array.count().tolist() == [2, 1, 0, 0, 0, 1, 3]
+
+    def test_reductions_match_row_by_row(self):
+        generator = np.random.default_rng(0)
+        rows = [generator.random(generator.integers(1, 8)) for _ in range(1000)]
+
+        array = ragged.RaggedArray.from_sequences(rows)
+
+        np.testing.assert_allclose(array.mean(), [row.mean() for row in rows])
+        np.testing.assert_array_equal(array.max(), [row.max() for row in rows])
+        np.testing.assert_array_equal(array.first(), [row[0] for row in rows])
+
+    def test_element_and_padded(self, rows):
+        array = ragged.RaggedArray.from_sequences(rows)
+        nan = np.nan
+
+        np.testing.assert_array_equal(
+            array.element(1), [30.0, nan, nan, nan, nan, nan, 2.0]
+        )
+        padded = array.to_padded(fill_value=-1.0)
+        assert padded.shape == (7, 3)
+        assert padded[0].tolist() == [10.0, 30.0, -1.0]
+        assert padded[6].tolist() == [1.0, 2.0, 3.0]
+        assert padded[2].tolist() == [-1.0, -1.0, -1.0]
+
+    def test_take(self, rows):
+        array = ragged.RaggedArray.from_sequences(rows)
+
+        taken = array.take([6, 0, 2])
+
+        assert taken.lengths.tolist() == [3, 2, 0]
+        assert taken.values.tolist() == [1.0, 2.0, 3.0, 10.0, 30.0]
+        assert array.take(array.lengths > 1).lengths.tolist() == [2, 2, 3]
+
+    def test_reduce_repeated_column(self, rows):
+        result = ragged.reduce_repeated_column(rows, "max")
+
+        assert result.index.tolist() == rows.index.tolist()
+        assert result[16] == 3.0
+
+
+class TestSampleReductions:
+    def test_add_sample_reductions(self, mock_data):
+        metrics = ragged.add_sample_reductions(mock_data.metrics)
+
+        assert set(ragged.SAMPLE_REDUCTIONS) <= set(metrics.columns)
+        np.testing.assert_allclose(
+            metrics.metrics_cpu_mean_percent,
+            mock_data.metrics.metrics_cpu_used_percent.map(np.nanmean),
+        )
+        np.testing.assert_array_equal(
+            metrics.metrics_disk_first_gb,
+            mock_data.metrics.metrics_disk_used_gb.map(lambda disks: disks[0]),
+        )
+        # The repeated fields are kept
+        pd.testing.assert_frame_equal(
+            metrics[mock_data.metrics.columns], mock_data.metrics
+        )
+
+    def test_add_sample_reductions_without_repeated_fields(self):
+        metrics = pd.DataFrame({"metrics_mem_used_gb": [1.0]})
+
+        pd.testing.assert_frame_equal(ragged.add_sample_reductions(metrics), metrics)
+
+    def test_sample_reduction(self, mock_data):
+        metrics = ragged.add_sample_reductions(mock_data.metrics)
+
+        pd.testing.assert_series_equal(
+            ragged.sample_reduction(mock_data.metrics, "metrics_disk_max_gb"),
+            metrics.metrics_disk_max_gb.rename("metrics_disk_used_gb"),
+        )
@@ -0,0 +1,71 @@
+import pandas as pd
+
+from cromonitor.query import reconcile
+
+
+class TestReconcile:
+    @staticmethod
+    def runtime():
+        return pd.DataFrame(
+            {
+                "runtime_instance_id": pd.array([1, 2, 3], dtype="Int64"),
+                "metrics_duration_sec": pd.array([1, 1, None], dtype="Int64"),
+            }
+        )
+
+    @staticmethod
+    def metrics():
+        return pd.DataFrame(
+            {
+                "metrics_instance_id": pd.array([1, 1, 2], dtype="Int64"),
+                "metrics_timestamp": pd.to_datetime(
+                    [
+                        "2024-01-01 00:00:00",
+                        "2024-01-01 00:00:01",
+                        "2024-01-01 00:00:00",
+                    ],
+                    utc=True,
+                ),
+            }
+        )
+
+    def test_backoff_delay_sec(self):
+        assert [reconcile.backoff_delay_sec(attempt, 2.0) for attempt in [1, 2, 3]] == [
+            2.0,
+            4.0,
+            8.0,
+        ]
+
+    def test_missing_instance_ids(self):
+        assert reconcile.missing_instance_ids(self.runtime(), self.metrics()) == [3]
+        assert reconcile.missing_instance_ids(self.runtime(), pd.DataFrame()) == [
+            1,
+            2,
+            3,
+        ]
+
+    def test_deduplicate_metrics(self):
+        metrics = self.metrics()
+        fetched_twice = pd.concat([metrics, metrics.iloc[[0]]], ignore_index=True)
+        summaries = pd.DataFrame({"metrics_instance_id": [1, 1], "summary_mem": [1, 1]})
+
+        pd.testing.assert_frame_equal(
+            reconcile.deduplicate_metrics(fetched_twice), metrics
+        )
+        assert len(reconcile.deduplicate_metrics(summaries)) == 1
+
+    def test_completeness_report(self):
+        report = reconcile.completeness_report(
+            runtime=self.runtime(),
+            metrics=self.metrics(),
+            refetch_attempts=pd.Series({2: 1, 3: 2}),
+            failed_instance_ids=[3],
+        )
+
+        assert report.instance_id.tolist() == [1, 2, 3]
+        assert report.row_count.tolist() == [2, 1, 0]
+        assert report.fetched_duration_sec[:2].tolist() == [1.0, 0.0]
+        assert pd.isna(report.fetched_duration_sec[2])
+        assert report.refetch_attempts.tolist() == [0, 1, 2]
+        assert report.status.tolist() == ["complete", "refetched", "failed"]
+        assert set(report.status) <= set(reconcile.COMPLETENESS_STATUSES)
@@ -0,0 +1,167 @@
+import concurrent.futures
+import threading
+
+import pandas as pd
+import pytest
+
+from cromonitor.query import scheduling
+from cromonitor.query.batching import MetricsBatch
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(scheduling, "POLL_INTERVAL_SEC", 0.01)
+
+
+@pytest.fixture
+def executor():
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    yield executor
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SlowBatches:
+    """
+    Fetches batches, blocking the batches of the slow instance ids until their
+    attempt is cancelled
+    """
+
+    def __init__(self, slow_ids=()):
+        self.slow_ids = set(slow_ids)
+        self.cancelled = {}
+        self.fetched = []
+
+    def fetch(self, attempt):
+        ids = attempt.batch.instance_ids
+        self.fetched.append(ids)
+        if self.slow_ids.intersection(ids):
+            cancelled = self.cancelled.setdefault(id(attempt), threading.Event())
+            cancelled.wait(timeout=5)
+            raise RuntimeError("Job cancelled")
+        return pd.DataFrame({"metrics_instance_id": ids})
+
+    def cancel(self, attempt):
+        self.cancelled.setdefault(id(attempt), threading.Event()).set()
+
+
+class TestScheduling:
+    def test_job_labels(self):
+        labels = scheduling.job_labels("Session1", "raw metrics")
+
+        assert labels == {
+            "cromonitor-session": "session1",
+            "cromonitor-query": "raw-metrics",
+        }
+
+    def test_split_batch(self):
+        batch = MetricsBatch(instance_ids=[1, 2, 3, 4, 5], estimated_bytes=100)
+
+        pieces = scheduling.split_batch(batch, 2)
+
+        assert [piece.instance_ids for piece in pieces] == [[1, 3, 5], [2, 4]]
+        assert pieces[0].estimated_bytes == 50
+        assert len(scheduling.split_batch(MetricsBatch(instance_ids=[1]), 3)) == 1
+
+    def test_split_batch_keeps_time_range(self):
+        start_time = pd.Timestamp("2024-01-01", tz="UTC")
+        end_time = pd.Timestamp("2024-01-02", tz="UTC")
+        batch = MetricsBatch(
+            instance_ids=[1, 2], start_time=start_time, end_time=end_time
+        )
+
+        pieces = scheduling.split_batch(batch, 2)
+
+        assert [(piece.start_time, piece.end_time) for piece in pieces] == [
+            (start_time, end_time),
+            (start_time, end_time),
+        ]
+
+    def test_running_jobs_by_owner(self):
+        running_jobs = scheduling.RunningJobs()
+        first, second, other = object(), object(), object()
+
+        with running_jobs.owned_by("batch 1"):
+            running_jobs.add(first)
+            running_jobs.add(second)
+        running_jobs.add(other)
+        running_jobs.remove(second)
+
+        assert running_jobs.pop("batch 1") == [first]
+        assert running_jobs.pop() == [other]
+        assert len(running_jobs) == 0
+
+    def test_run_batches(self, executor):
+        slow_batches = SlowBatches()
+        batches = [MetricsBatch(instance_ids=[1, 2]), MetricsBatch(instance_ids=[3])]
+
+        results, failures = scheduling.run_batches(
+            executor, slow_batches.fetch, batches, cancel=slow_batches.cancel
+        )
+
+        assert [df.metrics_instance_id.tolist() for df in results] == [[1, 2], [3]]
+        assert failures == []
+
+    def test_batch_past_deadline_is_abandoned(self, executor):
+        slow_batches = SlowBatches(slow_ids=[1])
+        batches = [MetricsBatch(instance_ids=[1, 2]), MetricsBatch(instance_ids=[3])]
+
+        results, failures = scheduling.run_batches(
+            executor,
+            slow_batches.fetch,
+            batches,
+            cancel=slow_batches.cancel,
+            batch_timeout_sec=0.05,
+        )
+
+        assert [df.metrics_instance_id.tolist() for df in results] == [[3]]
+        assert [batch.instance_ids for batch, _ in failures] == [[1, 2]]
+        assert isinstance(failures[0][1], TimeoutError)
+        assert len(slow_batches.cancelled) == 1
+
+    def test_slow_batch_is_hedged(self, executor):
+        slow_batches = SlowBatches(slow_ids=[1])
+        batches = [MetricsBatch(instance_ids=[1, 2, 3, 4])]
+        # Only the first attempt at the batch is slow
+        fetch = slow_batches.fetch
+
+        def fetch_once(attempt):
+            if len(slow_batches.fetched) > 0:
+                slow_batches.slow_ids.clear()
+            return fetch(attempt)
+
+        results, failures = scheduling.run_batches(
+            executor,
+            fetch_once,
+            batches,
+            cancel=slow_batches.cancel,
+            hedge_after_sec=0.05,
+        )
+
+        assert failures == []
+        assert sorted(results[0].metrics_instance_id) == [1, 2, 3, 4]
+        assert slow_batches.fetched[1:] == [[1, 3], [2, 4]]
+        # The job of the slow batch is cancelled once its pieces finish
+        assert len(slow_batches.cancelled) == 1
+
+    def test_failed_batch_waits_for_its_hedges(self, executor):
+        release = threading.Event()
+        batches = [MetricsBatch(instance_ids=[1, 2])]
+
+        def fetch(attempt):
+            if attempt.batch.instance_ids == [1, 2]:
+                release.wait(timeout=5)
+                raise ConnectionError("Connection reset")
+            # Pieces start before the batch fails
+            release.set()
+            return pd.DataFrame({"metrics_instance_id": attempt.batch.instance_ids})
+
+        results, failures = scheduling.run_batches(
+            executor,
+            fetch,
+            batches,
+            cancel=lambda attempt: None,
+            hedge_after_sec=0.02,
+        )
+
+        assert failures == []
+        assert sorted(results[0].metrics_instance_id) == [1, 2]
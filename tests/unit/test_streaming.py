@@ -0,0 +1,88 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from cromonitor.query.streaming import METRICS_KEY_COLUMNS, StreamedMetrics
+
+
+def record_batches(metrics, batch_rows):
+    return pa.Table.from_pandas(metrics, preserve_index=False).to_batches(
+        max_chunksize=batch_rows
+    )
+
+
+class TestStreamedMetrics:
+    @pytest.fixture
+    def streamed_metrics(self, tmp_path):
+        return StreamedMetrics(str(tmp_path / "metrics"), buffer_rows=50)
+
+    def test_write_part(self, streamed_metrics, mock_data):
+        keys = streamed_metrics.write_part(record_batches(mock_data.metrics, 20))
+
+        parts = streamed_metrics.parts()
+        assert len(parts) == 1
+        # Pages are buffered up to buffer_rows rows per row group
+        assert pq.ParquetFile(parts[0]).num_row_groups == 3
+        assert list(keys.columns) == METRICS_KEY_COLUMNS
+        pd.testing.assert_frame_equal(keys, mock_data.metrics[METRICS_KEY_COLUMNS])
+        pd.testing.assert_frame_equal(streamed_metrics.read(), mock_data.metrics)
+        assert streamed_metrics.count_rows() == len(mock_data.metrics)
+
+    def test_write_part_without_rows(self, streamed_metrics, mock_data):
+        keys = streamed_metrics.write_part(iter([]))
+
+        assert keys.empty
+        assert streamed_metrics.parts() == []
+        assert streamed_metrics.read().empty
+        assert list(streamed_metrics.iter_batches()) == []
+
+    def test_failed_query_leaves_no_part(self, streamed_metrics, mock_data, tmp_path):
+        def failing_batches():
+            yield from record_batches(mock_data.metrics, 60)
+            raise ConnectionError("Connection reset")
+
+        with pytest.raises(ConnectionError):
+            streamed_metrics.write_part(failing_batches())
+
+        assert streamed_metrics.parts() == []
+        assert not list((tmp_path / "metrics").iterdir())
+
+    def test_write_part_transform(self, streamed_metrics, mock_data):
+        streamed_metrics.write_part(
+            record_batches(mock_data.metrics, 20),
+            transform=lambda metrics: metrics.assign(
+                metrics_mem_used_mb=metrics.metrics_mem_used_gb * 1024
+            ),
+        )
+
+        metrics = streamed_metrics.read(
+            columns=["metrics_mem_used_gb", "metrics_mem_used_mb"]
+        )
+        assert (metrics.metrics_mem_used_mb == metrics.metrics_mem_used_gb * 1024).all()
+
+    def test_read_filters(self, streamed_metrics, mock_data):
+        other_vm = mock_data.metrics.assign(metrics_instance_id=2)
+        streamed_metrics.write_part(record_batches(mock_data.metrics, 100))
+        streamed_metrics.write_part(record_batches(other_vm, 100))
+        # Overlapping refresh of the last samples
+        streamed_metrics.write_part(record_batches(other_vm.iloc[-10:], 100))
+        start_time = mock_data.metrics.metrics_timestamp.min() + pd.Timedelta("60s")
+
+        metrics = streamed_metrics.read(
+            instance_ids=[2], start_time=start_time, columns=METRICS_KEY_COLUMNS
+        )
+
+        assert streamed_metrics.count_rows() == 2 * len(mock_data.metrics) + 10
+        assert (metrics.metrics_instance_id == 2).all()
+        assert len(metrics) == (mock_data.metrics.metrics_timestamp >= start_time).sum()
+
+    def test_iter_batches(self, streamed_metrics, mock_data):
+        streamed_metrics.write_part(record_batches(mock_data.metrics, 100))
+
+        batches = list(
+            streamed_metrics.iter_batches(columns=METRICS_KEY_COLUMNS, batch_size=40)
+        )
+
+        assert max(len(batch) for batch in batches) <= 40
+        assert sum(len(batch) for batch in batches) == len(mock_data.metrics)
@@ -0,0 +1,108 @@
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from cromonitor.table import utils
+from cromonitor.table.store import MonitoringStore
+
+
+def _normalize(df):
+    df = df.sort_values(["metrics_instance_id", "metrics_timestamp"])
+    df = df.reset_index(drop=True).astype(object)
+    return df.where(df.notna(), None)
+
+
+class TestMonitoringStore:
+    @pytest.fixture
+    def tables(self, mock_data):
+        # A second task of the workflow, on another VM, and a second workflow
+        metadata_runtime = mock_data.metadata_runtime
+        other_task = metadata_runtime.assign(
+            runtime_task_call_name="other_task", runtime_instance_id=2, runtime_shard=3
+        )
+        other_workflow = metadata_runtime.assign(
+            runtime_workflow_id="other-workflow", runtime_instance_id=3
+        )
+        metrics = pd.concat(
+            [
+                mock_data.metrics,
+                mock_data.metrics.assign(metrics_instance_id=2),
+                mock_data.metrics.assign(metrics_instance_id=3),
+            ],
+            ignore_index=True,
+        )
+        metadata_runtime = pd.concat(
+            [metadata_runtime, other_task, other_workflow], ignore_index=True
+        )
+        return metrics, metadata_runtime
+
+    @pytest.fixture
+    def store(self, tables, tmp_path):
+        store = MonitoringStore(str(tmp_path / "store"), rows_per_group=50)
+        store.write(*tables)
+        return store
+
+    def test_round_trip(self, store, tables, mock_data):
+        metrics, metadata_runtime = tables
+        workflow_id = mock_data.metadata_runtime.runtime_workflow_id[0]
+
+        metrics_runtime = store.read_metrics_runtime(workflow_ids=[workflow_id])
+
+        expected = utils.create_metrics_runtime_table(
+            metrics=metrics,
+            metadata_runtime=metadata_runtime[
+                metadata_runtime.runtime_workflow_id == workflow_id
+            ],
+        )
+        # Missing values of object columns are read back as None
+        pd.testing.assert_frame_equal(
+            _normalize(metrics_runtime[expected.columns]), _normalize(expected)
+        )
+        assert store.exists()
+        assert sorted(store.task_names()) == ["other_task", "write_to_stdout"]
+
+    def test_partitions(self, store, mock_data):
+        workflow_id = mock_data.metadata_runtime.runtime_workflow_id[0]
+        task_dir = (
+            f"{store.metrics_dir}/runtime_workflow_id={workflow_id}/"
+            "runtime_task_call_name=other_task"
+        )
+
+        task_files = pq.ParquetDataset(task_dir).files
+
+        assert len(task_files) == 1
+        # Samples of a task are split into row groups that the filters can skip
+        assert pq.ParquetFile(task_files[0]).num_row_groups == 4
+
+    def test_read_filters(self, store, mock_data):
+        start_time = mock_data.metrics.metrics_timestamp.min() + pd.Timedelta("60s")
+
+        metrics = store.read_metrics(
+            task_names=["other_task"],
+            shards=[3],
+            start_time=start_time,
+            columns=["metrics_timestamp", "metrics_mem_used_gb"],
+        )
+
+        assert list(metrics.columns) == ["metrics_timestamp", "metrics_mem_used_gb"]
+        assert len(metrics) == (mock_data.metrics.metrics_timestamp >= start_time).sum()
+        assert (metrics.metrics_timestamp >= start_time).all()
+        assert store.read_metrics(task_names=["other_task"], shards=[0]).empty
+
+    def test_write_replaces_workflow(self, store, tables, mock_data):
+        metrics, metadata_runtime = tables
+        workflow_id = mock_data.metadata_runtime.runtime_workflow_id[0]
+        workflow_runtime = metadata_runtime[
+            (metadata_runtime.runtime_workflow_id == workflow_id)
+            & (metadata_runtime.runtime_task_call_name == "other_task")
+        ]
+
+        store.write(metrics.iloc[:10], workflow_runtime)
+
+        assert len(store.read_metrics(task_names=["other_task"])) == 0
+        assert len(store.read_metrics(workflow_ids=["other-workflow"])) == len(
+            mock_data.metrics
+        )
+        assert sorted(
+            store.read_metadata_runtime().runtime_workflow_id.unique()
+        ) == sorted([workflow_id, "other-workflow"])